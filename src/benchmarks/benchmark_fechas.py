@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the date stage: compares formatear_fecha_nacimiento_y_egreso followed by
+calcular_edades_por_fechas_de_nacimiento_y_egreso against normalizar_fechas_egresos on
+synthetic DEIS-like dates (few distinct dates repeated over many rows), with the dates as
+strings and as categoricals.
+
+Usage:
+    python -m src.benchmarks.benchmark_fechas --filas 10000000 --repeticiones 3
+"""
+import click
+import numpy as np
+import polars as pl
+
+from src.benchmarks.benchmark_mapeo import medir_tiempo
+from src.data.make_dataset import (
+    COLUMNAS_FECHA,
+    calcular_edades_por_fechas_de_nacimiento_y_egreso,
+    formatear_fecha_nacimiento_y_egreso,
+    normalizar_fechas_egresos,
+)
+
+ANO_EGRESO = 2019
+DIAS_NACIMIENTO = 100 * 365
+
+
+def generar_fechas(n_filas, semilla=0):
+    """Genera una tabla sintetica con las fechas de nacimiento y egreso de un anio del DEIS"""
+    rng = np.random.default_rng(semilla)
+    df = pl.DataFrame(
+        {
+            "dia_egreso": rng.integers(0, 365, n_filas),
+            "edad_dias": rng.integers(0, DIAS_NACIMIENTO, n_filas),
+        }
+    )
+
+    egreso = pl.date(ANO_EGRESO, 1, 1) + pl.duration(days=pl.col("dia_egreso"))
+    nacimiento = egreso - pl.duration(days=pl.col("edad_dias"))
+
+    return df.select(
+        pl.lit(ANO_EGRESO).alias("ANO_EGRESO"),
+        nacimiento.dt.strftime("%Y-%m-%d").alias("FECHA_NACIMIENTO"),
+        egreso.dt.strftime("%Y-%m-%d").alias("FECHA_EGRESO"),
+    )
+
+
+@click.command()
+@click.option("--filas", type=int, default=10_000_000, help="Cantidad de filas sinteticas.")
+@click.option("--repeticiones", type=int, default=3, help="Repeticiones por metodo.")
+def main(filas, repeticiones):
+    """Compara el parseo fila a fila con la normalizacion de fechas unicas."""
+    df = generar_fechas(filas)
+
+    def fechas_por_fila():
+        tmp = formatear_fecha_nacimiento_y_egreso(df.lazy())
+        return calcular_edades_por_fechas_de_nacimiento_y_egreso(tmp).collect()
+
+    def fechas_normalizadas():
+        return normalizar_fechas_egresos(df.lazy()).collect()
+
+    def fechas_categoricas():
+        return normalizar_fechas_egresos(df_categorico.lazy()).collect()
+
+    with pl.StringCache():
+        df_categorico = df.with_columns(pl.col(COLUMNAS_FECHA).cast(pl.Categorical))
+        tiempo_categoricas, resultado_categoricas = medir_tiempo(fechas_categoricas, repeticiones)
+
+    tiempo_por_fila, resultado_por_fila = medir_tiempo(fechas_por_fila, repeticiones)
+    tiempo_unicas, resultado_unicas = medir_tiempo(fechas_normalizadas, repeticiones)
+
+    columnas_comunes = resultado_por_fila.columns
+    iguales = resultado_por_fila.frame_equal(
+        resultado_unicas.select(columnas_comunes)
+    ) and resultado_unicas.frame_equal(resultado_categoricas)
+    n_invalidas = resultado_unicas["FECHA_INVALIDA"].sum()
+
+    print(f"> Filas: {filas}")
+    print(f"> Fechas distintas: {df['FECHA_NACIMIENTO'].n_unique()} (nacimiento)")
+    print(f"> Parseo por fila: {tiempo_por_fila:.3f} s")
+    print(f"> normalizar_fechas_egresos: {tiempo_unicas:.3f} s ({n_invalidas} fechas invalidas)")
+    print(f"> normalizar_fechas_egresos (categoricas): {tiempo_categoricas:.3f} s")
+    print(f"> Aceleracion: {tiempo_por_fila / tiempo_unicas:.2f}x")
+    print(f"> Aceleracion (categoricas): {tiempo_por_fila / tiempo_categoricas:.2f}x")
+    print(f"> Resultados iguales: {iguales}")
+
+
+if __name__ == "__main__":
+    main()
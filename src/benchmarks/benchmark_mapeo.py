@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the column remapping stage: compares the chained mappear_columnas calls
+used until now against mappear_columnas_vectorizado on synthetic DEIS-like columns.
+
+Usage:
+    python -m src.benchmarks.benchmark_mapeo --filas 3000000 --repeticiones 3
+"""
+import time
+
+import click
+import numpy as np
+import polars as pl
+
+from src.data.make_dataset import (
+    MAPPING_METRICAS_EGRESOS,
+    MAPPING_SOCIODEMOGRAFICO,
+    mappear_columnas,
+    mappear_columnas_vectorizado,
+)
+
+REGIONES = [
+    "Metropolitana de Santiago",
+    "Del Libertador B. O'Higgins",
+    "De Aisén del Gral. C. Ibáñez del Campo",
+    "De Valparaíso",
+]
+
+
+def generar_columnas_a_mapear(n_filas, semilla=0):
+    """Genera una tabla sintetica con las columnas que se mapean al leer la base del DEIS"""
+    rng = np.random.default_rng(semilla)
+
+    with pl.StringCache():
+        return pl.DataFrame(
+            {
+                "INTERV_Q": rng.choice([1.0, 2.0], n_filas),
+                "CONDICION_EGRESO": rng.choice([1.0, 2.0], n_filas),
+                "GLOSA_REGION_RESIDENCIA": rng.choice(REGIONES, n_filas),
+                "SEXO": rng.choice([1.0, 2.0, 3.0, 99.0], n_filas),
+                "PUEBLO_ORIGINARIO": rng.choice([1.0, 2.0, 96.0, 97.0], n_filas),
+                "PREVISION": rng.choice([1.0, 2.0, 3.0, 96.0, 99.0], n_filas),
+            }
+        ).with_columns(pl.col("GLOSA_REGION_RESIDENCIA").cast(pl.Categorical))
+
+
+def medir_tiempo(funcion, repeticiones):
+    """Retorna el menor tiempo (en segundos) de ejecutar la funcion y su ultimo resultado"""
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        resultado = funcion()
+        tiempos.append(time.perf_counter() - inicio)
+
+    return min(tiempos), resultado
+
+
+@click.command()
+@click.option("--filas", type=int, default=3_000_000, help="Cantidad de filas sinteticas.")
+@click.option("--repeticiones", type=int, default=3, help="Repeticiones por metodo.")
+def main(filas, repeticiones):
+    """Compara el mapeo encadenado con el mapeo vectorizado en una sola proyeccion."""
+    with pl.StringCache():
+        df = generar_columnas_a_mapear(filas)
+
+        def mapeo_encadenado():
+            tmp = mappear_columnas(df.lazy(), MAPPING_METRICAS_EGRESOS)
+            return mappear_columnas(tmp, MAPPING_SOCIODEMOGRAFICO).collect()
+
+        def mapeo_vectorizado():
+            return mappear_columnas_vectorizado(
+                df.lazy(), MAPPING_METRICAS_EGRESOS, MAPPING_SOCIODEMOGRAFICO
+            ).collect()
+
+        tiempo_encadenado, resultado_encadenado = medir_tiempo(mapeo_encadenado, repeticiones)
+        tiempo_vectorizado, resultado_vectorizado = medir_tiempo(mapeo_vectorizado, repeticiones)
+
+    memoria_encadenado = resultado_encadenado.estimated_size("mb")
+    memoria_vectorizado = resultado_vectorizado.estimated_size("mb")
+
+    print(f"> Filas: {filas}")
+    print(f"> mappear_columnas: {tiempo_encadenado:.3f} s, {memoria_encadenado:.1f} MB")
+    print(
+        f"> mappear_columnas_vectorizado: {tiempo_vectorizado:.3f} s, {memoria_vectorizado:.1f} MB"
+    )
+    print(f"> Aceleracion: {tiempo_encadenado / tiempo_vectorizado:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the PowerPoint table writer: compares add_dataframes_to_powerpoint, which
+sets every cell through python-pptx, against add_dataframes_to_powerpoint_bulk on a synthetic
+ranking table (pandas for both, and Polars for the bulk writer).
+
+Usage:
+    python -m src.benchmarks.benchmark_pptx --filas 1000 --repeticiones 3
+"""
+import tempfile
+from pathlib import Path
+
+import click
+import numpy as np
+import polars as pl
+from lxml import etree
+from pptx import Presentation
+
+from src.benchmarks.benchmark_mapeo import medir_tiempo
+from src.visualization.visualize import (
+    add_dataframes_to_powerpoint,
+    add_dataframes_to_powerpoint_bulk,
+)
+
+OPCIONES_TABLA = {
+    "font_size": 8,
+    "cell_width": 33,
+    "cell_height": 0.5,
+    "font_family": "Open Sans",
+    "max_cell_characters": 100,
+}
+
+
+def generar_tabla_ranking(n_filas, semilla=0):
+    """Genera una tabla sintetica con las columnas de un ranking de egresos por estrato"""
+    rng = np.random.default_rng(semilla)
+    codigos = [f"{letra}{numero:03d}" for letra in "CIJ" for numero in range(200)]
+
+    return pl.DataFrame(
+        {
+            "ANO_EGRESO": rng.integers(2017, 2022, n_filas),
+            "DIAG1": rng.choice(codigos, n_filas),
+            "Descripción": [f"Diagnostico sintetico {i}, descripcion" for i in range(n_filas)],
+            "n_egresos": rng.integers(1, 5_000, n_filas),
+            "dias_estada_totales": rng.integers(1, 50_000, n_filas),
+            "n_int_q": rng.integers(0, 1_000, n_filas),
+            "n_muertos": rng.integers(0, 300, n_filas),
+            "ranking_nacional_n_egresos": rng.integers(1, 200, n_filas),
+            "porcentaje_nacional_n_egresos": rng.random(n_filas).round(4),
+        }
+    )
+
+
+def leer_xml_tablas(ruta_pptx):
+    """Obtiene el XML de las tablas de una presentacion"""
+    return [
+        etree.tostring(shape._element.graphic.graphicData.tbl)
+        for slide in Presentation(ruta_pptx).slides
+        for shape in slide.shapes
+        if shape.has_table
+    ]
+
+
+@click.command()
+@click.option("--filas", type=int, default=1_000, help="Filas de la tabla de ranking.")
+@click.option("--repeticiones", type=int, default=3, help="Repeticiones por metodo.")
+@click.option("--filas-por-diapositiva", type=int, default=25, help="Filas por diapositiva.")
+def main(filas, repeticiones, filas_por_diapositiva):
+    """Compara la escritura celda a celda con la escritura en bloque de las tablas."""
+    df_polars = generar_tabla_ranking(filas)
+    df_pandas = df_polars.to_pandas()
+
+    with tempfile.TemporaryDirectory() as carpeta:
+        ruta_celdas = Path(carpeta) / "celdas.pptx"
+        ruta_bloque = Path(carpeta) / "bloque.pptx"
+        ruta_paginada = Path(carpeta) / "paginada.pptx"
+
+        tiempo_celdas, _ = medir_tiempo(
+            lambda: add_dataframes_to_powerpoint([df_pandas], ruta_celdas, **OPCIONES_TABLA),
+            repeticiones,
+        )
+        tiempo_bloque, _ = medir_tiempo(
+            lambda: add_dataframes_to_powerpoint_bulk([df_pandas], ruta_bloque, **OPCIONES_TABLA),
+            repeticiones,
+        )
+        iguales = leer_xml_tablas(ruta_celdas) == leer_xml_tablas(ruta_bloque)
+
+        tiempo_polars, _ = medir_tiempo(
+            lambda: add_dataframes_to_powerpoint_bulk(
+                [df_polars],
+                ruta_paginada,
+                rows_per_slide=filas_por_diapositiva,
+                **OPCIONES_TABLA,
+            ),
+            repeticiones,
+        )
+        n_diapositivas = len(Presentation(ruta_paginada).slides)
+
+    print(f"> Filas: {filas}")
+    print(f"> add_dataframes_to_powerpoint: {tiempo_celdas:.3f} s")
+    print(f"> add_dataframes_to_powerpoint_bulk: {tiempo_bloque:.3f} s")
+    print(f"> Polars, paginada ({n_diapositivas} diapositivas): {tiempo_polars:.3f} s")
+    print(f"> Aceleracion: {tiempo_celdas / tiempo_bloque:.2f}x")
+    print(f"> Tablas iguales: {iguales}")
+
+
+if __name__ == "__main__":
+    main()
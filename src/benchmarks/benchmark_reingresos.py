@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the readmission rates: compares obtener_tasas_reingreso (one sort and a
+masked shift) against a self-join per patient on synthetic discharges, checks that both give the
+same rates, and times obtener_tasas_reingreso at doubling sizes to show how it scales.
+
+Usage:
+    python -m src.benchmarks.benchmark_reingresos --filas-autojoin 200000 --filas 8000000
+"""
+import click
+import numpy as np
+import polars as pl
+
+from src.benchmarks.benchmark_mapeo import medir_tiempo
+from src.features.build_features import VENTANAS_REINGRESO, obtener_tasas_reingreso
+
+AGRUPACION = ["ESTABLECIMIENTO_SALUD", "DIAG1"]
+EGRESOS_POR_PACIENTE = 1.7
+DIAS_PERIODO = 5 * 365
+
+
+def generar_episodios(n_filas, semilla=0):
+    """Genera egresos sinteticos con pacientes que se repiten y fechas en cinco anios"""
+    rng = np.random.default_rng(semilla)
+    n_pacientes = max(int(n_filas / EGRESOS_POR_PACIENTE), 1)
+
+    return pl.DataFrame(
+        {
+            "ID_PACIENTE": rng.integers(0, n_pacientes, n_filas).astype(str),
+            "ESTABLECIMIENTO_SALUD": rng.integers(0, 200, n_filas),
+            "DIAG1": rng.integers(0, 500, n_filas).astype(str),
+            "DIAS_ESTADA": np.ceil(rng.lognormal(1.3, 0.9, n_filas)).astype(np.int64),
+            "CONDICION_EGRESO": (rng.random(n_filas) < 0.03).astype(np.int64),
+            "__dia_egreso": rng.integers(0, DIAS_PERIODO, n_filas),
+        }
+    ).select(
+        pl.all().exclude("__dia_egreso"),
+        (pl.date(2017, 1, 1) + pl.duration(days=pl.col("__dia_egreso"))).alias("FECHA_EGRESO"),
+    )
+
+
+def es_posterior(llave):
+    """Expresion que compara en orden lexicografico la llave "_siguiente" con la original"""
+    columna, *resto = llave
+    siguiente = pl.col(f"{columna}_siguiente")
+    if not resto:
+        return siguiente > pl.col(columna)
+
+    return (siguiente > pl.col(columna)) | (
+        (siguiente == pl.col(columna)) & es_posterior(resto)
+    )
+
+
+def obtener_tasas_reingreso_autojoin(df, agrupar_por, ventanas=VENTANAS_REINGRESO):
+    """Calcula las tasas de reingreso uniendo cada egreso con todos los del mismo paciente"""
+    episodios = df.with_row_count("orden").with_columns(
+        (pl.col("FECHA_EGRESO") - pl.duration(days=pl.col("DIAS_ESTADA"))).alias("FECHA_INGRESO")
+    )
+    llave = ["FECHA_INGRESO", "FECHA_EGRESO", "orden"]
+    posteriores = episodios.select(["ID_PACIENTE"] + llave)
+
+    # Para cada egreso, el siguiente episodio es el menor de los posteriores segun la llave
+    siguientes = (
+        episodios.select(["ID_PACIENTE"] + llave)
+        .join(posteriores, on="ID_PACIENTE", suffix="_siguiente")
+        .filter(es_posterior(llave))
+        .groupby("orden")
+        .agg(
+            pl.col("FECHA_INGRESO_siguiente")
+            .sort_by(["FECHA_INGRESO_siguiente", "FECHA_EGRESO_siguiente", "orden_siguiente"])
+            .first()
+        )
+    )
+
+    episodios = episodios.join(siguientes, on="orden", how="left").with_columns(
+        (pl.col("FECHA_INGRESO_siguiente") - pl.col("FECHA_EGRESO"))
+        .dt.days()
+        .alias("dias_hasta_reingreso"),
+        pl.col("FECHA_EGRESO").max().alias("ultimo_egreso"),
+    )
+    dias_seguimiento = (pl.col("ultimo_egreso") - pl.col("FECHA_EGRESO")).dt.days()
+
+    return (
+        episodios.groupby(agrupar_por)
+        .agg(
+            [pl.count().alias("n_egresos")]
+            + [
+                metrica
+                for ventana in ventanas
+                for metrica in (
+                    ((pl.col("CONDICION_EGRESO") == 0) & (dias_seguimiento >= ventana))
+                    .sum()
+                    .alias(f"n_en_riesgo_{ventana}d"),
+                    (
+                        (pl.col("CONDICION_EGRESO") == 0)
+                        & (dias_seguimiento >= ventana)
+                        & pl.col("dias_hasta_reingreso").is_between(0, ventana)
+                    )
+                    .sum()
+                    .alias(f"n_reingresos_{ventana}d"),
+                )
+            ]
+        )
+        .with_columns(
+            [
+                pl.when(pl.col(f"n_en_riesgo_{ventana}d") > 0)
+                .then(pl.col(f"n_reingresos_{ventana}d") / pl.col(f"n_en_riesgo_{ventana}d"))
+                .alias(f"tasa_reingreso_{ventana}d")
+                for ventana in ventanas
+            ]
+        )
+    )
+
+
+@click.command()
+@click.option("--filas-autojoin", type=int, default=200_000, help="Filas de la comparacion.")
+@click.option("--filas", type=int, default=8_000_000, help="Filas maximas del escalamiento.")
+@click.option("--repeticiones", type=int, default=3, help="Repeticiones por metodo.")
+def main(filas_autojoin, filas, repeticiones):
+    """Compara las tasas de reingreso por autojoin y por desplazamiento ordenado."""
+    df = generar_episodios(filas_autojoin)
+
+    tiempo_autojoin, resultado_autojoin = medir_tiempo(
+        lambda: obtener_tasas_reingreso_autojoin(df.lazy(), AGRUPACION).collect(), repeticiones
+    )
+    tiempo_shift, resultado_shift = medir_tiempo(
+        lambda: obtener_tasas_reingreso(df.lazy(), AGRUPACION).collect(), repeticiones
+    )
+    iguales = resultado_autojoin.sort(AGRUPACION).frame_equal(
+        resultado_shift.sort(AGRUPACION).select(resultado_autojoin.columns), null_equal=True
+    )
+
+    print(f"> Filas: {filas_autojoin}")
+    print(f"> Autojoin por paciente: {tiempo_autojoin:.3f} s")
+    print(f"> obtener_tasas_reingreso: {tiempo_shift:.3f} s")
+    print(f"> Aceleracion: {tiempo_autojoin / tiempo_shift:.2f}x")
+    print(f"> Resultados iguales: {iguales}")
+
+    print("> Escalamiento de obtener_tasas_reingreso:")
+    n_filas = max(filas // 8, 1)
+    while n_filas <= filas:
+        df = generar_episodios(n_filas)
+        tiempo, _ = medir_tiempo(
+            lambda: obtener_tasas_reingreso(df.lazy(), AGRUPACION).collect(), repeticiones
+        )
+        print(f"  - {n_filas} filas: {tiempo:.3f} s ({tiempo / n_filas * 1e9:.0f} ns por fila)")
+        n_filas *= 2
+
+
+if __name__ == "__main__":
+    main()
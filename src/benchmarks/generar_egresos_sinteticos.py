@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+Generator of synthetic DEIS discharge databases, used by the benchmark suite. It writes one
+semicolon-separated CSV per discharge year with the columns of DICT_VARIABLES (plus DIAG1, DIAG2,
+FECHA_NACIMIENTO and GLOSA_INTERV_Q_PPAL, as the DEIS files), so the files can be read with
+leer_egresos_deis. It needs no network access or external files.
+
+The cardinalities follow the national data: about 2,000 establishments, 10,000 ICD-10 codes and
+346 comunas, with skewed (Zipf-like) frequencies, so a few hospitals and diagnoses concentrate
+most of the discharges. The rows are generated in chunks, so any scale fits in memory.
+
+Usage:
+    python -m src.benchmarks.generar_egresos_sinteticos data/interim/benchmarks/1M --filas 1000000
+"""
+import json
+import string
+from pathlib import Path
+
+import click
+import numpy as np
+import polars as pl
+
+from src.data.make_dataset import CODIGO_TORAX, DICT_VARIABLES
+from src.features.build_features import HOSPITALES_GRD, NO_PERTENECE_SNSS, PERTENECE_SNSS
+
+COLUMNAS_DEIS = list(DICT_VARIABLES) + [
+    "DIAG1",
+    "DIAG2",
+    "FECHA_NACIMIENTO",
+    "GLOSA_INTERV_Q_PPAL",
+]
+ANIOS_EGRESO = [2017, 2018, 2019, 2020, 2021]
+N_ESTABLECIMIENTOS = 2_000
+N_DIAGNOSTICOS = 10_000
+N_COMUNAS = 346
+N_REGIONES = 16
+N_INTERVENCIONES = 2_500
+N_PROCEDIMIENTOS = 1_500
+EXPONENTE_ZIPF = 1.1
+FRACCION_PACIENTES_DISTINTOS = 0.6
+FILAS_POR_BLOQUE = 1_000_000
+ARCHIVO_DESCRIPCION = "descripcion.json"
+
+
+def calcular_pesos_zipf(n_valores, exponente=EXPONENTE_ZIPF):
+    """Calcula probabilidades de tipo Zipf (el valor de rango r tiene peso 1 / r ** exponente)"""
+    pesos = 1.0 / np.arange(1, n_valores + 1) ** exponente
+    return pesos / pesos.sum()
+
+
+def generar_codigos_cie(n_codigos=N_DIAGNOSTICOS):
+    """Genera codigos CIE-10 sinteticos sin punto (ej: "C341", "I10X"), ordenados por letra"""
+    letras = [letra for letra in string.ascii_uppercase if letra != "U"]
+    codigos = [
+        f"{letra}{numero:02d}{sufijo}"
+        for letra in letras
+        for numero in range(100)
+        for sufijo in "0123456789X"
+    ]
+    paso = len(codigos) / n_codigos
+
+    return [codigos[int(i * paso)] for i in range(n_codigos)]
+
+
+def generar_catalogo_cie(codigos_cie):
+    """
+    Generates a synthetic ICD-10 catalog with the columns of catalogo_cie.COLUMNAS_CIE for the
+    given codes.
+
+    :param codigos_cie: The ICD-10 codes.
+    :type codigos_cie: list
+
+    :return: The synthetic catalog.
+    :rtype: pl.DataFrame
+    """
+    codigos = pl.Series("Código", codigos_cie)
+    return pl.DataFrame(codigos).with_columns(
+        ("Capítulo " + pl.col("Código").str.slice(0, 1)).alias("Capítulo"),
+        ("Sección " + pl.col("Código").str.slice(0, 2)).alias("Sección"),
+        ("Categoría " + pl.col("Código").str.slice(0, 3)).alias("Categoría"),
+        ("Diagnóstico sintético " + pl.col("Código")).alias("Descripción"),
+    )
+
+
+def generar_establecimientos(rng, n_establecimientos=N_ESTABLECIMIENTOS):
+    """
+    Generates the establishments: the GRD hospitals and the Torax (public) and the rest, with
+    their SEREMI, health service and membership to the SNSS.
+
+    :return: A table with one row per establishment, sorted by decreasing size.
+    :rtype: pl.DataFrame
+    """
+    codigos_publicos = list(dict.fromkeys(HOSPITALES_GRD + [CODIGO_TORAX]))
+    codigos_libres = np.setdiff1d(np.arange(101_000, 131_000), codigos_publicos)
+    otros = rng.choice(codigos_libres, n_establecimientos - len(codigos_publicos), replace=False)
+    codigos = np.concatenate([codigos_publicos, otros])
+    es_publico = np.concatenate(
+        [np.ones(len(codigos_publicos), bool), rng.random(len(otros)) < 0.45]
+    )
+    seremi = rng.integers(1, N_REGIONES + 1, n_establecimientos)
+
+    return pl.DataFrame(
+        {
+            "ESTABLECIMIENTO_SALUD": codigos.astype(np.float64),
+            "GLOSA_ESTABLECIMIENTO_SALUD": [f"Establecimiento {codigo}" for codigo in codigos],
+            "PERTENENCIA_ESTABLECIMIENTO_SALUD": np.where(
+                es_publico, PERTENECE_SNSS, NO_PERTENECE_SNSS
+            ),
+            "SEREMI": seremi.astype(np.float64),
+            # Dos servicios de salud por SEREMI (el DEIS los numera de forma correlativa)
+            "SERVICIO_DE_SALUD": (
+                seremi * 2 - 1 + rng.integers(0, 2, n_establecimientos)
+            ).astype(np.float64),
+        }
+    )
+
+
+def generar_comunas(rng, n_comunas=N_COMUNAS):
+    """Genera las comunas sinteticas, con su region"""
+    regiones = np.sort(rng.integers(1, N_REGIONES + 1, n_comunas))
+    codigos = regiones * 1_000 + np.arange(n_comunas) % 100 + 1
+
+    return pl.DataFrame(
+        {
+            "COMUNA_RESIDENCIA": codigos.astype(np.float64),
+            "GLOSA_COMUNA_RESIDENCIA": [f"Comuna {codigo}" for codigo in codigos],
+            "REGION_RESIDENCIA": regiones.astype(str),
+            "GLOSA_REGION_RESIDENCIA": [f"Región {region}" for region in regiones],
+        }
+    )
+
+
+def tomar_filas(tabla, indices):
+    """Toma las filas de una tabla de dimension segun un arreglo de indices"""
+    return tabla.select(pl.all().take(pl.Series(indices)))
+
+
+def generar_bloque_egresos(rng, n_filas, anio, dimensiones, n_pacientes):
+    """
+    Generates a chunk of synthetic discharges of one year.
+
+    :param rng: The random generator.
+    :type rng: np.random.Generator
+
+    :param n_filas: The number of rows of the chunk.
+    :type n_filas: int
+
+    :param anio: The discharge year.
+    :type anio: int
+
+    :param dimensiones: The dimension tables (see generar_egresos_sinteticos).
+    :type dimensiones: dict
+
+    :param n_pacientes: The number of distinct patients of the whole database.
+    :type n_pacientes: int
+
+    :return: The chunk, with the columns of COLUMNAS_DEIS.
+    :rtype: pl.DataFrame
+    """
+    establecimientos = dimensiones["establecimientos"]
+    comunas = dimensiones["comunas"]
+    codigos_cie = dimensiones["codigos_cie"]
+
+    indice_establecimiento = rng.choice(
+        len(establecimientos), n_filas, p=dimensiones["pesos_establecimientos"]
+    )
+    indice_comuna = rng.choice(len(comunas), n_filas, p=dimensiones["pesos_comunas"])
+    edad = np.clip(rng.gamma(2.2, 20.0, n_filas), 0, 105).astype(np.int64)
+    dia_egreso = rng.integers(0, 365, n_filas)
+    dias_edad = edad * 365 + rng.integers(0, 365, n_filas)
+    interv_q = rng.random(n_filas) < 0.35
+    con_procedimiento = rng.random(n_filas) < 0.4
+
+    df = pl.DataFrame(
+        {
+            "ID_PACIENTE": rng.integers(0, n_pacientes, n_filas),
+            "SEXO": rng.choice([1.0, 2.0, 3.0, 99.0], n_filas, p=[0.45, 0.549, 0.0005, 0.0005]),
+            "EDAD_A_OS": edad.astype(np.float64),
+            "PUEBLO_ORIGINARIO": rng.choice([1.0, 2.0, 96.0], n_filas, p=[0.08, 0.01, 0.91]),
+            "PAIS_ORIGEN": rng.choice([152.0, 604.0, 862.0], n_filas, p=[0.95, 0.03, 0.02]),
+            "PREVISION": rng.choice(
+                [1.0, 2.0, 3.0, 4.0, 96.0, 99.0], n_filas, p=[0.75, 0.17, 0.02, 0.01, 0.03, 0.02]
+            ),
+            "BENEFICIARIO": rng.choice(["A", "B", "C", "D", ""], n_filas),
+            "MODALIDAD": rng.choice([1.0, 2.0], n_filas, p=[0.9, 0.1]),
+            "PROCEDENCIA": rng.choice([1.0, 2.0, 3.0, 4.0, 5.0], n_filas),
+            "AREA_FUNCIONAL_EGRESO": rng.choice([1.0, 2.0, 3.0, 4.0], n_filas) * 100,
+            "DIAS_ESTADA": np.ceil(rng.lognormal(1.3, 0.9, n_filas)),
+            "CONDICION_EGRESO": np.where(rng.random(n_filas) < 0.03, 2.0, 1.0),
+            "INTERV_Q": np.where(interv_q, 1.0, 2.0),
+            "CODIGO_INTERV_Q_PPAL": pl.Series(
+                np.where(interv_q, 1_000 + rng.zipf(1.5, n_filas) % N_INTERVENCIONES, np.nan),
+                nan_to_null=True,
+            ),
+            "CODIGO_PROCED_PPAL": np.where(
+                con_procedimiento,
+                (rng.zipf(1.5, n_filas) % N_PROCEDIMIENTOS).astype(str),
+                "",
+            ),
+            "DIAG1": codigos_cie[
+                rng.choice(len(codigos_cie), n_filas, p=dimensiones["pesos_cie"])
+            ],
+            "DIAG2": np.where(
+                rng.random(n_filas) < 0.3,
+                codigos_cie[rng.integers(0, len(codigos_cie), n_filas)],
+                "",
+            ),
+            "__dia_egreso": dia_egreso,
+            "__dias_edad": dias_edad,
+        }
+    )
+
+    fecha_egreso = pl.date(anio, 1, 1) + pl.duration(days=pl.col("__dia_egreso"))
+    df = pl.concat(
+        [
+            df,
+            tomar_filas(establecimientos, indice_establecimiento),
+            tomar_filas(comunas, indice_comuna),
+        ],
+        how="horizontal",
+    ).with_columns(
+        ("P" + pl.col("ID_PACIENTE").cast(pl.Utf8)).alias("ID_PACIENTE"),
+        pl.col("EDAD_A_OS").alias("EDAD_CANT"),
+        pl.lit(1.0).alias("TIPO_EDAD"),
+        pl.lit(float(anio)).alias("ANO_EGRESO"),
+        fecha_egreso.dt.strftime("%Y-%m-%d").alias("FECHA_EGRESO"),
+        (fecha_egreso - pl.duration(days=pl.col("__dias_edad")))
+        .dt.strftime("%Y-%m-%d")
+        .alias("FECHA_NACIMIENTO"),
+        pl.when(pl.col("INTERV_Q") == 1.0)
+        .then(pl.lit("SI"))
+        .otherwise(pl.lit("NO"))
+        .alias("PROCED"),
+        pl.when(pl.col("CODIGO_PROCED_PPAL") != "")
+        .then("Procedimiento " + pl.col("CODIGO_PROCED_PPAL"))
+        .otherwise(pl.lit(""))
+        .alias("GLOSA_PROCED_PPAL"),
+        pl.when(pl.col("INTERV_Q") == 1.0)
+        .then("Intervencion " + pl.col("CODIGO_INTERV_Q_PPAL").cast(pl.Int64).cast(pl.Utf8))
+        .otherwise(pl.lit(""))
+        .alias("GLOSA_INTERV_Q_PPAL"),
+        # Los extranjeros no tienen region de residencia
+        pl.when(pl.col("PAIS_ORIGEN") != 152.0)
+        .then(pl.lit("Extranjero"))
+        .otherwise(pl.col("REGION_RESIDENCIA"))
+        .alias("REGION_RESIDENCIA"),
+    )
+
+    return df.select(COLUMNAS_DEIS)
+
+
+def generar_egresos_sinteticos(carpeta_salida, n_filas, semilla=0, anios=ANIOS_EGRESO):
+    """
+    Writes a synthetic DEIS database of n_filas discharges, split evenly in one CSV per year
+    (egresos_<anio>.csv). If the folder already has a database generated with the same
+    parameters (see ARCHIVO_DESCRIPCION), it is not generated again.
+
+    :param carpeta_salida: The folder where the CSVs are written.
+    :type carpeta_salida: str or Path
+
+    :param n_filas: The total number of discharges.
+    :type n_filas: int
+
+    :param semilla: The seed of the random generator.
+    :type semilla: int
+
+    :param anios: The discharge years, one file each.
+    :type anios: list
+
+    :return: The synthetic ICD-10 catalog of the generated codes (see generar_catalogo_cie).
+    :rtype: pl.DataFrame
+    """
+    carpeta_salida = Path(carpeta_salida)
+    ruta_descripcion = carpeta_salida / ARCHIVO_DESCRIPCION
+    descripcion = {"filas": n_filas, "semilla": semilla, "anios": list(anios)}
+
+    rng = np.random.default_rng(semilla)
+    codigos_cie = np.array(generar_codigos_cie())
+    catalogo_cie = generar_catalogo_cie(list(codigos_cie))
+
+    if ruta_descripcion.exists() and json.loads(ruta_descripcion.read_text()) == descripcion:
+        return catalogo_cie
+
+    establecimientos = generar_establecimientos(rng)
+    comunas = generar_comunas(rng)
+    dimensiones = {
+        "establecimientos": establecimientos,
+        "comunas": comunas,
+        "codigos_cie": codigos_cie,
+        "pesos_establecimientos": calcular_pesos_zipf(len(establecimientos), 0.8),
+        "pesos_comunas": calcular_pesos_zipf(len(comunas), 0.8),
+        # Los diagnosticos mas frecuentes quedan repartidos entre capitulos
+        "pesos_cie": rng.permutation(calcular_pesos_zipf(len(codigos_cie))),
+    }
+    n_pacientes = max(int(n_filas * FRACCION_PACIENTES_DISTINTOS), 1)
+
+    carpeta_salida.mkdir(parents=True, exist_ok=True)
+    ruta_descripcion.unlink(missing_ok=True)
+    filas_por_anio = np.diff(np.linspace(0, n_filas, len(anios) + 1).astype(np.int64))
+    for anio, filas_anio in zip(anios, filas_por_anio):
+        with open(carpeta_salida / f"egresos_{anio}.csv", "w", encoding="utf-8") as archivo:
+            for inicio in range(0, filas_anio, FILAS_POR_BLOQUE):
+                n_bloque = min(FILAS_POR_BLOQUE, filas_anio - inicio)
+                bloque = generar_bloque_egresos(rng, n_bloque, anio, dimensiones, n_pacientes)
+                bloque.write_csv(archivo, separator=";", has_header=inicio == 0)
+
+    ruta_descripcion.write_text(json.dumps(descripcion), encoding="utf-8")
+
+    return catalogo_cie
+
+
+@click.command()
+@click.argument("carpeta_salida", type=click.Path())
+@click.option("--filas", type=int, default=1_000_000, help="Cantidad total de egresos.")
+@click.option("--semilla", type=int, default=0, help="Semilla del generador aleatorio.")
+def main(carpeta_salida, filas, semilla):
+    """Genera una base sintetica de egresos del DEIS, con un CSV por anio."""
+    generar_egresos_sinteticos(carpeta_salida, filas, semilla)
+    print(f"> {filas} egresos sinteticos escritos en {carpeta_salida}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end benchmark suite of the DEIS pipeline on synthetic databases (see
+generar_egresos_sinteticos). For every scale it times the main stages and keeps their peak
+memory:
+
+    - ingesta: leer_egresos_deis (compact schema) until the table is collected.
+    - metricas: obtener_metricas_egresos per year, establishment and diagnosis.
+    - ranking_estratos: obtener_diccionario_estratos and calcular_ranking_estratos.
+    - union_cie: leer_y_unir_cie of the metrics with a synthetic ICD-10 catalog.
+
+Every run is appended to a JSON history, and compared with the last run of the same scale, so
+regressions between commits are visible. The suite runs offline: the databases and the ICD-10
+catalog are generated locally, and reused while their parameters do not change.
+
+Usage:
+    python -m src.benchmarks.suite_benchmarks --escalas 1M,10M,50M
+"""
+import gc
+import json
+import subprocess
+import time
+from datetime import datetime
+from pathlib import Path
+
+import click
+import polars as pl
+import psutil
+
+from src.benchmarks.generar_egresos_sinteticos import generar_egresos_sinteticos
+from src.data.make_dataset import CODIGO_TORAX, leer_egresos_deis, medir_memoria_etapa
+from src.features.build_features import (
+    calcular_ranking_estratos,
+    leer_y_unir_cie,
+    obtener_diccionario_estratos,
+    obtener_metricas_egresos,
+)
+
+RUTA_PROYECTO = Path(__file__).resolve().parents[2]
+
+# Escalas por defecto, en cantidad de egresos
+ESCALAS_DEFECTO = "1M,10M,50M"
+SUFIJOS_ESCALA = {"K": 1_000, "M": 1_000_000}
+CARPETA_DATOS = RUTA_PROYECTO / "data" / "interim" / "benchmarks"
+ARCHIVO_HISTORIAL = RUTA_PROYECTO / "reports" / "benchmarks" / "historial_benchmarks.json"
+ARCHIVO_CIE_SINTETICO = "cie_sintetico.xlsx"
+
+# Una etapa es regresion si tarda mas que este factor por el tiempo de la corrida anterior
+UMBRAL_REGRESION = 1.2
+
+AGRUPACION_METRICAS = [
+    "ANO_EGRESO",
+    "ESTABLECIMIENTO_SALUD",
+    "GLOSA_ESTABLECIMIENTO_SALUD",
+    "DIAG1",
+]
+VARIABLES_RANKING = ["n_egresos", "dias_estada_totales", "n_int_q", "n_muertos"]
+SUBGRUPO_RANKING = ["ANO_EGRESO", "DIAG1"]
+
+
+def parsear_escala(escala):
+    """Convierte una escala como "1M" o "500K" a una cantidad de filas"""
+    escala = escala.strip().upper()
+    if escala[-1] in SUFIJOS_ESCALA:
+        return int(float(escala[:-1]) * SUFIJOS_ESCALA[escala[-1]])
+
+    return int(escala)
+
+
+def obtener_commit():
+    """Obtiene el commit actual del repositorio, o None si git no esta disponible"""
+    try:
+        resultado = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=RUTA_PROYECTO,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return resultado.stdout.strip()
+
+
+def medir_etapa(nombre_etapa, funcion, resultados):
+    """
+    Runs a stage, keeping its wall time (s), peak RSS (MB), RSS at its start (MB) and number of
+    output rows in resultados.
+
+    :param nombre_etapa: The name of the stage.
+    :type nombre_etapa: str
+
+    :param funcion: The stage, without arguments. Must return a DataFrame.
+    :type funcion: callable
+
+    :param resultados: Dictionary where the measures of every stage are kept.
+    :type resultados: dict
+
+    :return: The output of the stage.
+    :rtype: pl.DataFrame
+    """
+    gc.collect()
+    rss_inicial = psutil.Process().memory_info().rss / 1024**2
+    picos = {}
+    with medir_memoria_etapa(nombre_etapa, picos):
+        inicio = time.perf_counter()
+        salida = funcion()
+        tiempo = time.perf_counter() - inicio
+
+    resultados[nombre_etapa] = {
+        "segundos": round(tiempo, 4),
+        "rss_pico_mb": round(picos[nombre_etapa], 1),
+        "rss_inicial_mb": round(rss_inicial, 1),
+        "filas_salida": salida.height,
+    }
+    print(f"  - {nombre_etapa}: {tiempo:.2f} s, pico {picos[nombre_etapa]:.0f} MB")
+
+    return salida
+
+
+def ejecutar_escala(n_filas, carpeta_datos, semilla=0):
+    """
+    Generates (or reuses) the synthetic database of a scale and runs every stage on it.
+
+    :param n_filas: The number of discharges of the database.
+    :type n_filas: int
+
+    :param carpeta_datos: The folder with the synthetic databases, one subfolder per scale.
+    :type carpeta_datos: Path
+
+    :param semilla: The seed of the generator.
+    :type semilla: int
+
+    :return: The measures of every stage (see medir_etapa).
+    :rtype: dict
+    """
+    carpeta_escala = Path(carpeta_datos) / str(n_filas)
+    catalogo_cie = generar_egresos_sinteticos(carpeta_escala, n_filas, semilla)
+
+    ruta_cie = Path(carpeta_datos) / ARCHIVO_CIE_SINTETICO
+    if not ruta_cie.exists():
+        catalogo_cie.write_excel(ruta_cie)
+    # Calienta el cache del catalogo, para medir solo la union
+    leer_y_unir_cie(pl.DataFrame({"DIAG1": ["A000"]}), ruta_cie)
+
+    resultados = {}
+    with pl.StringCache():
+        df = medir_etapa(
+            "ingesta",
+            lambda: leer_egresos_deis(carpeta_escala, esquema_compacto=True).collect(),
+            resultados,
+        )
+        metricas = medir_etapa(
+            "metricas",
+            lambda: obtener_metricas_egresos(df.lazy(), AGRUPACION_METRICAS).collect(
+                streaming=True
+            ),
+            resultados,
+        )
+
+        def ranking_estratos():
+            dict_estratos = obtener_diccionario_estratos(df, CODIGO_TORAX)
+            return calcular_ranking_estratos(
+                metricas.lazy(), dict_estratos, VARIABLES_RANKING, SUBGRUPO_RANKING.copy()
+            ).collect()
+
+        medir_etapa("ranking_estratos", ranking_estratos, resultados)
+        medir_etapa(
+            "union_cie",
+            lambda: leer_y_unir_cie(
+                metricas.with_columns(pl.col("DIAG1").cast(pl.Utf8)).lazy(), ruta_cie
+            ).collect(),
+            resultados,
+        )
+
+    return resultados
+
+
+def leer_historial(ruta_historial):
+    """Lee el historial de corridas, o una lista vacia si no existe"""
+    ruta_historial = Path(ruta_historial)
+    if not ruta_historial.exists():
+        return []
+
+    return json.loads(ruta_historial.read_text(encoding="utf-8"))
+
+
+def guardar_historial(ruta_historial, historial):
+    """Escribe el historial de corridas"""
+    ruta_historial = Path(ruta_historial)
+    ruta_historial.parent.mkdir(parents=True, exist_ok=True)
+    ruta_historial.write_text(json.dumps(historial, indent=2), encoding="utf-8")
+
+
+def comparar_con_anterior(corrida, historial, umbral_regresion=UMBRAL_REGRESION):
+    """
+    Compares the stages of a run with the last run of the same scale in the history.
+
+    :param corrida: The run to compare.
+    :type corrida: dict
+
+    :param historial: The previous runs.
+    :type historial: list
+
+    :param umbral_regresion: Time ratio above which a stage is flagged as a regression.
+    :type umbral_regresion: float
+
+    :return: The names of the stages flagged as regressions.
+    :rtype: list
+    """
+    anteriores = [previa for previa in historial if previa["filas"] == corrida["filas"]]
+    if not anteriores:
+        print("  > Sin corridas anteriores de esta escala")
+        return []
+
+    anterior = anteriores[-1]
+    print(f"  > Comparacion con {anterior['commit']} ({anterior['fecha']}):")
+    regresiones = []
+    for nombre_etapa, medidas in corrida["etapas"].items():
+        medidas_anteriores = anterior["etapas"].get(nombre_etapa)
+        if medidas_anteriores is None:
+            continue
+
+        razon_tiempo = medidas["segundos"] / max(medidas_anteriores["segundos"], 1e-9)
+        razon_memoria = medidas["rss_pico_mb"] / max(medidas_anteriores["rss_pico_mb"], 1e-9)
+        es_regresion = razon_tiempo > umbral_regresion
+        if es_regresion:
+            regresiones.append(nombre_etapa)
+
+        marca = " REGRESION" if es_regresion else ""
+        print(
+            f"    - {nombre_etapa}: tiempo {razon_tiempo:.2f}x, memoria {razon_memoria:.2f}x{marca}"
+        )
+
+    return regresiones
+
+
+@click.command()
+@click.option("--escalas", default=ESCALAS_DEFECTO, help="Escalas separadas por coma (ej: 1M,10M).")
+@click.option("--carpeta-datos", type=click.Path(), default=str(CARPETA_DATOS))
+@click.option("--historial", type=click.Path(), default=str(ARCHIVO_HISTORIAL))
+@click.option("--umbral-regresion", type=float, default=UMBRAL_REGRESION)
+@click.option("--semilla", type=int, default=0, help="Semilla del generador de datos.")
+def main(escalas, carpeta_datos, historial, umbral_regresion, semilla):
+    """Ejecuta la suite de benchmarks y la compara con la corrida anterior de cada escala."""
+    registros = leer_historial(historial)
+    commit = obtener_commit()
+    regresiones = []
+
+    for escala in escalas.split(","):
+        n_filas = parsear_escala(escala)
+        print(f"> Escala {escala.strip()} ({n_filas} egresos)")
+        corrida = {
+            "fecha": datetime.now().isoformat(timespec="seconds"),
+            "commit": commit,
+            "version_polars": pl.__version__,
+            "filas": n_filas,
+            "etapas": ejecutar_escala(n_filas, carpeta_datos, semilla),
+        }
+        regresiones += comparar_con_anterior(corrida, registros, umbral_regresion)
+        registros.append(corrida)
+        guardar_historial(historial, registros)
+
+    if regresiones:
+        print(f"> Etapas con regresion: {', '.join(sorted(set(regresiones)))}")
+
+
+if __name__ == "__main__":
+    main()
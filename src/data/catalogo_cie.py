@@ -0,0 +1,266 @@
+"""
+This module provides cached access to the reference workbooks in data/external, mainly the
+ICD-10 (CIE-10) catalog used to describe the diagnoses of the DEIS discharges.
+
+Excel parsing is slow, so each workbook is converted once to a Parquet cache in data/interim.
+The cache is invalidated when the workbook changes (mtime and size first, then a content hash),
+and the parsed table is memoized in the process. Paths are resolved from the project root, so
+the functions work from any working directory.
+
+Module Constants:
+    - RUTA_PROYECTO: The root folder of the project.
+    - CARPETA_EXTERNA: The folder with the third party reference workbooks.
+    - CARPETA_CACHE: The folder where the Parquet caches are written.
+    - ARCHIVO_CIE: The ICD-10 workbook.
+    - COLUMNAS_CIE: The columns of the ICD-10 catalog.
+    - ARCHIVO_ESQUEMA_REGISTRO: The 2023 registry scheme workbook of the DEIS.
+    - HOJA_COMUNAS: The sheet of the registry scheme with the comunas and regions.
+    - COLUMNA_CODIGO_COMUNA / COLUMNA_CODIGO_REGION: The code columns of that sheet.
+
+Module Functions:
+    - calcular_firma_archivo: Obtains the mtime and size of a file.
+    - leer_excel_cacheado: Reads a sheet of a workbook through its Parquet cache.
+    - leer_catalogo_cie: Reads the ICD-10 catalog.
+    - obtener_diccionario_cie: Obtains a memoized code -> (Capítulo, Sección, Categoría,
+    Descripción) dictionary.
+    - buscar_codigo_cie: Looks up the description of one ICD-10 code.
+    - leer_tabla_comunas: Reads the comuna -> region table of the registry scheme.
+    - leer_tabla_regiones: Obtains the region table from the comuna table.
+    - limpiar_memoria_catalogos: Clears the in-process memoized tables.
+"""
+
+import hashlib
+import json
+from pathlib import Path
+
+import polars as pl
+
+
+RUTA_PROYECTO = Path(__file__).resolve().parents[2]
+CARPETA_EXTERNA = RUTA_PROYECTO / "data" / "external"
+CARPETA_CACHE = RUTA_PROYECTO / "data" / "interim"
+ARCHIVO_CIE = CARPETA_EXTERNA / "CIE-10 - sin_puntos_y_X.xlsx"
+COLUMNAS_CIE = ["Código", "Capítulo", "Sección", "Categoría", "Descripción"]
+ARCHIVO_ESQUEMA_REGISTRO = CARPETA_EXTERNA / "Esquema_Registro-2023.xlsx"
+HOJA_COMUNAS = "Anexo 2"
+FILAS_ENCABEZADO_COMUNAS = 5
+COLUMNA_CODIGO_COMUNA = "Código Comuna"
+COLUMNA_CODIGO_REGION = "Código Región"
+
+TAMANO_BLOQUE_HASH = 1024 * 1024
+
+_MEMORIA_TABLAS = {}
+_MEMORIA_DICCIONARIOS = {}
+
+
+def calcular_firma_archivo(ruta_archivo):
+    """Obtiene el mtime y el tamaño de un archivo"""
+    estadisticas = Path(ruta_archivo).stat()
+    return {"mtime_ns": estadisticas.st_mtime_ns, "tamano": estadisticas.st_size}
+
+
+def calcular_hash_contenido(ruta_archivo):
+    """Calcula el hash sha256 del contenido de un archivo"""
+    hash_archivo = hashlib.sha256()
+    with open(ruta_archivo, "rb") as archivo:
+        for bloque in iter(lambda: archivo.read(TAMANO_BLOQUE_HASH), b""):
+            hash_archivo.update(bloque)
+
+    return hash_archivo.hexdigest()
+
+
+def obtener_rutas_cache(ruta_excel, opciones_lectura, carpeta_cache):
+    """
+    Obtains the Parquet cache path and its JSON sidecar for a workbook and its read options.
+
+    :param ruta_excel: The path of the workbook.
+    :type ruta_excel: Path
+
+    :param opciones_lectura: The options passed to pl.read_excel.
+    :type opciones_lectura: dict
+
+    :param carpeta_cache: The folder where the cache is written.
+    :type carpeta_cache: Path
+
+    :return: The path of the Parquet cache and the path of its sidecar.
+    :rtype: tuple
+    """
+    clave = json.dumps([str(ruta_excel), opciones_lectura], sort_keys=True, default=str)
+    sufijo = hashlib.sha256(clave.encode()).hexdigest()[:12]
+    ruta_cache = Path(carpeta_cache) / f"{Path(ruta_excel).stem}_{sufijo}.parquet"
+
+    return ruta_cache, ruta_cache.with_suffix(".json")
+
+
+def leer_excel_cacheado(ruta_excel, carpeta_cache=CARPETA_CACHE, **opciones_lectura):
+    """
+    Reads a sheet of a workbook through a Parquet cache. The workbook is only parsed when there is
+    no cache or its content changed. The result is memoized in the process while the workbook
+    keeps the same mtime and size.
+
+    :param ruta_excel: The path of the workbook. Relative paths are resolved from the project
+    root.
+    :type ruta_excel: str or Path
+
+    :param carpeta_cache: The folder where the Parquet cache is written.
+    :type carpeta_cache: str or Path
+
+    :param opciones_lectura: Options passed to pl.read_excel (ej: sheet_name, read_csv_options).
+
+    :return: The sheet of the workbook.
+    :rtype: pl.DataFrame
+    """
+    ruta_excel = Path(ruta_excel)
+    if not ruta_excel.is_absolute():
+        ruta_excel = RUTA_PROYECTO / ruta_excel
+
+    ruta_cache, ruta_metadatos = obtener_rutas_cache(ruta_excel, opciones_lectura, carpeta_cache)
+    firma = calcular_firma_archivo(ruta_excel)
+
+    memoria = _MEMORIA_TABLAS.get(ruta_cache)
+    if memoria and memoria[0] == firma:
+        return memoria[1]
+
+    metadatos = {}
+    if ruta_cache.exists() and ruta_metadatos.exists():
+        metadatos = json.loads(ruta_metadatos.read_text(encoding="utf-8"))
+
+    firma_vigente = all(metadatos.get(llave) == valor for llave, valor in firma.items())
+    if not firma_vigente and metadatos:
+        hash_excel = calcular_hash_contenido(ruta_excel)
+        firma_vigente = metadatos.get("hash") == hash_excel
+        if firma_vigente:
+            metadatos.update(firma)
+            ruta_metadatos.write_text(json.dumps(metadatos, indent=2), encoding="utf-8")
+
+    if firma_vigente:
+        tabla = pl.read_parquet(ruta_cache)
+    else:
+        tabla = pl.read_excel(ruta_excel, **opciones_lectura)
+
+        ruta_cache.parent.mkdir(parents=True, exist_ok=True)
+        tabla.write_parquet(ruta_cache)
+        metadatos = {
+            **firma,
+            "hash": calcular_hash_contenido(ruta_excel),
+            "origen": str(ruta_excel),
+        }
+        ruta_metadatos.write_text(json.dumps(metadatos, indent=2), encoding="utf-8")
+
+    _MEMORIA_TABLAS[ruta_cache] = (firma, tabla)
+
+    return tabla
+
+
+def leer_catalogo_cie(ruta_excel=ARCHIVO_CIE, carpeta_cache=CARPETA_CACHE):
+    """
+    Reads the ICD-10 catalog through its Parquet cache.
+
+    :param ruta_excel: The path of the ICD-10 workbook.
+    :type ruta_excel: str or Path
+
+    :param carpeta_cache: The folder where the Parquet cache is written.
+    :type carpeta_cache: str or Path
+
+    :return: The ICD-10 catalog, with the columns in COLUMNAS_CIE.
+    :rtype: pl.DataFrame
+    """
+    return leer_excel_cacheado(ruta_excel, carpeta_cache)
+
+
+def obtener_diccionario_cie(ruta_excel=ARCHIVO_CIE, carpeta_cache=CARPETA_CACHE):
+    """
+    Obtains a dictionary from each ICD-10 code to its (Capítulo, Sección, Categoría,
+    Descripción). The dictionary is memoized while the catalog does not change.
+
+    :param ruta_excel: The path of the ICD-10 workbook.
+    :type ruta_excel: str or Path
+
+    :param carpeta_cache: The folder where the Parquet cache is written.
+    :type carpeta_cache: str or Path
+
+    :return: The code -> (Capítulo, Sección, Categoría, Descripción) dictionary.
+    :rtype: dict
+    """
+    catalogo = leer_catalogo_cie(ruta_excel, carpeta_cache)
+
+    memoria = _MEMORIA_DICCIONARIOS.get(str(ruta_excel))
+    if memoria and memoria[0] is catalogo:
+        return memoria[1]
+
+    diccionario = {
+        codigo: tuple(descripcion)
+        for codigo, *descripcion in catalogo.select(COLUMNAS_CIE).iter_rows()
+    }
+    _MEMORIA_DICCIONARIOS[str(ruta_excel)] = (catalogo, diccionario)
+
+    return diccionario
+
+
+def buscar_codigo_cie(codigo, ruta_excel=ARCHIVO_CIE):
+    """
+    Looks up an ICD-10 code in the catalog.
+
+    :param codigo: The ICD-10 code, without dots (ej: "C341").
+    :type codigo: str
+
+    :param ruta_excel: The path of the ICD-10 workbook.
+    :type ruta_excel: str or Path
+
+    :return: The (Capítulo, Sección, Categoría, Descripción) of the code, or None if the code is
+    not in the catalog.
+    :rtype: tuple or None
+    """
+    return obtener_diccionario_cie(ruta_excel).get(codigo)
+
+
+def leer_tabla_comunas(ruta_excel=ARCHIVO_ESQUEMA_REGISTRO, carpeta_cache=CARPETA_CACHE):
+    """
+    Reads the comuna table of the registry scheme ("Anexo 2", after its header rows) through its
+    Parquet cache. Each row is a comuna, with its name and the code of its region.
+
+    :param ruta_excel: The path of the registry scheme workbook.
+    :type ruta_excel: str or Path
+
+    :param carpeta_cache: The folder where the Parquet cache is written.
+    :type carpeta_cache: str or Path
+
+    :return: The comuna table, with COLUMNA_CODIGO_COMUNA and COLUMNA_CODIGO_REGION among its
+    columns.
+    :rtype: pl.DataFrame
+    """
+    return leer_excel_cacheado(
+        ruta_excel,
+        carpeta_cache,
+        sheet_name=HOJA_COMUNAS,
+        read_csv_options={"skip_rows": FILAS_ENCABEZADO_COMUNAS},
+    )
+
+
+def leer_tabla_regiones(ruta_excel=ARCHIVO_ESQUEMA_REGISTRO, carpeta_cache=CARPETA_CACHE):
+    """
+    Obtains the region table (one row per region) from the region columns of the comuna table.
+
+    :param ruta_excel: The path of the registry scheme workbook.
+    :type ruta_excel: str or Path
+
+    :param carpeta_cache: The folder where the Parquet cache is written.
+    :type carpeta_cache: str or Path
+
+    :return: The region table, with COLUMNA_CODIGO_REGION and the other region columns.
+    :rtype: pl.DataFrame
+    """
+    comunas = leer_tabla_comunas(ruta_excel, carpeta_cache)
+    columnas_region = [columna for columna in comunas.columns if "Región" in columna]
+
+    return (
+        comunas.select(columnas_region)
+        .filter(pl.col(COLUMNA_CODIGO_REGION).is_not_null())
+        .unique(subset=COLUMNA_CODIGO_REGION, maintain_order=True)
+    )
+
+
+def limpiar_memoria_catalogos():
+    """Limpia las tablas y diccionarios guardados en memoria"""
+    _MEMORIA_TABLAS.clear()
+    _MEMORIA_DICCIONARIOS.clear()
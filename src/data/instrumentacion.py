@@ -0,0 +1,209 @@
+"""
+This module implements the opt-in instrumentation of the pipeline stages. When it is enabled,
+every stage decorated with etapa_perfilada (or wrapped in perfilar_etapa) records its wall time,
+rows in and out and peak RSS, plus the Polars query plan (LazyFrame.explain) with and without
+streaming when the stage receives or returns a LazyFrame. Every record is logged as a JSON line,
+and escribir_reporte_perfilado writes all of them to a JSON report.
+
+The instrumentation is enabled with the VARIABLE_ENTORNO_PERFILADO environment variable, whose
+value is the path of the report (make_dataset sets it from its --perfilado option). When it is
+not set, the stages run unchanged.
+
+A stage that returns a LazyFrame only builds the plan, so its time does not include the work:
+that is measured where the plan is collected, which is instrumented as its own stage. The row
+counts are only recorded for DataFrames, counting a LazyFrame would execute it.
+
+Module Constants:
+    - VARIABLE_ENTORNO_PERFILADO: The environment variable that enables the instrumentation.
+    - INTERVALO_MUESTREO_MEMORIA: The seconds between two samples of the process' RSS.
+    - REGISTROS_PERFILADO: The records of the stages profiled in this process.
+
+Module Functions:
+    - medir_rss_mb: Returns the current RSS of the process.
+    - medir_memoria_etapa: Context manager that keeps the peak RSS of a stage.
+    - perfilado_activo / activar_perfilado: Check and enable the instrumentation.
+    - perfilar_etapa: Context manager that records a stage, when the instrumentation is enabled.
+    - etapa_perfilada: Decorator that records every call of a function as a stage.
+    - escribir_reporte_perfilado: Writes the records to a JSON report.
+"""
+
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+import polars as pl
+import psutil
+
+VARIABLE_ENTORNO_PERFILADO = "EGRESOS_PERFILADO"
+INTERVALO_MUESTREO_MEMORIA = 0.05
+
+# Registros de las etapas perfiladas, en el orden en que terminan, y pila de etapas en curso
+REGISTROS_PERFILADO = []
+ETAPAS_EN_CURSO = []
+
+
+def medir_rss_mb():
+    """Retorna el RSS actual del proceso, en MB"""
+    return psutil.Process().memory_info().rss / 1024**2
+
+
+@contextmanager
+def medir_memoria_etapa(nombre_etapa, picos_por_etapa):
+    """
+    Context manager that samples the process' RSS in a background thread while the stage runs
+    and keeps the peak value (in MB) of every stage in picos_por_etapa.
+
+    :param nombre_etapa: The name of the stage being measured.
+    :type nombre_etapa: str
+
+    :param picos_por_etapa: Dictionary where the peak RSS of each stage is accumulated.
+    :type picos_por_etapa: dict
+    """
+    proceso = psutil.Process()
+    pico = {"rss": proceso.memory_info().rss}
+    terminado = threading.Event()
+
+    def muestrear():
+        while not terminado.wait(INTERVALO_MUESTREO_MEMORIA):
+            pico["rss"] = max(pico["rss"], proceso.memory_info().rss)
+
+    hilo = threading.Thread(target=muestrear, daemon=True)
+    hilo.start()
+    try:
+        yield
+    finally:
+        terminado.set()
+        hilo.join()
+        pico_mb = max(pico["rss"], proceso.memory_info().rss) / 1024**2
+        picos_por_etapa[nombre_etapa] = max(picos_por_etapa.get(nombre_etapa, 0), pico_mb)
+
+
+def perfilado_activo():
+    """Indica si la instrumentacion de las etapas esta activada"""
+    return bool(os.environ.get(VARIABLE_ENTORNO_PERFILADO))
+
+
+def activar_perfilado(ruta_reporte):
+    """Activa la instrumentacion (tambien en los subprocesos) con la ruta del reporte"""
+    os.environ[VARIABLE_ENTORNO_PERFILADO] = str(ruta_reporte)
+
+
+def contar_filas(tabla):
+    """Retorna las filas de un DataFrame, o None si no es un DataFrame"""
+    return tabla.height if isinstance(tabla, pl.DataFrame) else None
+
+
+@contextmanager
+def perfilar_etapa(nombre_etapa, entrada=None):
+    """
+    Context manager that records a stage when the instrumentation is enabled: its wall time,
+    peak RSS, rows in and out, and the query plan with and without streaming. The output is
+    given by setting registro["salida"] on the yielded dictionary. The plan is the one of the
+    output if it is a LazyFrame, otherwise the one of the input (ej: a collect stage).
+
+    Stages nested in other stages are named with the path of the enclosing stages (ej:
+    "leer_archivos_egresos_deis/transformar_egresos_deis").
+
+    :param nombre_etapa: The name of the stage.
+    :type nombre_etapa: str
+
+    :param entrada: The input table of the stage.
+    :type entrada: pl.DataFrame or pl.LazyFrame, optional
+
+    :return: The record of the stage (an empty dictionary if the instrumentation is disabled).
+    :rtype: dict
+    """
+    if not perfilado_activo():
+        yield {}
+        return
+
+    logger = logging.getLogger(__name__)
+
+    ETAPAS_EN_CURSO.append(nombre_etapa)
+    registro = {
+        "etapa": "/".join(ETAPAS_EN_CURSO),
+        "inicio": datetime.now().isoformat(timespec="milliseconds"),
+        "filas_entrada": contar_filas(entrada),
+    }
+    picos = {}
+    inicio = time.perf_counter()
+    try:
+        with medir_memoria_etapa(nombre_etapa, picos):
+            yield registro
+    except Exception as error:
+        registro["error"] = repr(error)
+        raise
+    finally:
+        registro["segundos"] = round(time.perf_counter() - inicio, 4)
+        registro["rss_pico_mb"] = round(picos[nombre_etapa], 1)
+        ETAPAS_EN_CURSO.pop()
+
+        salida = registro.pop("salida", None)
+        registro["filas_salida"] = contar_filas(salida)
+        # Los planes se obtienen despues de medir, para no sumar su costo a la etapa
+        tabla_plan = salida if isinstance(salida, pl.LazyFrame) else entrada
+        if isinstance(tabla_plan, pl.LazyFrame):
+            registro["plan"] = tabla_plan.explain()
+            registro["plan_streaming"] = tabla_plan.explain(streaming=True, comm_subplan_elim=False)
+
+        REGISTROS_PERFILADO.append(registro)
+        resumen = {clave: valor for clave, valor in registro.items() if "plan" not in clave}
+        logger.info(json.dumps(resumen))
+
+
+def etapa_perfilada(funcion):
+    """
+    Decorator that records every call of a function as a stage (see perfilar_etapa), with its
+    first argument as the input and its return value as the output. When the instrumentation is
+    disabled the function is called directly.
+
+    :param funcion: The stage function.
+    :type funcion: callable
+
+    :return: The decorated function.
+    :rtype: callable
+    """
+
+    @functools.wraps(funcion)
+    def funcion_perfilada(*args, **kwargs):
+        if not perfilado_activo():
+            return funcion(*args, **kwargs)
+
+        entrada = args[0] if args else None
+        with perfilar_etapa(funcion.__name__, entrada) as registro:
+            salida = funcion(*args, **kwargs)
+            registro["salida"] = salida
+
+        return salida
+
+    return funcion_perfilada
+
+
+def escribir_reporte_perfilado(ruta_reporte=None):
+    """
+    Writes the records of the stages profiled in this process to a JSON report.
+
+    :param ruta_reporte: The path of the report. Defaults to the value of
+    VARIABLE_ENTORNO_PERFILADO.
+    :type ruta_reporte: str or Path, optional
+
+    :return: The path of the report.
+    :rtype: Path
+    """
+    ruta_reporte = Path(ruta_reporte or os.environ[VARIABLE_ENTORNO_PERFILADO])
+    reporte = {
+        "fecha": datetime.now().isoformat(timespec="seconds"),
+        "version_polars": pl.__version__,
+        "etapas": REGISTROS_PERFILADO,
+    }
+
+    ruta_reporte.parent.mkdir(parents=True, exist_ok=True)
+    ruta_reporte.write_text(json.dumps(reporte, indent=2, ensure_ascii=False), encoding="utf-8")
+
+    return ruta_reporte
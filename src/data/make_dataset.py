@@ -1,11 +1,44 @@
 # -*- coding: utf-8 -*-
+import codecs
+import glob
+import hashlib
+import json
 import logging
+import os
+from bisect import bisect_right
+from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor
+from itertools import accumulate, repeat
 from pathlib import Path
 
 import click
 import polars as pl
+import pyarrow.parquet as pq
 from dotenv import find_dotenv, load_dotenv
 
+try:
+    from src.data.instrumentacion import (
+        VARIABLE_ENTORNO_PERFILADO,
+        activar_perfilado,
+        escribir_reporte_perfilado,
+        etapa_perfilada,
+        medir_memoria_etapa,
+        medir_rss_mb,
+        perfilar_etapa,
+    )
+except ModuleNotFoundError:
+    # Ejecutado como script (python src/data/make_dataset.py, como en el Makefile) sin el paquete
+    # src instalado: el modulo hermano se importa desde la carpeta del script
+    from instrumentacion import (
+        VARIABLE_ENTORNO_PERFILADO,
+        activar_perfilado,
+        escribir_reporte_perfilado,
+        etapa_perfilada,
+        medir_memoria_etapa,
+        medir_rss_mb,
+        perfilar_etapa,
+    )
+
 DICT_VARIABLES = {
     "ID_PACIENTE": str,
     "ESTABLECIMIENTO_SALUD": pl.Float64,
@@ -72,16 +105,137 @@ MAPPING_SOCIODEMOGRAFICO = {
     },
 }
 
+# Tipos compactos para el modo de esquema compacto. Los codigos se leen como Float64 segun
+# DICT_VARIABLES y se convierten al entero mas angosto que admite su rango; los codigos de texto
+# (diagnosticos, procedimientos y glosas) se codifican como diccionario (Categorical)
+ESQUEMA_COMPACTO = {
+    "ESTABLECIMIENTO_SALUD": pl.Int32,
+    "SEREMI": pl.UInt8,
+    "SERVICIO_DE_SALUD": pl.UInt8,
+    "SEXO": pl.UInt8,
+    "EDAD_CANT": pl.UInt8,
+    "TIPO_EDAD": pl.UInt8,
+    "EDAD_A_OS": pl.UInt8,
+    "PUEBLO_ORIGINARIO": pl.UInt8,
+    "PAIS_ORIGEN": pl.UInt16,
+    "COMUNA_RESIDENCIA": pl.UInt16,
+    "REGION_RESIDENCIA": pl.UInt8,
+    "PREVISION": pl.UInt8,
+    "MODALIDAD": pl.UInt8,
+    "PROCEDENCIA": pl.UInt8,
+    "ANO_EGRESO": pl.UInt16,
+    "AREA_FUNCIONAL_EGRESO": pl.UInt16,
+    "DIAS_ESTADA": pl.UInt16,
+    "CONDICION_EGRESO": pl.UInt8,
+    "INTERV_Q": pl.UInt8,
+    "CODIGO_INTERV_Q_PPAL": pl.UInt32,
+    "DIAG1": pl.Categorical,
+    "DIAG2": pl.Categorical,
+    "GLOSA_INTERV_Q_PPAL": pl.Categorical,
+    "CODIGO_PROCED_PPAL": pl.Categorical,
+    "GLOSA_PROCED_PPAL": pl.Categorical,
+}
+
+# Layout ordenado: archivos ordenados por hospital, anio y diagnostico, con estadisticas por
+# grupo de filas y un indice de hospital -> grupos de filas
+COLUMNAS_ORDEN_PARQUET = ["ESTABLECIMIENTO_SALUD", "ANO_EGRESO", "DIAG1"]
+FILAS_POR_GRUPO_ORDENADO = 50_000
+CARPETA_EGRESOS_ORDENADOS = "egresos_ordenados"
+SUFIJO_INDICE = ".indice.json"
+
+# Adaptadores de los formatos de las bases del DEIS, del mas especifico al mas general. Las
+# bases nuevas tienen una primera columna sin nombre y la edad en EDAD_ANOS
+ADAPTADORES_ESQUEMA = {
+    "formato_nuevo": {"eliminar": [""], "renombrar": {"EDAD_ANOS": "EDAD_A_OS"}},
+    "formato_antiguo": {"eliminar": [], "renombrar": {}},
+}
+
+# Codificacion usada si un archivo no es UTF-8 valido (si falla, se usa latin-1)
+CODIFICACION_ALTERNATIVA = "cp1252"
+CARACTERES_BLOQUE_TRANSCODIFICACION = 4 * 1024 * 1024
+CARPETA_EGRESOS_UTF8 = "egresos_utf8"
+# Junto a cada version UTF-8 se guarda el tamano y la fecha de modificacion del archivo de origen
+SUFIJO_ORIGEN_UTF8 = ".origen.json"
+
 VALORES_NULOS = {
     "REGION_RESIDENCIA": "Extranjero",
     "FECHA_EGRESO": "",
 }
 
+# Esquemas de bandas etarias, por nombre de la columna que generan. Los limites se aplican sobre
+# la variable indicada; con cerrado_izquierda los intervalos son [a, b) en vez de (a, b].
+# Las bandas pediatricas se calculan en dias (un mes = 365.25 / 12 dias)
+DIAS_POR_ANO = 365.25
+ESQUEMAS_EDAD = {
+    "EDAD_CATEGORIA": {"variable": "EDAD_A_OS", "limites": list(range(0, 121, 10))},
+    "EDAD_QUINQUENAL": {
+        "variable": "EDAD_A_OS",
+        "limites": list(range(5, 121, 5)),
+        "cerrado_izquierda": True,
+    },
+    "EDAD_PEDIATRICA": {
+        "variable": "EDAD_CALCULADA_DIAS",
+        "limites": [DIAS_POR_ANO / 12, 15 * DIAS_POR_ANO, 18 * DIAS_POR_ANO],
+        "etiquetas": ["neonato", "ninos", "adolescente", "adulto"],
+        "cerrado_izquierda": True,
+    },
+    "EDAD_MENOR_18": {
+        "variable": "EDAD_CALCULADA_DIAS",
+        "limites": [18 * DIAS_POR_ANO],
+        "etiquetas": ["hasta_18", "18_y_mas"],
+        "cerrado_izquierda": True,
+    },
+}
+ESQUEMAS_EDAD_DEFECTO = ["EDAD_CATEGORIA"]
+
+# Normalizacion de fechas: columnas, formato y edad maxima considerada valida
+COLUMNAS_FECHA = ["FECHA_NACIMIENTO", "FECHA_EGRESO"]
+FORMATO_FECHA = "%Y-%m-%d"
+EDAD_MAXIMA_VALIDA = 120
+
 # Imputa codigo del torax
 CODIGO_TORAX = 112103
 
+RANGOS_ENTEROS = {
+    pl.Int8: (-(2**7), 2**7 - 1),
+    pl.Int16: (-(2**15), 2**15 - 1),
+    pl.Int32: (-(2**31), 2**31 - 1),
+    pl.Int64: (-(2**63), 2**63 - 1),
+    pl.UInt8: (0, 2**8 - 1),
+    pl.UInt16: (0, 2**16 - 1),
+    pl.UInt32: (0, 2**32 - 1),
+    pl.UInt64: (0, 2**64 - 1),
+}
+# Valor que ningun tipo entero admite: en un LazyFrame reemplaza a los valores invalidos, para
+# que la conversion estricta falle al recolectar en vez de truncarlos
+VALOR_FUERA_DE_RANGO = float(2**64)
+
+# Columnas por las que se particiona la salida en Parquet (estructura tipo Hive). Dentro de cada
+# particion las filas se ordenan por hospital y se escriben en grupos grandes con estadisticas
+# min/max, para que leer un hospital descarte los grupos de filas que no lo contienen
+COLUMNAS_PARTICION = ["ANO_EGRESO"]
+COLUMNAS_ORDEN_PARTICION = ["ESTABLECIMIENTO_SALUD"]
+FILAS_POR_GRUPO_PARTICION = 100_000
+CARPETA_EGRESOS_PARQUET = "egresos_procesados"
+
+# Manifiesto de archivos crudos ya procesados. Se debe incrementar VERSION_ESQUEMA cada vez
+# que cambien las transformaciones, para forzar el reprocesamiento de todos los archivos
+ARCHIVO_MANIFIESTO = "manifiesto_egresos.json"
+VERSION_ESQUEMA = 4
+TAMANO_BLOQUE_HASH = 2**20
 
-def leer_egresos_deis(ruta_carpeta_contenedora):
+# Hospitales con extracto propio cuando no se indican otros por linea de comandos
+HOSPITALES_EXTRACTOS = [CODIGO_TORAX, 109101]
+
+# Parametros del procesamiento por lotes con memoria acotada. El limite es para el RSS de todo el
+# proceso y es orientativo: los lotes usan lo que el proceso no ocupa ya, pero la memoria fija de
+# polars (hilos, archivos mapeados) no depende del tamano del lote
+LIMITE_MEMORIA_MB_DEFECTO = 2048
+FILAS_MUESTRA_LOTE = 10000
+FACTOR_SEGURIDAD_MEMORIA = 4
+
+
+def leer_egresos_deis(ruta_carpeta_contenedora, esquema_compacto=False, esquemas_edad=None):
     """
     Read and process the DEIS's public databases for hospital discharges in Chile from the input
     directory, filtering by a specific hospital.
@@ -90,26 +244,498 @@ def leer_egresos_deis(ruta_carpeta_contenedora):
     (Instituto Nacional del Torax's code).
     :type filtro_hospital: int, optional
 
+    :param esquema_compacto: If True, the columns are downcast to ESQUEMA_COMPACTO.
+    :type esquema_compacto: bool, optional
+
+    :param esquemas_edad: The age band schemes to add, one categorical column each (see
+    agregar_categorizacion_edad). Defaults to ESQUEMAS_EDAD_DEFECTO.
+    :type esquemas_edad: list or dict, optional
+
     :return: The processed DataFrame filtered by the specified hospital.
     :rtype: pl.DataFrame
     """
+    return leer_archivos_egresos_deis(
+        f"{ruta_carpeta_contenedora}/*.csv", esquema_compacto, esquemas_edad
+    )
+
+
+@etapa_perfilada
+def leer_archivos_egresos_deis(patron_archivos, esquema_compacto=False, esquemas_edad=None):
+    """
+    Read and process one or more DEIS discharge files matching a path or glob pattern. With
+    esquema_compacto, the memory saved on a sample of every file is logged (see
+    registrar_ahorro_memoria).
+
+    :param patron_archivos: Path or glob pattern of the semicolon-separated DEIS files.
+    :type patron_archivos: str
+
+    :param esquema_compacto: If True, the columns are downcast to ESQUEMA_COMPACTO.
+    :type esquema_compacto: bool, optional
+
+    :param esquemas_edad: The age band schemes to add. Defaults to ESQUEMAS_EDAD_DEFECTO.
+    :type esquemas_edad: list or dict, optional
+
+    :return: The processed LazyFrame.
+    :rtype: pl.LazyFrame
+    """
+    if esquema_compacto:
+        for ruta_archivo in sorted(glob.glob(patron_archivos)):
+            registrar_ahorro_memoria(ruta_archivo)
+
     with pl.StringCache():
-        df_nacional = pl.scan_csv(
-            f"{ruta_carpeta_contenedora}/*.csv",
-            separator=";",
-            dtypes=DICT_VARIABLES,
-            null_values=VALORES_NULOS,
+        df_nacional = escanear_egresos_deis(patron_archivos)
+
+        return transformar_egresos_deis(df_nacional, esquema_compacto, esquemas_edad)
+
+
+def leer_encabezado_csv(ruta_archivo, separador=";"):
+    """Lee los nombres de las columnas de la primera linea de un archivo CSV"""
+    with open(ruta_archivo, "rb") as archivo:
+        primera_linea = archivo.readline()
+
+    encabezado = primera_linea.decode("utf-8", errors="replace").lstrip("\ufeff").rstrip("\r\n")
+
+    return [columna.strip().strip('"') for columna in encabezado.split(separador)]
+
+
+def detectar_adaptador_esquema(columnas):
+    """
+    Detect the DEIS file format from its header. A format matches when all the columns that its
+    adapter drops or renames are in the header; formats without changes match any header.
+
+    :param columnas: The columns of the file header.
+    :type columnas: list
+
+    :return: The name of the format and its adapter (see ADAPTADORES_ESQUEMA).
+    :rtype: tuple[str, dict]
+    """
+    for nombre_formato, adaptador in ADAPTADORES_ESQUEMA.items():
+        columnas_adaptadas = set(adaptador["eliminar"]) | set(adaptador["renombrar"])
+        if columnas_adaptadas <= set(columnas):
+            return nombre_formato, adaptador
+
+
+def obtener_tipos_archivo(adaptador):
+    """Obtiene los tipos de DICT_VARIABLES con los nombres que tienen las columnas en el archivo"""
+    nombres_originales = {nuevo: original for original, nuevo in adaptador["renombrar"].items()}
+    return {
+        nombres_originales.get(columna, columna): tipo for columna, tipo in DICT_VARIABLES.items()
+    }
+
+
+def adaptar_esquema(df, adaptador):
+    """
+    Apply a schema adapter to a raw DEIS table, dropping and renaming its columns. The other
+    columns keep their position, so every format ends with the layout of the old format.
+
+    :param df: The raw table, as read from the file.
+    :type df: pl.DataFrame or pl.LazyFrame
+
+    :param adaptador: The adapter of the file format (see ADAPTADORES_ESQUEMA).
+    :type adaptador: dict
+
+    :return: The table with the common layout.
+    :rtype: pl.DataFrame or pl.LazyFrame
+    """
+    return df.drop(adaptador["eliminar"]).rename(adaptador["renombrar"])
+
+
+def escanear_archivo_deis(ruta_archivo):
+    """
+    Lazily scan a single raw DEIS file, adapting its schema according to its header.
+
+    :param ruta_archivo: The raw DEIS file.
+    :type ruta_archivo: str
+
+    :return: The name of the detected format and the adapted LazyFrame.
+    :rtype: tuple[str, pl.LazyFrame]
+    """
+    nombre_formato, adaptador = detectar_adaptador_esquema(leer_encabezado_csv(ruta_archivo))
+
+    # Las columnas con valores nulos se leen como texto y se convierten despues: scan_csv con
+    # null_values por columna falla cuando la proyeccion cambia el orden de las columnas. El
+    # texto vacio ("") se lee como nulo en todas las columnas, igual que con read_csv_batched
+    tipos_archivo = obtener_tipos_archivo(adaptador)
+    tipos_archivo.update({columna: pl.Utf8 for columna in VALORES_NULOS})
+
+    df = pl.scan_csv(ruta_archivo, separator=";", dtypes=tipos_archivo, null_values="")
+    df = adaptar_esquema(df, adaptador).with_columns(
+        [
+            pl.when(pl.col(columna) != valor_nulo)
+            .then(pl.col(columna))
+            .cast(DICT_VARIABLES[columna])
+            .alias(columna)
+            for columna, valor_nulo in VALORES_NULOS.items()
+        ]
+    )
+
+    return nombre_formato, df
+
+
+@etapa_perfilada
+def escanear_egresos_deis(patron_archivos):
+    """
+    Lazily scan every raw DEIS file matching a path or glob pattern as a single LazyFrame. Each
+    file gets the schema adapter of its format, so folders mixing the old and new DEIS formats
+    are read without an intermediate CSV. The files are scanned in parallel when the LazyFrame
+    is collected. The format detected for each file is logged.
+
+    :param patron_archivos: Path or glob pattern of the semicolon-separated DEIS files.
+    :type patron_archivos: str
+
+    :return: The raw discharges of all the files, with a common layout.
+    :rtype: pl.LazyFrame
+    """
+    logger = logging.getLogger(__name__)
+
+    rutas_archivos = sorted(glob.glob(patron_archivos))
+    if not rutas_archivos:
+        raise FileNotFoundError(f"No hay archivos que coincidan con {patron_archivos}")
+
+    escaneos = []
+    for ruta_archivo in rutas_archivos:
+        nombre_formato, df_archivo = escanear_archivo_deis(ruta_archivo)
+        logger.info(f"{Path(ruta_archivo).name}: {nombre_formato}")
+        escaneos.append(df_archivo)
+
+    return pl.concat(escaneos, how="diagonal", parallel=True)
+
+
+def detectar_codificacion(ruta_archivo):
+    """
+    Detect the encoding of a raw DEIS file. The file is validated as UTF-8 by blocks, without
+    loading it whole; if it is not valid UTF-8, it is assumed to be CODIFICACION_ALTERNATIVA.
+
+    :param ruta_archivo: The raw DEIS file.
+    :type ruta_archivo: str
+
+    :return: "utf-8", "utf-8-sig" (UTF-8 with BOM) or CODIFICACION_ALTERNATIVA.
+    :rtype: str
+    """
+    with open(ruta_archivo, "rb") as archivo:
+        inicio = archivo.read(len(codecs.BOM_UTF8))
+        if inicio == codecs.BOM_UTF8:
+            return "utf-8-sig"
+
+        decodificador = codecs.getincrementaldecoder("utf-8")()
+        try:
+            decodificador.decode(inicio)
+            for bloque in iter(lambda: archivo.read(TAMANO_BLOQUE_HASH), b""):
+                decodificador.decode(bloque)
+            decodificador.decode(b"", final=True)
+        except UnicodeDecodeError:
+            return CODIFICACION_ALTERNATIVA
+
+    return "utf-8"
+
+
+def transcodificar_archivo(ruta_origen, ruta_destino, codificacion):
+    """
+    Transcode a file to UTF-8 by blocks of characters, without loading it whole. If the file
+    can not be decoded with the given encoding, it is decoded as latin-1, which accepts any byte.
+
+    :param ruta_origen: The file to transcode.
+    :type ruta_origen: str or Path
+
+    :param ruta_destino: The UTF-8 file to write.
+    :type ruta_destino: str or Path
+
+    :param codificacion: The encoding of the source file.
+    :type codificacion: str
+
+    :return: The encoding used to decode the source file.
+    :rtype: str
+    """
+    ruta_temporal = Path(f"{ruta_destino}.tmp")
+
+    for codificacion_origen in dict.fromkeys([codificacion, "latin-1"]):
+        try:
+            with open(ruta_origen, encoding=codificacion_origen, newline="") as lector, open(
+                ruta_temporal, "w", encoding="utf-8", newline=""
+            ) as escritor:
+                for bloque in iter(lambda: lector.read(CARACTERES_BLOQUE_TRANSCODIFICACION), ""):
+                    escritor.write(bloque)
+        except UnicodeDecodeError:
+            continue
+
+        ruta_temporal.replace(ruta_destino)
+        return codificacion_origen
+
+
+def preparar_archivo_utf8(ruta_archivo, carpeta_utf8):
+    """
+    Leave a UTF-8 version of a raw DEIS file in carpeta_utf8. UTF-8 files are linked, and the
+    other ones are transcoded. The size and modification time of the raw file are saved next to
+    its UTF-8 version (SUFIJO_ORIGEN_UTF8), and files whose size and modification time did not
+    change are skipped. A replaced raw file is prepared again even if it is older than the copy.
+
+    :param ruta_archivo: The raw DEIS file.
+    :type ruta_archivo: str
+
+    :param carpeta_utf8: The folder with the UTF-8 versions of the raw files.
+    :type carpeta_utf8: str or Path
+
+    :return: The path of the UTF-8 file and the detected encoding (None if it was up to date).
+    :rtype: tuple[str, str]
+    """
+    ruta_destino = Path(carpeta_utf8) / Path(ruta_archivo).name
+    ruta_origen = ruta_destino.with_name(ruta_destino.name + SUFIJO_ORIGEN_UTF8)
+
+    estado_archivo = os.stat(ruta_archivo)
+    origen = {"tamano": estado_archivo.st_size, "mtime_ns": estado_archivo.st_mtime_ns}
+    if ruta_destino.exists() and ruta_origen.exists():
+        with open(ruta_origen, encoding="utf-8") as archivo:
+            if json.load(archivo) == origen:
+                return str(ruta_destino), None
+
+    codificacion = detectar_codificacion(ruta_archivo)
+    ruta_origen.unlink(missing_ok=True)
+    ruta_destino.unlink(missing_ok=True)
+
+    if codificacion == "utf-8":
+        try:
+            os.link(ruta_archivo, ruta_destino)
+        except OSError:
+            ruta_destino.symlink_to(Path(ruta_archivo).resolve())
+    else:
+        codificacion = transcodificar_archivo(ruta_archivo, ruta_destino, codificacion)
+
+    with open(ruta_origen, "w", encoding="utf-8") as archivo:
+        json.dump(origen, archivo)
+
+    return str(ruta_destino), codificacion
+
+
+@etapa_perfilada
+def transcodificar_egresos_deis(ruta_carpeta_contenedora, carpeta_utf8, n_procesos=None):
+    """
+    Decode stage of the raw DEIS files: detect the encoding of every file and transcode the
+    ones that are not UTF-8 (DEIS often publishes them in Latin-1/Windows-1252), so they can be
+    scanned by Polars. The files are processed concurrently in a process pool sized to the
+    available cores. The UTF-8 files are only linked into carpeta_utf8.
+
+    :param ruta_carpeta_contenedora: The directory with the raw DEIS CSV files.
+    :type ruta_carpeta_contenedora: str
+
+    :param carpeta_utf8: The folder where the UTF-8 versions of the files are left.
+    :type carpeta_utf8: str or Path
+
+    :param n_procesos: The number of processes. Defaults to the number of cores.
+    :type n_procesos: int, optional
+
+    :return: The folder with the UTF-8 files, to be read with leer_egresos_deis.
+    :rtype: str
+    """
+    logger = logging.getLogger(__name__)
+
+    rutas_archivos = sorted(glob.glob(f"{ruta_carpeta_contenedora}/*.csv"))
+    carpeta_utf8 = Path(carpeta_utf8)
+    carpeta_utf8.mkdir(parents=True, exist_ok=True)
+
+    # Elimina las versiones UTF-8 de archivos que ya no estan en la carpeta de origen
+    nombres_archivos = {Path(ruta_archivo).name for ruta_archivo in rutas_archivos}
+    for ruta_vieja in carpeta_utf8.glob("*.csv"):
+        if ruta_vieja.name not in nombres_archivos:
+            ruta_vieja.unlink()
+    for ruta_vieja in carpeta_utf8.glob(f"*.csv{SUFIJO_ORIGEN_UTF8}"):
+        if ruta_vieja.name.removesuffix(SUFIJO_ORIGEN_UTF8) not in nombres_archivos:
+            ruta_vieja.unlink()
+
+    n_procesos = min(n_procesos or os.cpu_count() or 1, max(len(rutas_archivos), 1))
+    with ProcessPoolExecutor(max_workers=n_procesos) as pool:
+        resultados = list(pool.map(preparar_archivo_utf8, rutas_archivos, repeat(carpeta_utf8)))
+
+    for ruta_utf8, codificacion in resultados:
+        estado = codificacion or "sin cambios"
+        logger.info(f"{Path(ruta_utf8).name}: {estado}")
+
+    return str(carpeta_utf8)
+
+
+def leer_muestra_archivo(ruta_archivo):
+    """
+    Read the first rows of a raw DEIS file with the types of its format.
+
+    :param ruta_archivo: The raw DEIS file.
+    :type ruta_archivo: str
+
+    :return: The raw sample (without adapting) and the adapter of the file format.
+    :rtype: tuple[pl.DataFrame, dict]
+    """
+    _, adaptador = detectar_adaptador_esquema(leer_encabezado_csv(ruta_archivo))
+    muestra = pl.read_csv(
+        ruta_archivo,
+        separator=";",
+        dtypes=obtener_tipos_archivo(adaptador),
+        null_values=VALORES_NULOS,
+        n_rows=FILAS_MUESTRA_LOTE,
+    )
+
+    return muestra, adaptador
+
+
+@etapa_perfilada
+def transformar_egresos_deis(df, esquema_compacto=False, esquemas_edad=None):
+    """
+    Apply the processing steps of the DEIS's discharges to a raw table. It works both on
+    a LazyFrame and on an eager batch of rows.
+
+    :param df: The raw discharges table.
+    :type df: pl.DataFrame or pl.LazyFrame
+
+    :param esquema_compacto: If True, the columns are downcast to ESQUEMA_COMPACTO.
+    :type esquema_compacto: bool, optional
+
+    :param esquemas_edad: The age band schemes to add. Defaults to ESQUEMAS_EDAD_DEFECTO.
+    :type esquemas_edad: list or dict, optional
+
+    :return: The processed table.
+    :rtype: pl.DataFrame or pl.LazyFrame
+    """
+    tmp = compactar_esquema(df) if esquema_compacto else df
+    tmp = mappear_columnas_vectorizado(tmp, MAPPING_METRICAS_EGRESOS, MAPPING_SOCIODEMOGRAFICO)
+    tmp = agregar_columnas_region_y_comuna(tmp)
+    tmp = normalizar_fechas_egresos(tmp)
+    tmp = agregar_categorizacion_edad(tmp, esquemas_edad)
+
+    return tmp
+
+
+def es_valor_invalido(columna, tipo):
+    """Expresion que marca los valores no nulos que no son enteros o no caben en el tipo"""
+    valor = pl.col(columna)
+    minimo, maximo = RANGOS_ENTEROS[tipo]
+
+    return valor.is_not_null() & ((valor != valor.floor()) | (valor < minimo) | (valor > maximo))
+
+
+def validar_rangos_esquema(df, esquema=None):
+    """
+    Check that the numeric columns to downcast only hold integer values inside the range of
+    their compact type. All the columns are checked with a single aggregation.
+
+    :param df: The raw discharges table.
+    :type df: pl.DataFrame
+
+    :param esquema: The compact types. Defaults to ESQUEMA_COMPACTO.
+    :type esquema: dict, optional
+
+    :raises ValueError: If any column has values that do not fit in its compact type.
+    """
+    esquema = esquema or ESQUEMA_COMPACTO
+    columnas_enteras = {
+        columna: tipo
+        for columna, tipo in esquema.items()
+        if columna in df.columns and tipo in pl.INTEGER_DTYPES
+    }
+
+    valores_invalidos = df.select(
+        [
+            es_valor_invalido(columna, tipo).sum().alias(columna)
+            for columna, tipo in columnas_enteras.items()
+        ]
+    ).row(0, named=True)
+
+    errores = {columna: n for columna, n in valores_invalidos.items() if n}
+    if errores:
+        detalle = ", ".join(
+            f"{columna} ({n} valores fuera de {columnas_enteras[columna]})"
+            for columna, n in errores.items()
         )
-        df_nacional = mappear_columnas(df_nacional, MAPPING_METRICAS_EGRESOS)
-        df_nacional = mappear_columnas(df_nacional, MAPPING_SOCIODEMOGRAFICO)
-        df_nacional = agregar_columnas_region_y_comuna(df_nacional)
-        df_nacional = agregar_categorizacion_edad(df_nacional)
-        df_nacional = formatear_fecha_nacimiento_y_egreso(df_nacional)
-        df_nacional = calcular_edades_por_fechas_de_nacimiento_y_egreso(df_nacional)
+        raise ValueError(f"Valores que no caben en el esquema compacto: {detalle}")
+
+
+@etapa_perfilada
+def compactar_esquema(df, esquema=None):
+    """
+    Downcast the code columns to the narrowest integer types and dictionary-encode the text
+    codes, following ESQUEMA_COMPACTO.
+
+    On an eager table the value ranges are validated first (see validar_rangos_esquema). On a
+    LazyFrame the same check is part of the plan: the values that are not integers or do not fit
+    in their type are replaced by VALOR_FUERA_DE_RANGO before the strict cast, so collecting
+    raises a ComputeError naming the column instead of truncating them.
+
+    :param df: The raw discharges table.
+    :type df: pl.DataFrame or pl.LazyFrame
+
+    :param esquema: The compact types. Defaults to ESQUEMA_COMPACTO.
+    :type esquema: dict, optional
 
-        return df_nacional
+    :return: The table with the compact types.
+    :rtype: pl.DataFrame or pl.LazyFrame
+    """
+    esquema = esquema or ESQUEMA_COMPACTO
+    es_lazy = isinstance(df, pl.LazyFrame)
+    if not es_lazy:
+        validar_rangos_esquema(df, esquema)
+
+    conversiones = []
+    for columna, tipo in esquema.items():
+        if columna not in df.columns:
+            continue
+
+        valor = pl.col(columna)
+        if es_lazy and tipo in pl.INTEGER_DTYPES:
+            valor = pl.when(~es_valor_invalido(columna, tipo)).then(valor).otherwise(
+                VALOR_FUERA_DE_RANGO
+            )
+        conversiones.append(valor.cast(tipo, strict=True).alias(columna))
+
+    return df.with_columns(conversiones)
+
+
+def reportar_ahorro_memoria(df_original, df_compacto):
+    """
+    Compare the memory used by every column before and after the downcast.
+
+    :param df_original: The table with the original types.
+    :type df_original: pl.DataFrame
+
+    :param df_compacto: The same table with the compact types.
+    :type df_compacto: pl.DataFrame
+
+    :return: A DataFrame with the original and compact type and size (MB) of every column,
+    sorted by the memory saved.
+    :rtype: pl.DataFrame
+    """
+    reporte = pl.DataFrame(
+        {
+            "columna": df_original.columns,
+            "tipo_original": [str(tipo) for tipo in df_original.dtypes],
+            "tipo_compacto": [str(df_compacto.schema[columna]) for columna in df_original.columns],
+            "mb_original": [
+                df_original.get_column(columna).estimated_size("mb")
+                for columna in df_original.columns
+            ],
+            "mb_compacto": [
+                df_compacto.get_column(columna).estimated_size("mb")
+                for columna in df_original.columns
+            ],
+        }
+    )
+
+    return reporte.with_columns(
+        (pl.col("mb_original") - pl.col("mb_compacto")).alias("mb_ahorrados")
+    ).sort("mb_ahorrados", descending=True)
+
+
+def registrar_ahorro_memoria(ruta_archivo):
+    """Registra en el log el ahorro de memoria del esquema compacto en una muestra del archivo"""
+    logger = logging.getLogger(__name__)
+    muestra, adaptador = leer_muestra_archivo(ruta_archivo)
+    muestra = adaptar_esquema(muestra, adaptador)
+    reporte = reportar_ahorro_memoria(muestra, compactar_esquema(muestra))
+
+    for fila in reporte.filter(pl.col("mb_ahorrados") != 0).iter_rows(named=True):
+        logger.info(
+            f"{Path(ruta_archivo).name} - {fila['columna']}: {fila['tipo_original']} -> "
+            f"{fila['tipo_compacto']}, {fila['mb_ahorrados']:.3f} MB ahorrados "
+            f"cada {len(muestra)} filas"
+        )
 
 
+@etapa_perfilada
 def mappear_columnas(df, dict_mapeo):
     """
     Map columns in the DataFrame based on a mapping dictionary.
@@ -131,6 +757,94 @@ def mappear_columnas(df, dict_mapeo):
     return tmp
 
 
+def mappear_serie(serie, dict_cambio, valores_texto):
+    """
+    Remap a Series with a join against a lookup table built from its distinct values, so the
+    mapping (and the conversion to text of unmapped values) is computed once per distinct value
+    and not once per row. Categorical columns are joined on their physical codes.
+
+    :param serie: The Series to remap.
+    :type serie: pl.Series
+
+    :param dict_cambio: The mapping of original value -> new value.
+    :type dict_cambio: dict
+
+    :param valores_texto: Whether the new values are text. In that case the result is a
+    categorical and unmapped values are kept as text.
+    :type valores_texto: bool
+
+    :return: The remapped Series.
+    :rtype: pl.Series
+    """
+    unicos = serie.unique()
+    llave_serie = serie
+    llaves = unicos.to_list()
+
+    if serie.dtype == pl.Categorical:
+        llave_serie = serie.to_physical()
+        llaves = unicos.cast(pl.Utf8).to_list()
+        unicos = unicos.to_physical()
+
+    valores = [dict_cambio.get(llave, llave) for llave in llaves]
+    if valores_texto:
+        valores = pl.Series([None if valor is None else str(valor) for valor in valores])
+        valores = valores.cast(pl.Categorical)
+    else:
+        valores = pl.Series(valores, dtype=serie.dtype)
+
+    tabla_mapeo = pl.DataFrame({"llave": unicos, "valor": valores})
+    mapeada = llave_serie.to_frame("llave").join(tabla_mapeo, on="llave", how="left")
+
+    return mapeada.get_column("valor").alias(serie.name)
+
+
+def compilar_expresiones_mapeo(*dicts_mapeo):
+    """
+    Compile one or more mapping dictionaries into one expression per variable. Variables mapped
+    to text (SEXO, PREVISION, PUEBLO_ORIGINARIO, etc.) are produced as categoricals.
+
+    :param dicts_mapeo: The mapping dictionaries (variable -> {original value: new value}).
+    :type dicts_mapeo: dict
+
+    :return: The list of remapping expressions.
+    :rtype: list
+    """
+    expresiones = []
+    for dict_mapeo in dicts_mapeo:
+        for variable, dict_cambio in dict_mapeo.items():
+            valores_texto = all(isinstance(valor, str) for valor in dict_cambio.values())
+            expresiones.append(
+                pl.col(variable).map_batches(
+                    lambda serie, dict_cambio=dict_cambio, valores_texto=valores_texto: (
+                        mappear_serie(serie, dict_cambio, valores_texto)
+                    ),
+                    return_dtype=pl.Categorical if valores_texto else None,
+                )
+            )
+
+    return expresiones
+
+
+@etapa_perfilada
+def mappear_columnas_vectorizado(df, *dicts_mapeo):
+    """
+    Map columns in the DataFrame based on one or more mapping dictionaries. All the variables
+    are remapped in a single projection, without copying the frame. Values without a mapping
+    keep their original value.
+
+    :param df: The input DataFrame.
+    :type df: pl.DataFrame or pl.LazyFrame
+
+    :param dicts_mapeo: The mapping dictionaries (ej: MAPPING_METRICAS_EGRESOS).
+    :type dicts_mapeo: dict
+
+    :return: The DataFrame with mapped columns.
+    :rtype: pl.DataFrame or pl.LazyFrame
+    """
+    return df.with_columns(compilar_expresiones_mapeo(*dicts_mapeo))
+
+
+@etapa_perfilada
 def agregar_columnas_region_y_comuna(df):
     """
     Add location-related columns to the DataFrame based on region and comuna information.
@@ -154,17 +868,50 @@ def agregar_columnas_region_y_comuna(df):
     return tmp
 
 
-def agregar_categorizacion_edad(df):
+@etapa_perfilada
+def obtener_esquemas_edad(esquemas_edad=None):
+    """Obtiene las definiciones de los esquemas de edad (nombre de columna -> esquema)"""
+    if esquemas_edad is None:
+        esquemas_edad = ESQUEMAS_EDAD_DEFECTO
+    if isinstance(esquemas_edad, dict):
+        return esquemas_edad
+
+    return {nombre: ESQUEMAS_EDAD[nombre] for nombre in convertir_a_lista(esquemas_edad)}
+
+
+def agregar_categorizacion_edad(df, esquemas_edad=None):
     """
-    Add age category column to the DataFrame based on age in years.
+    Add one age category column per age band scheme. All the schemes are evaluated in a single
+    projection, so adding a scheme does not add a pass over the data.
 
-    :param df: The input DataFrame.
+    A scheme is defined by the variable it bins, its limits and optionally its labels and
+    whether the intervals are closed on the left (see ESQUEMAS_EDAD).
+
+    :param df: The input DataFrame. The pediatric schemes need EDAD_CALCULADA_DIAS.
     :type df: pl.DataFrame
 
-    :return: The DataFrame with added age category column.
+    :param esquemas_edad: The names of schemes in ESQUEMAS_EDAD, or a dictionary of column
+    name -> scheme definition for custom schemes. Defaults to ESQUEMAS_EDAD_DEFECTO (the 10 year
+    bins of EDAD_CATEGORIA).
+    :type esquemas_edad: list or dict, optional
+
+    :return: The DataFrame with added age category columns.
     :rtype: pl.DataFrame
     """
-    tmp = df.with_columns(EDAD_CATEGORIA=pl.col("EDAD_A_OS").cut(range(0, 121, 10)))
+    esquemas_edad = obtener_esquemas_edad(esquemas_edad)
+
+    tmp = df.with_columns(
+        [
+            pl.col(esquema["variable"])
+            .cut(
+                esquema["limites"],
+                labels=esquema.get("etiquetas"),
+                left_closed=esquema.get("cerrado_izquierda", False),
+            )
+            .alias(nombre_columna)
+            for nombre_columna, esquema in esquemas_edad.items()
+        ]
+    )
 
     return tmp
 
@@ -192,66 +939,1258 @@ def calcular_edades_por_fechas_de_nacimiento_y_egreso(df):
     return tmp
 
 
-def filtrar_hospital_de_interes(df, codigo_hospital):
-    return df.filter(pl.col("ESTABLECIMIENTO_SALUD") == codigo_hospital)
+def parsear_fechas_categoricas(serie, formato=FORMATO_FECHA):
+    """
+    Parse a categorical column of date strings. Only the categories are parsed, once each, and
+    the dates are broadcast to the rows through the category codes.
 
+    :param serie: The categorical column of date strings.
+    :type serie: pl.Series
 
-def leer_deis_formato_nuevo(ruta_carpeta_contenedora):
-    with pl.StringCache():
-        df = pl.scan_csv(
-            f"{ruta_carpeta_contenedora}/*.csv",
-            separator=";",
-            dtypes=DICT_VARIABLES,
-            null_values=VALORES_NULOS,
+    :param formato: The format of the dates.
+    :type formato: str
+
+    :return: The parsed column.
+    :rtype: pl.Series
+    """
+    serie_local = serie.cat.to_local()
+    fechas_categorias = serie_local.cat.get_categories().str.strptime(
+        pl.Date, formato, strict=False
+    )
+
+    return fechas_categorias.take(serie_local.to_physical()).alias(serie.name)
+
+
+def obtener_expresion_fecha(columna, tipo, formato=FORMATO_FECHA):
+    """
+    Obtain the expression that parses a date column, with a fast path for each input type:
+
+    - Date: the column is kept as is.
+    - Categorical: only the distinct dates are parsed (see parsear_fechas_categoricas).
+    - Utf8: the native parser of Polars, which caches the distinct strings and has a fast path
+    for ISO dates. Parsing the distinct strings and joining them back is slower than this parser.
+
+    :param columna: The name of the date column.
+    :type columna: str
+
+    :param tipo: The type of the column.
+    :type tipo: pl.DataType
+
+    :param formato: The format of the dates.
+    :type formato: str
+
+    :return: The expression of the parsed column (Date).
+    :rtype: pl.Expr
+    """
+    if tipo == pl.Date:
+        return pl.col(columna)
+
+    if tipo == pl.Categorical:
+        return pl.col(columna).map_batches(
+            lambda serie: parsear_fechas_categoricas(serie, formato), return_dtype=pl.Date
         )
 
-    # Elimina la primera columna que no tiene nombre
-    df = df.drop(columns="")
+    return pl.col(columna).str.strptime(pl.Date, formato, strict=False)
 
-    # Cambia el nombre de la edad
-    df = df.rename({"EDAD_ANOS": "EDAD_A_OS"})
 
-    return df
+def convertir_fechas_a_enteros(serie):
+    """
+    Convert a Date column to integers AAAAMMDD (ej: 2019-03-01 -> 20190301). The year, month
+    and day are computed once for every day between the first and the last date of the column,
+    and broadcast to the rows by their offset from the first date, instead of decomposing the
+    calendar of every row.
 
+    :param serie: The Date column.
+    :type serie: pl.Series
 
-@click.command()
-@click.argument("input_filepath", type=click.Path(exists=True))
-@click.argument("output_filepath", type=click.Path())
-def main(input_filepath, output_filepath):
-    """Runs data processing scripts to turn raw data from (../raw) into
-    cleaned data ready to be analyzed (saved in ../processed).
+    :return: The dates as AAAAMMDD integers (Int32), null where the date is null.
+    :rtype: pl.Series
     """
-    logger = logging.getLogger(__name__)
-    logger.info("making final data set from raw data")
+    dias = serie.cast(pl.Int32)
+    primer_dia, ultimo_dia = dias.min(), dias.max()
+    if primer_dia is None:
+        return pl.Series(serie.name, [None] * len(serie), dtype=pl.Int32)
 
-    # # Lee el formato de las bases que tienen una columna mas
-    # ruta_nuevo_formato = f"{input_filepath}/formato_nuevo"
-    # output_nuevo_formato = f"{input_filepath}/Egresos_Hospitalarios_consolidados.csv"
-    # with pl.StringCache():
-    #     df_nuevo_formato = leer_deis_formato_nuevo(ruta_nuevo_formato).collect()
+    calendario = pl.int_range(primer_dia, ultimo_dia + 1, dtype=pl.Int32, eager=True).cast(pl.Date)
+    calendario_enteros = (
+        calendario.dt.year().cast(pl.Int32) * 10_000
+        + calendario.dt.month().cast(pl.Int32) * 100
+        + calendario.dt.day().cast(pl.Int32)
+    )
 
-    # df_nuevo_formato.write_csv(output_nuevo_formato, separator=";")
+    return calendario_enteros.take(dias - primer_dia).alias(serie.name)
 
-    with pl.StringCache():
-        # Lee y procesa base de DEIS y filtra la base del Torax
-        df_nacional = leer_egresos_deis(input_filepath).collect()
-        df_hospital_de_interes = filtrar_hospital_de_interes(df_nacional, CODIGO_TORAX)
-        df_roberto = filtrar_hospital_de_interes(df_nacional, 109101)
 
-        # Define la ruta a guardar ambas bases de datos
-        ruta_egresos_nacionales = f"{output_filepath}/egresos_procesados.csv"
-        ruta_egresos_hospital = f"{output_filepath}/egresos_procesados_{CODIGO_TORAX}.csv"
-        ruta_egresos_roberto = f"{output_filepath}/egresos_procesados_109101.csv"
+@etapa_perfilada
+def normalizar_fechas_egresos(df, formato=FORMATO_FECHA):
+    """
+    Parse the birth and discharge dates (see obtener_expresion_fecha) and derive the ages in a
+    single pass. Strings that do not match the format become null instead of raising. The
+    derived columns are:
 
-        # Exporta bases de datos
-        print(f"> Guardando {ruta_egresos_nacionales}")
-        df_nacional.write_csv(ruta_egresos_nacionales)
+    - EDAD_CALCULADA_DIAS and EDAD_CALCULADA_ANO, as in
+    calcular_edades_por_fechas_de_nacimiento_y_egreso.
+    - EDAD_ANOS_CUMPLIDOS: the age in completed calendar years (Int16), without the 365.25
+    approximation (it only increases on the birthday).
+    - FECHA_INVALIDA: True if a date does not parse, the birth is after the discharge, the age is
+    over EDAD_MAXIMA_VALIDA or the discharge date is not in ANO_EGRESO.
+
+    :param df: The discharges table, with the dates as strings.
+    :type df: pl.DataFrame or pl.LazyFrame
 
-        print(f"> Guardando {ruta_egresos_hospital}")
-        df_hospital_de_interes.write_csv(ruta_egresos_hospital)
+    :param formato: The format of the dates.
+    :type formato: str
+
+    :return: The table with the parsed dates, the ages and the invalid date flag.
+    :rtype: pl.DataFrame or pl.LazyFrame
+    """
+    tmp = df.with_columns(
+        [
+            obtener_expresion_fecha(columna, df.schema[columna], formato).alias(f"__{columna}")
+            for columna in COLUMNAS_FECHA
+        ]
+    )
+
+    # Los dias se restan sobre la representacion entera de las fechas (dias desde 1970), y los
+    # anios cumplidos salen de las fechas como enteros AAAAMMDD: (AAAAMMDD - AAAAMMDD) // 10000
+    nacimiento = pl.col("__FECHA_NACIMIENTO")
+    egreso = pl.col("__FECHA_EGRESO")
+    tmp = tmp.with_columns(
+        [(egreso.cast(pl.Int32) - nacimiento.cast(pl.Int32)).alias("__dias")]
+        + [
+            pl.col(f"__{columna}")
+            .map_batches(convertir_fechas_a_enteros, return_dtype=pl.Int32)
+            .alias(f"__entero_{columna}")
+            for columna in COLUMNAS_FECHA
+        ]
+    )
+
+    tmp = tmp.with_columns(
+        [
+            pl.col("__dias").cast(pl.Int64).alias("EDAD_CALCULADA_DIAS"),
+            (pl.col("__dias") / 365.25).alias("EDAD_CALCULADA_ANO"),
+            (
+                (pl.col("__entero_FECHA_EGRESO") - pl.col("__entero_FECHA_NACIMIENTO")) // 10_000
+            )
+            .cast(pl.Int16)
+            .alias("EDAD_ANOS_CUMPLIDOS"),
+        ]
+    )
+
+    fecha_no_parseada = [
+        pl.col(columna).is_not_null() & pl.col(f"__{columna}").is_null()
+        for columna in COLUMNAS_FECHA
+    ]
+    fecha_imposible = [
+        pl.col("__dias") < 0,
+        pl.col("EDAD_ANOS_CUMPLIDOS") > EDAD_MAXIMA_VALIDA,
+        pl.col("__entero_FECHA_EGRESO") // 10_000 != pl.col("ANO_EGRESO"),
+    ]
+    tmp = tmp.with_columns(
+        [
+            pl.any_horizontal(fecha_no_parseada + fecha_imposible)
+            .fill_null(False)
+            .alias("FECHA_INVALIDA"),
+            nacimiento.alias("FECHA_NACIMIENTO"),
+            egreso.alias("FECHA_EGRESO"),
+        ]
+    )
+
+    columnas_temporales = ["__dias"] + [
+        f"__{prefijo}{columna}" for prefijo in ["", "entero_"] for columna in COLUMNAS_FECHA
+    ]
+
+    return tmp.drop(columnas_temporales)
+
+
+def filtrar_hospital_de_interes(df, codigo_hospital):
+    return df.filter(pl.col("ESTABLECIMIENTO_SALUD") == codigo_hospital)
+
+
+def convertir_a_lista(valor):
+    """Convierte un valor escalar o iterable (ej: lista, tupla o pl.Series) en una lista"""
+    if isinstance(valor, (str, bytes)) or not isinstance(valor, Iterable):
+        return [valor]
+
+    return list(valor)
+
+
+def formatear_valor_particion(valor):
+    """Formatea el valor de una particion (los codigos se leen como float, ej: 112103.0)"""
+    if valor is None:
+        return "nulo"
+
+    if isinstance(valor, float) and valor.is_integer():
+        return str(int(valor))
+
+    return str(valor)
+
+
+def escribir_parquet_particionado(df, ruta_salida, nombre_archivo, escritores, particiones=None):
+    """
+    Append a DataFrame to a zstd-compressed Parquet dataset partitioned in Hive style
+    (ej: ANO_EGRESO=2019/nombre_archivo.parquet).
+
+    The rows of every partition are sorted by COLUMNAS_ORDEN_PARTICION and written in row groups
+    of FILAS_POR_GRUPO_PARTICION rows with min/max statistics, so reading a single hospital skips
+    the row groups that cannot contain it. escritores keeps one open pq.ParquetWriter per file, so
+    all the batches of a raw file are appended to a single file per partition; the caller must
+    close them. Every file keeps all the columns, so the typed schema, categoricals and dates are
+    preserved and any single partition can be read on its own.
+
+    :param df: The DataFrame (or batch) to write.
+    :type df: pl.DataFrame
+
+    :param ruta_salida: The base directory of the partitioned dataset.
+    :type ruta_salida: str
+
+    :param nombre_archivo: The file name (without extension) used inside each partition.
+    :type nombre_archivo: str
+
+    :param escritores: Dictionary with the open writers, by path of the file. The writers of new
+    partitions are added to it.
+    :type escritores: dict
+
+    :param particiones: The columns to partition by. Defaults to COLUMNAS_PARTICION.
+    :type particiones: list, optional
+
+    :return: The paths of the files written by this call.
+    :rtype: list
+    """
+    particiones = particiones or COLUMNAS_PARTICION
+    rutas_escritas = []
+
+    for valores, df_particion in df.partition_by(particiones, as_dict=True).items():
+        valores = valores if isinstance(valores, tuple) else (valores,)
+        carpeta = Path(ruta_salida).joinpath(
+            *[
+                f"{columna}={formatear_valor_particion(valor)}"
+                for columna, valor in zip(particiones, valores)
+            ]
+        )
+        ruta_archivo = str(carpeta / f"{nombre_archivo}.parquet")
+
+        tabla = df_particion.sort(COLUMNAS_ORDEN_PARTICION).to_arrow()
+        if ruta_archivo not in escritores:
+            carpeta.mkdir(parents=True, exist_ok=True)
+            # El escritor nativo de polars no guarda el minimo y maximo de cada grupo, pyarrow si
+            escritores[ruta_archivo] = pq.ParquetWriter(
+                ruta_archivo, tabla.schema, compression="zstd", write_statistics=True
+            )
+
+        escritor = escritores[ruta_archivo]
+        escritor.write_table(tabla.cast(escritor.schema), row_group_size=FILAS_POR_GRUPO_PARTICION)
+        rutas_escritas.append(ruta_archivo)
+
+    return rutas_escritas
+
+
+def leer_egresos_parquet(ruta_dataset, hospitales=None, anios=None):
+    """
+    Lazily read the partitioned Parquet dataset, optionally restricted to some hospitals
+    and/or years. The years are resolved from the directory layout, so only the files of the
+    requested partitions are scanned; the hospitals are filtered on the rows, a filter that is
+    pushed down to the row group statistics of the files (sorted by hospital).
+
+    Since every file has its own categorical dictionary, the result must be collected inside
+    a pl.StringCache() context.
+
+    :param ruta_dataset: The base directory of the partitioned dataset.
+    :type ruta_dataset: str
+
+    :param hospitales: The hospital codes to read. Defaults to all hospitals.
+    :type hospitales: int or list, optional
+
+    :param anios: The discharge years to read. Defaults to all years.
+    :type anios: int or list, optional
+
+    :return: The LazyFrame with the requested rows.
+    :rtype: pl.LazyFrame
+    """
+    anios = ["*"] if anios is None else convertir_a_lista(anios)
+
+    patrones = [
+        f"{ruta_dataset}/ANO_EGRESO={formatear_valor_particion(anio)}/*.parquet" for anio in anios
+    ]
+    patrones = [patron for patron in patrones if glob.glob(patron)]
+    if not patrones:
+        raise FileNotFoundError(f"No hay particiones que coincidan en {ruta_dataset}")
+
+    df = pl.concat([pl.scan_parquet(patron) for patron in patrones])
+    if hospitales is not None:
+        df = df.filter(pl.col("ESTABLECIMIENTO_SALUD").is_in(convertir_a_lista(hospitales)))
+
+    return df
+
+
+def escribir_parquet_ordenado(df, ruta_archivo, filas_por_grupo=FILAS_POR_GRUPO_ORDENADO):
+    """
+    Write a DataFrame as a single Parquet file sorted by COLUMNAS_ORDEN_PARQUET, with row groups
+    of filas_por_grupo rows and min/max statistics, so filters on the hospital (and on the year or
+    diagnosis within it) can skip most of the row groups. A sidecar JSON index with the row
+    groups of every hospital is written next to the file (see escribir_indice_parquet).
+
+    :param df: The DataFrame to write.
+    :type df: pl.DataFrame
+
+    :param ruta_archivo: The path of the Parquet file.
+    :type ruta_archivo: str or Path
+
+    :param filas_por_grupo: The number of rows of each row group.
+    :type filas_por_grupo: int
+
+    :return: The path of the written file.
+    :rtype: str
+    """
+    ruta_archivo = Path(ruta_archivo)
+    ruta_archivo.parent.mkdir(parents=True, exist_ok=True)
+
+    # Los codigos numericos se ordenan como numeros; los diagnosticos categoricos por su texto,
+    # no por el orden de llegada del categorico
+    orden = [
+        pl.col(columna).cast(pl.Utf8) if df.schema[columna] == pl.Categorical else pl.col(columna)
+        for columna in COLUMNAS_ORDEN_PARQUET
+    ]
+    df_ordenado = df.sort(orden)
+    # El escritor nativo de polars no guarda el minimo y maximo de cada grupo, pyarrow si
+    df_ordenado.write_parquet(
+        ruta_archivo,
+        compression="zstd",
+        statistics=True,
+        row_group_size=filas_por_grupo,
+        use_pyarrow=True,
+    )
+    escribir_indice_parquet(ruta_archivo, df_ordenado)
+
+    return str(ruta_archivo)
+
+
+def escribir_indice_parquet(ruta_archivo, df_ordenado):
+    """
+    Write the sidecar index of a sorted Parquet file: the rows and min/max statistics of every
+    row group, and the range of row groups of every hospital.
+
+    :param ruta_archivo: The path of the sorted Parquet file.
+    :type ruta_archivo: str or Path
+
+    :param df_ordenado: The sorted DataFrame written to the file.
+    :type df_ordenado: pl.DataFrame
+
+    :return: The index.
+    :rtype: dict
+    """
+    metadatos = pq.ParquetFile(ruta_archivo).metadata
+    columnas = {metadatos.schema.column(i).name: i for i in range(metadatos.num_columns)}
+
+    grupos = []
+    for numero_grupo in range(metadatos.num_row_groups):
+        grupo = metadatos.row_group(numero_grupo)
+        estadisticas = {
+            columna: [
+                grupo.column(columnas[columna]).statistics.min,
+                grupo.column(columnas[columna]).statistics.max,
+            ]
+            for columna in ["ESTABLECIMIENTO_SALUD", "ANO_EGRESO"]
+        }
+        grupos.append({"filas": grupo.num_rows, **estadisticas})
+
+    # Fila en que termina cada grupo, para ubicar las filas de cada hospital
+    filas_finales = list(accumulate(grupo["filas"] for grupo in grupos))
+    filas_hospitales = (
+        df_ordenado.with_row_count("fila")
+        .groupby("ESTABLECIMIENTO_SALUD")
+        .agg(pl.col("fila").min().alias("primera"), pl.col("fila").max().alias("ultima"))
+    )
+    establecimientos = {
+        str(int(codigo)): [
+            bisect_right(filas_finales, primera),
+            bisect_right(filas_finales, ultima),
+        ]
+        for codigo, primera, ultima in filas_hospitales.drop_nulls().iter_rows()
+    }
+
+    indice = {
+        "columnas_orden": COLUMNAS_ORDEN_PARQUET,
+        "grupos": grupos,
+        "establecimientos": establecimientos,
+    }
+    ruta_indice = Path(f"{ruta_archivo}{SUFIJO_INDICE}")
+    ruta_indice.write_text(json.dumps(indice, indent=2), encoding="utf-8")
+
+    return indice
+
+
+def obtener_grupos_hospitales(indice, hospitales):
+    """
+    Obtain the row groups of a sorted Parquet file that contain the given hospitals.
+
+    :param indice: The sidecar index of the file (see escribir_indice_parquet).
+    :type indice: dict
+
+    :param hospitales: The hospital codes.
+    :type hospitales: list
+
+    :return: The sorted numbers of the row groups.
+    :rtype: list
+    """
+    grupos = set()
+    for hospital in hospitales:
+        rango = indice["establecimientos"].get(str(int(hospital)))
+        if rango:
+            grupos.update(range(rango[0], rango[1] + 1))
+
+    return sorted(grupos)
+
+
+@etapa_perfilada
+def exportar_egresos_ordenados(
+    ruta_carpeta_contenedora, ruta_salida, esquema_compacto=False, esquemas_edad=None
+):
+    """
+    Process every raw DEIS file of the input directory and write it as a sorted Parquet file
+    with its sidecar index (see escribir_parquet_ordenado). Files are processed one at a time.
+
+    :param ruta_carpeta_contenedora: The directory with the raw DEIS CSV files.
+    :type ruta_carpeta_contenedora: str
+
+    :param ruta_salida: The directory of the sorted files.
+    :type ruta_salida: str
+
+    :param esquema_compacto: If True, the columns are downcast to ESQUEMA_COMPACTO.
+    :type esquema_compacto: bool, optional
+
+    :param esquemas_edad: The age band schemes to add. Defaults to ESQUEMAS_EDAD_DEFECTO.
+    :type esquemas_edad: list or dict, optional
+
+    :return: The paths of the written files.
+    :rtype: list
+    """
+    rutas_escritas = []
+
+    with pl.StringCache():
+        for ruta_archivo in sorted(glob.glob(f"{ruta_carpeta_contenedora}/*.csv")):
+            print(f"> Ordenando {ruta_archivo}")
+            df_archivo = leer_archivos_egresos_deis(
+                ruta_archivo, esquema_compacto, esquemas_edad
+            ).collect()
+            ruta_ordenada = f"{ruta_salida}/{Path(ruta_archivo).stem}.parquet"
+            rutas_escritas.append(escribir_parquet_ordenado(df_archivo, ruta_ordenada))
+
+    return rutas_escritas
+
+
+def leer_egresos_ordenados(ruta_carpeta, hospitales=None, anios=None):
+    """
+    Lazily read the sorted Parquet files. When hospitals are given, only the row groups that can
+    contain them (according to the sidecar index) are read; the year filter is pushed down to the
+    row group statistics.
+
+    As with leer_egresos_parquet, the result must be collected inside a pl.StringCache() context.
+
+    :param ruta_carpeta: The directory of the sorted files.
+    :type ruta_carpeta: str
+
+    :param hospitales: The hospital codes to read. Defaults to all hospitals.
+    :type hospitales: int or list, optional
+
+    :param anios: The discharge years to read. Defaults to all years.
+    :type anios: int or list, optional
+
+    :return: The LazyFrame with the requested rows.
+    :rtype: pl.LazyFrame
+    """
+    rutas_archivos = sorted(glob.glob(f"{ruta_carpeta}/*.parquet"))
+    if not rutas_archivos:
+        raise FileNotFoundError(f"No hay archivos ordenados en {ruta_carpeta}")
+
+    escaneos = []
+    for ruta_archivo in rutas_archivos:
+        if hospitales is None:
+            escaneos.append(pl.scan_parquet(ruta_archivo))
+            continue
+
+        hospitales = convertir_a_lista(hospitales)
+        indice = json.loads(Path(f"{ruta_archivo}{SUFIJO_INDICE}").read_text(encoding="utf-8"))
+        grupos = obtener_grupos_hospitales(indice, hospitales)
+        if grupos:
+            tabla = pq.ParquetFile(ruta_archivo).read_row_groups(grupos)
+            escaneos.append(
+                pl.from_arrow(tabla)
+                .lazy()
+                .filter(pl.col("ESTABLECIMIENTO_SALUD").is_in(hospitales))
+            )
+
+    if not escaneos:
+        raise FileNotFoundError(f"Los hospitales {hospitales} no estan en {ruta_carpeta}")
+
+    df = pl.concat(escaneos, how="diagonal")
+    if anios is not None:
+        df = df.filter(pl.col("ANO_EGRESO").is_in(convertir_a_lista(anios)))
+
+    return df
+
+
+def calcular_filas_por_lote(
+    muestra, limite_memoria_mb, esquema_compacto=False, esquemas_edad=None
+):
+    """
+    Estimate how many rows can be processed per batch without exceeding the memory ceiling.
+    The ceiling applies to the RSS of the whole process, so the batches get only the memory that
+    the process is not already using. The size of a processed row is measured on a sample of the
+    file and inflated by FACTOR_SEGURIDAD_MEMORIA to account for parsing buffers and
+    intermediate copies. If the process already uses the whole ceiling, the batches have
+    FILAS_MUESTRA_LOTE rows.
+
+    :param muestra: The first rows of the raw DEIS file.
+    :type muestra: pl.DataFrame
+
+    :param limite_memoria_mb: The memory ceiling in MB.
+    :type limite_memoria_mb: float
+
+    :param esquema_compacto: If True, the columns are downcast to ESQUEMA_COMPACTO.
+    :type esquema_compacto: bool, optional
+
+    :param esquemas_edad: The age band schemes to add. Defaults to ESQUEMAS_EDAD_DEFECTO.
+    :type esquemas_edad: list or dict, optional
+
+    :return: The number of rows per batch.
+    :rtype: int
+    """
+    muestra = transformar_egresos_deis(muestra, esquema_compacto, esquemas_edad)
+    bytes_por_fila = muestra.estimated_size() / max(len(muestra), 1)
+
+    memoria_disponible_mb = limite_memoria_mb - medir_rss_mb()
+    if memoria_disponible_mb <= 0:
+        logging.getLogger(__name__).warning(
+            f"El proceso ya usa mas de {limite_memoria_mb} MB, se procesan lotes de "
+            f"{FILAS_MUESTRA_LOTE} filas"
+        )
+        return FILAS_MUESTRA_LOTE
+
+    return max(
+        int(memoria_disponible_mb * 1024**2 / (bytes_por_fila * FACTOR_SEGURIDAD_MEMORIA)), 1
+    )
+
+
+def iterar_lotes_egresos(
+    ruta_carpeta_contenedora,
+    limite_memoria_mb,
+    picos_por_etapa,
+    esquema_compacto=False,
+    esquemas_edad=None,
+):
+    """
+    Read and process the raw DEIS files in batches sized to respect the memory ceiling. Only
+    one batch is held in memory at a time.
+
+    :param ruta_carpeta_contenedora: The directory with the raw DEIS CSV files.
+    :type ruta_carpeta_contenedora: str
+
+    :param limite_memoria_mb: The memory ceiling in MB.
+    :type limite_memoria_mb: float
+
+    :param picos_por_etapa: Dictionary where the peak RSS of each stage is accumulated.
+    :type picos_por_etapa: dict
+
+    :param esquema_compacto: If True, the columns are downcast to ESQUEMA_COMPACTO.
+    :type esquema_compacto: bool, optional
+
+    :param esquemas_edad: The age band schemes to add. Defaults to ESQUEMAS_EDAD_DEFECTO.
+    :type esquemas_edad: list or dict, optional
+
+    :return: Yields the name of the source file, the batch number and the processed batch.
+    :rtype: Iterator[tuple[str, int, pl.DataFrame]]
+    """
+    for ruta_archivo in sorted(glob.glob(f"{ruta_carpeta_contenedora}/*.csv")):
+        for numero_lote, df_lote in iterar_lotes_archivo(
+            ruta_archivo, limite_memoria_mb, picos_por_etapa, esquema_compacto, esquemas_edad
+        ):
+            yield Path(ruta_archivo).stem, numero_lote, df_lote
+
+
+def iterar_lotes_archivo(
+    ruta_archivo, limite_memoria_mb, picos_por_etapa, esquema_compacto=False, esquemas_edad=None
+):
+    """
+    Read and process a single raw DEIS file in batches sized to respect the memory ceiling. With
+    esquema_compacto, the memory saved on a sample of the file is logged (see
+    registrar_ahorro_memoria).
+
+    :param ruta_archivo: The raw DEIS file.
+    :type ruta_archivo: str
+
+    :param limite_memoria_mb: The memory ceiling in MB.
+    :type limite_memoria_mb: float
+
+    :param picos_por_etapa: Dictionary where the peak RSS of each stage is accumulated.
+    :type picos_por_etapa: dict
+
+    :param esquema_compacto: If True, the columns are downcast to ESQUEMA_COMPACTO.
+    :type esquema_compacto: bool, optional
+
+    :param esquemas_edad: The age band schemes to add. Defaults to ESQUEMAS_EDAD_DEFECTO.
+    :type esquemas_edad: list or dict, optional
+
+    :return: Yields the batch number and the processed batch.
+    :rtype: Iterator[tuple[int, pl.DataFrame]]
+    """
+    if esquema_compacto:
+        registrar_ahorro_memoria(ruta_archivo)
+
+    muestra, adaptador = leer_muestra_archivo(ruta_archivo)
+    filas_por_lote = calcular_filas_por_lote(
+        adaptar_esquema(muestra, adaptador), limite_memoria_mb, esquema_compacto, esquemas_edad
+    )
+    print(f"> Procesando {ruta_archivo} en lotes de {filas_por_lote} filas")
+
+    # El lector por lotes necesita el esquema completo del archivo, no solo DICT_VARIABLES
+    lector = pl.read_csv_batched(
+        ruta_archivo,
+        separator=";",
+        dtypes=muestra.schema,
+        null_values=VALORES_NULOS,
+        batch_size=filas_por_lote,
+    )
+
+    numero_lote = 0
+    while True:
+        with medir_memoria_etapa("lectura", picos_por_etapa):
+            lotes = lector.next_batches(1)
+        if not lotes:
+            break
+
+        with medir_memoria_etapa("transformacion", picos_por_etapa):
+            df_lote = transformar_egresos_deis(
+                adaptar_esquema(lotes[0], adaptador), esquema_compacto, esquemas_edad
+            )
+        del lotes
+
+        yield numero_lote, df_lote
+        numero_lote += 1
+
+
+def calcular_hash_archivo(ruta_archivo):
+    """Calcula el hash SHA-256 del contenido de un archivo, leyendolo por bloques"""
+    hash_archivo = hashlib.sha256()
+    with open(ruta_archivo, "rb") as archivo:
+        for bloque in iter(lambda: archivo.read(TAMANO_BLOQUE_HASH), b""):
+            hash_archivo.update(bloque)
+
+    return hash_archivo.hexdigest()
+
+
+def leer_manifiesto(ruta_dataset):
+    """
+    Read the manifest of already-processed raw files of a Parquet dataset. Each entry is keyed
+    by the raw file name and stores its content hash, the schema version it was processed with,
+    the discharge years it contains and the files it produced (relative to ruta_dataset).
+
+    :param ruta_dataset: The base directory of the partitioned dataset.
+    :type ruta_dataset: str
+
+    :return: The manifest. It is empty if the dataset has not been processed yet.
+    :rtype: dict
+    """
+    ruta_manifiesto = Path(ruta_dataset) / ARCHIVO_MANIFIESTO
+    if not ruta_manifiesto.exists():
+        return {"archivos": {}}
+
+    with open(ruta_manifiesto, encoding="utf-8") as archivo:
+        return json.load(archivo)
+
+
+def guardar_manifiesto(ruta_dataset, manifiesto):
+    """Guarda el manifiesto del dataset (se escribe en un temporal y luego se reemplaza)"""
+    ruta_manifiesto = Path(ruta_dataset) / ARCHIVO_MANIFIESTO
+    ruta_manifiesto.parent.mkdir(parents=True, exist_ok=True)
+
+    ruta_temporal = ruta_manifiesto.with_suffix(".tmp")
+    with open(ruta_temporal, "w", encoding="utf-8") as archivo:
+        json.dump(manifiesto, archivo, indent=2, ensure_ascii=False)
+    ruta_temporal.replace(ruta_manifiesto)
+
+
+def eliminar_salidas(ruta_dataset, salidas):
+    """Elimina los archivos producidos por un archivo crudo y las particiones que queden vacias"""
+    for salida in salidas:
+        ruta = Path(ruta_dataset) / salida
+        ruta.unlink(missing_ok=True)
+
+        for carpeta in ruta.parents:
+            if carpeta == Path(ruta_dataset) or any(carpeta.iterdir()):
+                break
+            carpeta.rmdir()
+
+
+def exportar_archivo_parquet(
+    ruta_archivo,
+    ruta_dataset,
+    limite_memoria_mb=None,
+    picos_por_etapa=None,
+    esquema_compacto=False,
+    esquemas_edad=None,
+):
+    """
+    Process a single raw DEIS file and write it to the partitioned Parquet dataset, as one file
+    per year partition (also when it is processed in batches, which are appended to it).
+
+    :param ruta_archivo: The raw DEIS file.
+    :type ruta_archivo: str
+
+    :param ruta_dataset: The base directory of the partitioned dataset.
+    :type ruta_dataset: str
+
+    :param limite_memoria_mb: If given, the file is processed in batches that respect this
+    memory ceiling. Otherwise, the whole file is processed at once.
+    :type limite_memoria_mb: float, optional
+
+    :param picos_por_etapa: Dictionary where the peak RSS of each stage is accumulated when
+    processing in batches.
+    :type picos_por_etapa: dict, optional
+
+    :param esquema_compacto: If True, the columns are downcast to ESQUEMA_COMPACTO.
+    :type esquema_compacto: bool, optional
+
+    :param esquemas_edad: The age band schemes to add. Defaults to ESQUEMAS_EDAD_DEFECTO.
+    :type esquemas_edad: list or dict, optional
+
+    :return: The written paths and the discharge years found in the file.
+    :rtype: tuple[list, list]
+    """
+    nombre_archivo = Path(ruta_archivo).stem
+    picos_por_etapa = {} if picos_por_etapa is None else picos_por_etapa
+    anios = set()
+
+    if limite_memoria_mb is None:
+        print(f"> Procesando {ruta_archivo}")
+        df_archivo = leer_archivos_egresos_deis(
+            ruta_archivo, esquema_compacto, esquemas_edad
+        ).collect()
+        lotes = [(None, df_archivo)]
+    else:
+        lotes = iterar_lotes_archivo(
+            ruta_archivo, limite_memoria_mb, picos_por_etapa, esquema_compacto, esquemas_edad
+        )
+
+    # Los lotes de un archivo se agregan al mismo archivo de cada particion
+    escritores = {}
+    try:
+        for _, df_lote in lotes:
+            with medir_memoria_etapa("escritura", picos_por_etapa):
+                escribir_parquet_particionado(df_lote, ruta_dataset, nombre_archivo, escritores)
+            anios.update(df_lote.get_column("ANO_EGRESO").drop_nulls().unique().to_list())
+    finally:
+        for escritor in escritores.values():
+            escritor.close()
+
+    return list(escritores), sorted(int(anio) for anio in anios)
+
+
+@etapa_perfilada
+def exportar_egresos_parquet_incremental(
+    ruta_carpeta_contenedora,
+    ruta_dataset,
+    limite_memoria_mb=None,
+    reconstruir=False,
+    esquema_compacto=False,
+    esquemas_edad=None,
+):
+    """
+    Incrementally update the partitioned Parquet dataset. Only the raw files that are new, whose
+    content changed or that were processed with another VERSION_ESQUEMA are processed; the
+    partitions produced by changed or deleted raw files are removed before writing again.
+
+    :param ruta_carpeta_contenedora: The directory with the raw DEIS CSV files.
+    :type ruta_carpeta_contenedora: str
+
+    :param ruta_dataset: The base directory of the partitioned dataset.
+    :type ruta_dataset: str
+
+    :param limite_memoria_mb: If given, each file is processed in batches that respect this
+    memory ceiling.
+    :type limite_memoria_mb: float, optional
+
+    :param reconstruir: If True, the whole dataset is rebuilt ignoring the manifest.
+    :type reconstruir: bool, optional
+
+    :param esquema_compacto: If True, the columns are downcast to ESQUEMA_COMPACTO. Files
+    processed with the other mode are processed again.
+    :type esquema_compacto: bool, optional
+
+    :param esquemas_edad: The age band schemes to add. Defaults to ESQUEMAS_EDAD_DEFECTO. Files
+    processed with other schemes are processed again.
+    :type esquemas_edad: list or dict, optional
+
+    :return: The processed raw files and the discharge years whose partitions changed.
+    :rtype: dict
+    """
+    logger = logging.getLogger(__name__)
+    manifiesto = leer_manifiesto(ruta_dataset)
+    entradas = manifiesto["archivos"]
+
+    # Las definiciones de los esquemas de edad se comparan como quedan guardadas en el JSON. Las
+    # entradas sin esquemas de edad se procesaron con los esquemas por defecto
+    definiciones_edad = json.loads(json.dumps(obtener_esquemas_edad(esquemas_edad)))
+    definiciones_edad_defecto = json.loads(json.dumps(obtener_esquemas_edad()))
+    archivos_crudos = {
+        Path(ruta).name: ruta for ruta in sorted(glob.glob(f"{ruta_carpeta_contenedora}/*.csv"))
+    }
+
+    archivos_procesados = []
+    anios_modificados = set()
+    picos_por_etapa = {}
+
+    # Elimina las salidas de los archivos crudos que ya no existen
+    for nombre_archivo in [nombre for nombre in entradas if nombre not in archivos_crudos]:
+        logger.info(f"{nombre_archivo} ya no existe, eliminando sus particiones")
+        eliminar_salidas(ruta_dataset, entradas[nombre_archivo]["salidas"])
+        anios_modificados.update(entradas.pop(nombre_archivo)["anios"])
+        guardar_manifiesto(ruta_dataset, manifiesto)
+
+    with pl.StringCache():
+        for nombre_archivo, ruta_archivo in archivos_crudos.items():
+            hash_archivo = calcular_hash_archivo(ruta_archivo)
+            entrada = entradas.get(nombre_archivo)
+
+            if (
+                not reconstruir
+                and entrada is not None
+                and entrada["hash"] == hash_archivo
+                and entrada["version_esquema"] == VERSION_ESQUEMA
+                and entrada.get("esquema_compacto", False) == esquema_compacto
+                and entrada.get("esquemas_edad", definiciones_edad_defecto) == definiciones_edad
+            ):
+                logger.info(f"{nombre_archivo} sin cambios, se omite")
+                continue
+
+            if entrada is not None:
+                eliminar_salidas(ruta_dataset, entrada["salidas"])
+                anios_modificados.update(entrada["anios"])
+
+            rutas_escritas, anios = exportar_archivo_parquet(
+                ruta_archivo,
+                ruta_dataset,
+                limite_memoria_mb,
+                picos_por_etapa,
+                esquema_compacto,
+                esquemas_edad,
+            )
+            entradas[nombre_archivo] = {
+                "hash": hash_archivo,
+                "version_esquema": VERSION_ESQUEMA,
+                "esquema_compacto": esquema_compacto,
+                "esquemas_edad": definiciones_edad,
+                "anios": anios,
+                "salidas": [str(Path(ruta).relative_to(ruta_dataset)) for ruta in rutas_escritas],
+            }
+
+            # Se guarda despues de cada archivo, para no perder el avance si se interrumpe
+            guardar_manifiesto(ruta_dataset, manifiesto)
+            archivos_procesados.append(nombre_archivo)
+            anios_modificados.update(anios)
+
+    for etapa, pico_mb in picos_por_etapa.items():
+        logger.info(f"Pico de RSS en la etapa {etapa}: {pico_mb:.1f} MB")
+        if limite_memoria_mb is not None and pico_mb > limite_memoria_mb:
+            logger.warning(f"La etapa {etapa} supero el limite de {limite_memoria_mb} MB")
+
+    return {
+        "archivos_procesados": archivos_procesados,
+        "anios_modificados": sorted(anios_modificados),
+    }
+
+
+def leer_codigos_hospitales(hospitales=None, archivo_hospitales=None):
+    """
+    Build the list of hospital codes to extract from a comma separated string and/or a text
+    file with one code per line (empty lines and lines starting with # are ignored).
+
+    :param hospitales: Comma separated hospital codes (ej: "112103,109101").
+    :type hospitales: str, optional
+
+    :param archivo_hospitales: Path of a file with one hospital code per line.
+    :type archivo_hospitales: str, optional
+
+    :return: The unique hospital codes, in order of appearance. Defaults to HOSPITALES_EXTRACTOS.
+    :rtype: list
+    """
+    codigos = []
+    if hospitales:
+        codigos += [codigo.strip() for codigo in hospitales.split(",")]
+
+    if archivo_hospitales:
+        with open(archivo_hospitales, encoding="utf-8") as archivo:
+            codigos += [linea.strip() for linea in archivo if not linea.startswith("#")]
+
+    codigos = [int(codigo) for codigo in codigos if codigo]
+
+    return list(dict.fromkeys(codigos)) or HOSPITALES_EXTRACTOS
+
+
+@etapa_perfilada
+def escribir_extractos_hospitales(df, codigos_hospitales, archivos_abiertos, output_filepath):
+    """
+    Route the rows of a table to the CSV extract of their hospital. The rows of all the
+    requested hospitals are selected with a single filter and split with a single
+    partition_by, so the cost does not grow with the number of hospitals.
+
+    The files are opened (and their header written) the first time a hospital has rows, and
+    are kept in archivos_abiertos so the following batches append to them.
+
+    :param df: The processed discharges (a batch or the whole table).
+    :type df: pl.DataFrame
+
+    :param codigos_hospitales: The hospitals to extract.
+    :type codigos_hospitales: list
+
+    :param archivos_abiertos: Dictionary of hospital code -> open file. It is updated in place.
+    :type archivos_abiertos: dict
+
+    :param output_filepath: The output directory.
+    :type output_filepath: str
+    """
+    df_hospitales = df.filter(pl.col("ESTABLECIMIENTO_SALUD").is_in(codigos_hospitales))
+
+    for codigo, df_hospital in df_hospitales.partition_by(
+        "ESTABLECIMIENTO_SALUD", as_dict=True
+    ).items():
+        codigo = formatear_valor_particion(codigo)
+        primer_lote = codigo not in archivos_abiertos
+        if primer_lote:
+            ruta = f"{output_filepath}/egresos_procesados_{codigo}.csv"
+            print(f"> Guardando {ruta}")
+            archivos_abiertos[codigo] = open(ruta, "w", encoding="utf-8")
+
+        df_hospital.write_csv(archivos_abiertos[codigo], has_header=primer_lote)
+
+
+@etapa_perfilada
+def exportar_extractos_hospitales(
+    ruta_carpeta_contenedora,
+    output_filepath,
+    codigos_hospitales,
+    limite_memoria_mb=LIMITE_MEMORIA_MB_DEFECTO,
+    esquema_compacto=False,
+    esquemas_edad=None,
+):
+    """
+    Write the CSV extract of every requested hospital with a single streaming scan of the
+    raw data, without writing the national table.
+
+    :param ruta_carpeta_contenedora: The directory with the raw DEIS CSV files.
+    :type ruta_carpeta_contenedora: str
+
+    :param output_filepath: The output directory.
+    :type output_filepath: str
+
+    :param codigos_hospitales: The hospitals to extract.
+    :type codigos_hospitales: list
+
+    :param limite_memoria_mb: The memory ceiling in MB. Defaults to LIMITE_MEMORIA_MB_DEFECTO.
+    :type limite_memoria_mb: float, optional
+
+    :param esquema_compacto: If True, the batches are downcast to ESQUEMA_COMPACTO, so more
+    rows fit in every batch.
+    :type esquema_compacto: bool, optional
+
+    :param esquemas_edad: The age band schemes to add. Defaults to ESQUEMAS_EDAD_DEFECTO.
+    :type esquemas_edad: list or dict, optional
+
+    :return: The codes of the hospitals that had at least one discharge.
+    :rtype: list
+    """
+    logger = logging.getLogger(__name__)
+    picos_por_etapa = {}
+    archivos_abiertos = {}
+
+    try:
+        with pl.StringCache():
+            lotes = iterar_lotes_egresos(
+                ruta_carpeta_contenedora,
+                limite_memoria_mb,
+                picos_por_etapa,
+                esquema_compacto,
+                esquemas_edad,
+            )
+            for _, _, df_lote in lotes:
+                escribir_extractos_hospitales(
+                    df_lote, codigos_hospitales, archivos_abiertos, output_filepath
+                )
+    finally:
+        for archivo in archivos_abiertos.values():
+            archivo.close()
+
+    sin_egresos = set(map(str, codigos_hospitales)) - set(archivos_abiertos)
+    if sin_egresos:
+        logger.warning(f"Hospitales sin egresos: {sorted(sin_egresos)}")
+
+    return list(archivos_abiertos)
+
+
+@etapa_perfilada
+def exportar_egresos_por_lotes(
+    ruta_carpeta_contenedora,
+    output_filepath,
+    limite_memoria_mb,
+    codigos_hospitales,
+    esquema_compacto=False,
+    esquemas_edad=None,
+):
+    """
+    Out-of-core version of the CSV export: appends every processed batch to the national CSV
+    and to the hospital extracts, so the national table is never materialized. Reports the peak
+    RSS of every stage, and warns about the stages above the ceiling: the ceiling sizes the
+    batches (see calcular_filas_por_lote) but it is advisory, it is not enforced.
+
+    :param ruta_carpeta_contenedora: The directory with the raw DEIS CSV files.
+    :type ruta_carpeta_contenedora: str
+
+    :param output_filepath: The output directory.
+    :type output_filepath: str
+
+    :param limite_memoria_mb: The memory ceiling in MB.
+    :type limite_memoria_mb: float
+
+    :param codigos_hospitales: The hospitals with their own CSV extract.
+    :type codigos_hospitales: list
+
+    :param esquema_compacto: If True, the batches are downcast to ESQUEMA_COMPACTO, so more
+    rows fit in every batch.
+    :type esquema_compacto: bool, optional
+
+    :param esquemas_edad: The age band schemes to add. Defaults to ESQUEMAS_EDAD_DEFECTO.
+    :type esquemas_edad: list or dict, optional
+
+    :return: The peak RSS (MB) of every stage.
+    :rtype: dict
+    """
+    logger = logging.getLogger(__name__)
+    picos_por_etapa = {}
+    ruta_nacional = f"{output_filepath}/egresos_procesados.csv"
+    archivo_nacional = None
+    archivos_abiertos = {}
+
+    try:
+        with pl.StringCache():
+            lotes = iterar_lotes_egresos(
+                ruta_carpeta_contenedora,
+                limite_memoria_mb,
+                picos_por_etapa,
+                esquema_compacto,
+                esquemas_edad,
+            )
+            for _, _, df_lote in lotes:
+                with medir_memoria_etapa("escritura", picos_por_etapa):
+                    primer_lote = archivo_nacional is None
+                    if primer_lote:
+                        archivo_nacional = open(ruta_nacional, "w", encoding="utf-8")
+
+                    df_lote.write_csv(archivo_nacional, has_header=primer_lote)
+                    escribir_extractos_hospitales(
+                        df_lote, codigos_hospitales, archivos_abiertos, output_filepath
+                    )
+    finally:
+        if archivo_nacional is not None:
+            archivo_nacional.close()
+        for archivo in archivos_abiertos.values():
+            archivo.close()
+
+    for etapa, pico_mb in picos_por_etapa.items():
+        logger.info(f"Pico de RSS en la etapa {etapa}: {pico_mb:.1f} MB")
+        if pico_mb > limite_memoria_mb:
+            logger.warning(f"La etapa {etapa} supero el limite de {limite_memoria_mb} MB")
+
+    return picos_por_etapa
+
+
+def leer_deis_formato_nuevo(ruta_carpeta_contenedora):
+    """Lee las bases con el formato nuevo (ver escanear_egresos_deis, que detecta el formato)"""
+    with pl.StringCache():
+        return escanear_egresos_deis(f"{ruta_carpeta_contenedora}/*.csv")
+
+
+@click.command()
+@click.argument("input_filepath", type=click.Path(exists=True))
+@click.argument("output_filepath", type=click.Path())
+@click.option(
+    "--formato",
+    type=click.Choice(["csv", "parquet", "parquet-ordenado"]),
+    default="csv",
+    help=(
+        "csv escribe las bases completas; parquet escribe un dataset particionado; "
+        "parquet-ordenado escribe un archivo por base, ordenado por hospital, con su indice."
+    ),
+)
+@click.option(
+    "--limite-memoria-mb",
+    type=float,
+    default=None,
+    help=(
+        "Procesa por lotes sin cargar la base nacional. El limite (RSS del proceso, en MB) es "
+        "orientativo: dimensiona los lotes y se advierte si una etapa lo supera, pero no incluye "
+        "la memoria fija de polars."
+    ),
+)
+@click.option(
+    "--hospitales",
+    default=None,
+    help="Codigos de los hospitales a extraer, separados por coma (ej: 112103,109101).",
+)
+@click.option(
+    "--archivo-hospitales",
+    type=click.Path(exists=True),
+    default=None,
+    help="Archivo de texto con un codigo de hospital por linea.",
+)
+@click.option(
+    "--solo-extractos",
+    is_flag=True,
+    help="Escribe solo los extractos por hospital, sin la base nacional.",
+)
+@click.option(
+    "--reconstruir",
+    is_flag=True,
+    help="En formato parquet, reprocesa todos los archivos ignorando el manifiesto.",
+)
+@click.option(
+    "--esquema-compacto",
+    is_flag=True,
+    help="Convierte los codigos a los enteros mas angostos y los textos a categoricos.",
+)
+@click.option(
+    "--esquema-edad",
+    "esquemas_edad",
+    type=click.Choice(list(ESQUEMAS_EDAD)),
+    multiple=True,
+    help=(
+        "Esquema de bandas de edad a agregar como columna (se puede repetir). Por defecto, "
+        f"{', '.join(ESQUEMAS_EDAD_DEFECTO)}."
+    ),
+)
+@click.option(
+    "--sin-transcodificar",
+    is_flag=True,
+    help="Lee los archivos directamente, sin la etapa que los transcodifica a UTF-8.",
+)
+@click.option(
+    "--procesos",
+    type=int,
+    default=None,
+    help="Procesos para transcodificar los archivos. Por defecto, los nucleos disponibles.",
+)
+@click.option(
+    "--perfilado",
+    type=click.Path(),
+    default=None,
+    envvar=VARIABLE_ENTORNO_PERFILADO,
+    help="Registra tiempo, filas, memoria y plan de cada etapa en este reporte JSON.",
+)
+def main(
+    input_filepath,
+    output_filepath,
+    formato,
+    limite_memoria_mb,
+    hospitales,
+    archivo_hospitales,
+    solo_extractos,
+    reconstruir,
+    esquema_compacto,
+    esquemas_edad,
+    sin_transcodificar,
+    procesos,
+    perfilado,
+):
+    """Runs data processing scripts to turn raw data from (../raw) into
+    cleaned data ready to be analyzed (saved in ../processed).
+    """
+    logger = logging.getLogger(__name__)
+    logger.info("making final data set from raw data")
+
+    if perfilado:
+        activar_perfilado(perfilado)
+        # El reporte se escribe al terminar, tambien si una etapa falla
+        click.get_current_context().call_on_close(
+            lambda: logger.info(f"Reporte de perfilado: {escribir_reporte_perfilado(perfilado)}")
+        )
+
+    codigos_hospitales = leer_codigos_hospitales(hospitales, archivo_hospitales)
+    esquemas_edad = list(esquemas_edad) or None
+
+    if not sin_transcodificar:
+        # Ej: data/raw -> data/interim/egresos_utf8
+        carpeta_utf8 = Path(input_filepath).resolve().parent / "interim" / CARPETA_EGRESOS_UTF8
+        input_filepath = transcodificar_egresos_deis(input_filepath, carpeta_utf8, procesos)
+
+    if formato == "parquet":
+        # Los extractos por hospital se leen como particiones con leer_egresos_parquet
+        ruta_dataset = f"{output_filepath}/{CARPETA_EGRESOS_PARQUET}"
+        resumen = exportar_egresos_parquet_incremental(
+            input_filepath,
+            ruta_dataset,
+            limite_memoria_mb,
+            reconstruir,
+            esquema_compacto,
+            esquemas_edad,
+        )
+        logger.info(
+            f"{len(resumen['archivos_procesados'])} archivos procesados, "
+            f"anios modificados: {resumen['anios_modificados']}"
+        )
+        return
+
+    if formato == "parquet-ordenado":
+        exportar_egresos_ordenados(
+            input_filepath,
+            f"{output_filepath}/{CARPETA_EGRESOS_ORDENADOS}",
+            esquema_compacto,
+            esquemas_edad,
+        )
+        return
+
+    if solo_extractos:
+        exportar_extractos_hospitales(
+            input_filepath,
+            output_filepath,
+            codigos_hospitales,
+            limite_memoria_mb or LIMITE_MEMORIA_MB_DEFECTO,
+            esquema_compacto,
+            esquemas_edad,
+        )
+        return
+
+    if limite_memoria_mb is not None:
+        exportar_egresos_por_lotes(
+            input_filepath,
+            output_filepath,
+            limite_memoria_mb,
+            codigos_hospitales,
+            esquema_compacto,
+            esquemas_edad,
+        )
+        return
+
+    with pl.StringCache():
+        # Lee y procesa base de DEIS
+        df_nacional = leer_egresos_deis(input_filepath, esquema_compacto, esquemas_edad)
+        with perfilar_etapa("collect", df_nacional) as registro:
+            df_nacional = df_nacional.collect()
+            registro["salida"] = df_nacional
+
+        # Exporta base nacional
+        ruta_egresos_nacionales = f"{output_filepath}/egresos_procesados.csv"
+        print(f"> Guardando {ruta_egresos_nacionales}")
+        with perfilar_etapa("write_csv", df_nacional):
+            df_nacional.write_csv(ruta_egresos_nacionales)
 
-        print(f"> Guardando {ruta_egresos_roberto}")
-        df_roberto.write_csv(ruta_egresos_roberto)
+        # Exporta los extractos de los hospitales de interes
+        archivos_abiertos = {}
+        try:
+            escribir_extractos_hospitales(
+                df_nacional, codigos_hospitales, archivos_abiertos, output_filepath
+            )
+        finally:
+            for archivo in archivos_abiertos.values():
+                archivo.close()
 
 
 if __name__ == "__main__":
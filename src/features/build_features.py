@@ -12,20 +12,63 @@ Module Functions:
     - obtener_metricas_egresos: Calculates metrics for hospital discharges, such as the number of
     discharges, total length of stay, surgical interventions, and number of deaths per diagnosis
     at the specified aggregation level.
+    - consolidar_metricas_egresos: Rolls up metrics to a coarser grouping level, merging the
+    approximate distinct patient sketches instead of re-scanning the patients.
+    - construir_cubo_metricas: Builds the metrics cube at the finest common grain, with the
+    distinct patient sketches, so obtener_metricas_egresos can answer from it.
+    - guardar_cubo_metricas / leer_cubo_metricas: Persist the metrics cube as Parquet.
+    - construir_tabla_cohortes / obtener_metricas_cohortes: Compute the metrics of many
+    (possibly overlapping) diagnosis cohorts in a single pass, through a diagnosis -> cohort
+    lookup table.
+    - obtener_metricas_bandas_edad: Computes the metrics of every band of several age band
+    schemes (see make_dataset.ESQUEMAS_EDAD) with a single group-by.
+    - marcar_reingresos: Links every discharge with the next episode of the same patient and
+    flags the 30/90-day readmissions, with a single sort and a masked shift.
+    - obtener_tasas_reingreso: Calculates the readmission rates at any grouping level.
+    - obtener_resumen_procedimientos: Calculates the frequency of the main surgical
+    interventions and procedures in a single scan, for one hospital, a list or a stratum.
+    - obtener_desglose_sociodemografico: Calculates the metrics per diagnosis for any subset of
+    the sociodemographic dimensions, and adds the comuna and ICD-10 labels after aggregating.
+    - agregar_glosas_sociodemograficas: Joins the cached comuna and ICD-10 tables to a
+    breakdown and formats its labels.
     - obtener_diccionario_estratos: Obtains a dictionary of hospitals belonging to different 
     Chilean strata, including public and private hospitals, national hospital codes, 'grd' 
-    hospitals, and the hospital being analyzed.
+    hospitals, the hospital being analyzed and user-defined strata, from a single scan.
+    - leer_config_estratos: Reads user-defined strata from a YAML or JSON file.
+    - calcular_version_datos: Computes a version key of the source data, used to cache the
+    establishment -> strata index.
     - obtener_metricas_para_un_estrato: Obtains metrics for a specific stratum in the DataFrame 
     based on the analysis variable and ranking subgroup.
     - obtener_resumen_por_estratos: Obtains a summary of metrics for different strata in the 
     DataFrame based on provided dictionaries, variables to rank, and ranking subgroup.
     - left_join_consecutivo: Performs a left join operation on two DataFrames based on a specified
     column.
+    - leer_y_unir_cie: Joins the cached ICD-10 catalog (see src.data.catalogo_cie) on "DIAG1".
+    - actualizar_cubo_metricas / actualizar_ranking_estratos: Refresh the metrics cube and the
+    stratum rankings only for the years touched by new or changed input files.
+    - verificar_consistencia_incremental: Checks an incremental refresh against a full rebuild.
+    - calcular_ranking_estratos: Computes the ranking, total and share of every stratum and
+    ranking variable in a single lazy plan, with membership flags and over() windows.
+
+The main functions are instrumented with src.data.instrumentacion.etapa_perfilada: with the
+EGRESOS_PERFILADO environment variable set, every call records its time, rows, peak memory and
+query plan.
 """
 
+import glob
+import hashlib
+import json
+import os
+from pathlib import Path
+
 import polars as pl
 import pandas as pd
-from functools import reduce
+import yaml
+
+from src.data import catalogo_cie
+from src.data.instrumentacion import etapa_perfilada
+from src.data.make_dataset import convertir_a_lista, obtener_expresion_fecha
+from src.features import hyperloglog
 
 
 PERTENECE_SNSS = "Pertenecientes al Sistema Nacional de Servicios de Salud, SNSS"
@@ -99,6 +142,83 @@ HOSPITALES_GRD = [
 ]
 
 
+# Atributos propios de cada establecimiento, disponibles para definir estratos
+ATRIBUTOS_ESTABLECIMIENTO = [
+    "GLOSA_ESTABLECIMIENTO_SALUD",
+    "PERTENENCIA_ESTABLECIMIENTO_SALUD",
+    "SEREMI",
+    "SERVICIO_DE_SALUD",
+]
+
+# Version del indice establecimiento -> estratos guardado en cache. Se debe incrementar cada vez
+# que cambie la forma de calcular la pertenencia a los estratos
+VERSION_INDICE_ESTRATOS = 2
+
+# Columnas de las metricas que preceden a las columnas de ranking de cada estrato
+COLUMNAS_BASE_RANKING = [
+    "ANO_EGRESO",
+    "ESTABLECIMIENTO_SALUD",
+    "GLOSA_ESTABLECIMIENTO_SALUD",
+    "Capítulo",
+    "Sección",
+    "Categoría",
+    "Descripción",
+    "DIAG1",
+    "n_egresos",
+    "dias_estada_totales",
+    "n_int_q",
+    "n_muertos",
+    "n_pacientes_distintos",
+]
+
+# Columnas necesarias para calcular las metricas de obtener_metricas_egresos
+COLUMNAS_METRICAS = ["DIAG1", "DIAS_ESTADA", "INTERV_Q", "CONDICION_EGRESO", "ID_PACIENTE"]
+
+# Metricas que se pueden sumar al pasar a un nivel de agrupacion mas grueso
+METRICAS_ADITIVAS = ["n_egresos", "dias_estada_totales", "n_int_q", "n_muertos"]
+
+# Columnas del conteo aproximado de pacientes distintos (ver hyperloglog.py)
+COLUMNA_SKETCH_PACIENTES = "sketch_pacientes_distintos"
+COLUMNA_PRECISION_SKETCH = "precision_sketch_pacientes"
+COLUMNAS_PACIENTES_APROXIMADOS = [
+    "n_pacientes_distintos",
+    COLUMNA_SKETCH_PACIENTES,
+    COLUMNA_PRECISION_SKETCH,
+]
+
+# Grano del cubo de metricas y atributos que dependen de el (no agregan celdas al cubo)
+DIMENSIONES_CUBO = [
+    "ANO_EGRESO",
+    "ESTABLECIMIENTO_SALUD",
+    "DIAG1",
+    "SEXO",
+    "EDAD_CATEGORIA",
+    "PREVISION",
+    "COMUNA_RESIDENCIA",
+]
+ATRIBUTOS_CUBO = ATRIBUTOS_ESTABLECIMIENTO + ["REGION_RESIDENCIA"]
+ERROR_PACIENTES_CUBO = 0.01
+ARCHIVO_CUBO_METRICAS = "cubo_metricas_egresos.parquet"
+
+# Dimensiones del desglose sociodemografico y glosas que se llevan a formato titulo
+DIMENSIONES_SOCIODEMOGRAFICAS = [
+    "ANO_EGRESO",
+    "REGION_RESIDENCIA",
+    "COMUNA_RESIDENCIA",
+    "SEXO",
+    "EDAD_CATEGORIA",
+    "PREVISION",
+    "BENEFICIARIO",
+]
+GLOSAS_FORMATO_TITULO = ["PREVISION", "Nombre Comuna"]
+
+# Ventanas (en dias desde el egreso) de las tasas de reingreso, y columnas para enlazar episodios
+VENTANAS_REINGRESO = [30, 90]
+COLUMNAS_EPISODIOS = ["ID_PACIENTE", "FECHA_EGRESO", "DIAS_ESTADA", "CONDICION_EGRESO"]
+SEMILLA_HASH_PACIENTES = 0
+# La estada ocupa 16 bits de la llave de orden; una estada negativa o mayor es invalida
+DIAS_ESTADA_MAXIMA = 2**16 - 1
+
 UNIR_EN = [
     "ANO_EGRESO",
     "ESTABLECIMIENTO_SALUD",
@@ -112,78 +232,891 @@ UNIR_EN = [
 ]
 
 
-def obtener_metricas_egresos(df, agrupar_por):
+@etapa_perfilada
+def obtener_metricas_egresos(df, agrupar_por, error_pacientes_distintos=None, cubo=None):
     """
     Calculates the number of discharges, total length of stay, surgical interventions,
     and number of deaths per diagnosis. This calculation is performed at the specified
     aggregation level.
 
+    By default the distinct patients are counted exactly. With error_pacientes_distintos, they
+    are approximated with HyperLogLog sketches (see src.features.hyperloglog), which are kept in
+    the output (COLUMNA_SKETCH_PACIENTES and COLUMNA_PRECISION_SKETCH) so the metrics can be
+    rolled up to coarser levels with consolidar_metricas_egresos. The approximate mode is meant
+    for mergeability, not speed: at a fine grain (ej: year x establishment x diagnosis) almost
+    every patient falls in its own register, so building the sketches is slower than the exact
+    count. Use it when the output will be rolled up or refreshed incrementally.
+
+    If a metrics cube is given (see construir_cubo_metricas) and agrupar_por is a subset of its
+    dimensions, the metrics are rolled up from the cube and df is not scanned. In that case
+    the distinct patients come from the sketches of the cube.
+
     :param df: The hospital discharge data table to be analyzed.
     :type df: pl.DataFrame or pl.LazyFrame
 
     :param agrupar_por: The grouping level to work with.
     :type agrupar_por: str
 
+    :param error_pacientes_distintos: The relative standard error of the approximate distinct
+    patient count (ej: 0.01). If None, the patients are counted exactly.
+    :type error_pacientes_distintos: float or None
+
+    :param cubo: A metrics cube to answer from, if it has the dimensions of agrupar_por.
+    :type cubo: pl.DataFrame or pl.LazyFrame or None
+
     :returns: Returns a DataFrame with metrics including the number of discharges,
     total length of stay, surgical interventions, and number of deaths per diagnosis
     and grouping level.
     :rtype: pl.DataFrame or pl.LazyFrame
     """
-    metricas_agregadas = df.groupby(agrupar_por).agg(
-        [
+    if cubo is not None and set(convertir_a_lista(agrupar_por)) <= set(
+        obtener_dimensiones_cubo(cubo)
+    ):
+        metricas_agregadas = consolidar_metricas_egresos(cubo, agrupar_por)
+        if error_pacientes_distintos is None:
+            metricas_agregadas = metricas_agregadas.drop(
+                [COLUMNA_SKETCH_PACIENTES, COLUMNA_PRECISION_SKETCH]
+            )
+
+        return metricas_agregadas
+
+    if error_pacientes_distintos is None:
+        metricas_agregadas = df.groupby(agrupar_por).agg(
+            [
+                pl.col("DIAG1").count().alias("n_egresos"),
+                pl.col("DIAS_ESTADA").sum().alias("dias_estada_totales"),
+                pl.col("INTERV_Q").sum().alias("n_int_q"),
+                pl.col("CONDICION_EGRESO").sum().alias("n_muertos"),
+                pl.col("ID_PACIENTE").n_unique().alias("n_pacientes_distintos"),
+            ]
+        )
+
+        return metricas_agregadas
+
+    agrupar_por = convertir_a_lista(agrupar_por)
+    precision = hyperloglog.calcular_precision_hll(error_pacientes_distintos)
+
+    metricas_agregadas = hyperloglog.construir_sketches_hll(
+        df,
+        agrupar_por,
+        "ID_PACIENTE",
+        precision,
+        COLUMNA_SKETCH_PACIENTES,
+        sumas=[
             pl.col("DIAG1").count().alias("n_egresos"),
             pl.col("DIAS_ESTADA").sum().alias("dias_estada_totales"),
             pl.col("INTERV_Q").sum().alias("n_int_q"),
             pl.col("CONDICION_EGRESO").sum().alias("n_muertos"),
-            pl.col("ID_PACIENTE").n_unique().alias("n_pacientes_distintos"),
+        ],
+    )
+    metricas_agregadas = metricas_agregadas.with_columns(
+        hyperloglog.estimar_cardinalidad_hll(COLUMNA_SKETCH_PACIENTES, precision).alias(
+            "n_pacientes_distintos"
+        ),
+        pl.lit(precision, dtype=pl.UInt8).alias(COLUMNA_PRECISION_SKETCH),
+    )
+
+    columnas_finales = agrupar_por + METRICAS_ADITIVAS + COLUMNAS_PACIENTES_APROXIMADOS
+
+    return metricas_agregadas.select(columnas_finales)
+
+
+@etapa_perfilada
+def consolidar_metricas_egresos(df_metricas, agrupar_por):
+    """
+    Rolls up metrics computed with obtener_metricas_egresos to a coarser grouping level (ej: from
+    year x establishment x diagnosis to year x region, or to the strata of an establishment ->
+    stratum index). The additive metrics are summed, and the distinct patients are estimated
+    again from the merged sketches, so the patients are not scanned again.
+
+    :param df_metricas: Metrics computed with error_pacientes_distintos, so they include the
+    distinct patient sketches.
+    :type df_metricas: pl.DataFrame or pl.LazyFrame
+
+    :param agrupar_por: The coarser grouping level.
+    :type agrupar_por: str or list
+
+    :return: The metrics at the coarser grouping level, with their merged sketches.
+    :rtype: pl.DataFrame or pl.LazyFrame
+    """
+    agrupar_por = convertir_a_lista(agrupar_por)
+
+    metricas_agregadas = df_metricas.groupby(agrupar_por).agg(
+        [pl.col(metrica).sum() for metrica in METRICAS_ADITIVAS]
+        + [pl.col(COLUMNA_PRECISION_SKETCH).first()]
+    )
+    sketches = hyperloglog.combinar_sketches_hll(
+        df_metricas, agrupar_por, COLUMNA_SKETCH_PACIENTES
+    )
+
+    metricas_agregadas = metricas_agregadas.join(sketches, how="left", on=agrupar_por)
+    metricas_agregadas = metricas_agregadas.with_columns(
+        hyperloglog.estimar_cardinalidad_hll(
+            COLUMNA_SKETCH_PACIENTES, pl.col(COLUMNA_PRECISION_SKETCH)
+        ).alias("n_pacientes_distintos")
+    )
+
+    columnas_finales = agrupar_por + METRICAS_ADITIVAS + COLUMNAS_PACIENTES_APROXIMADOS
+
+    return metricas_agregadas.select(columnas_finales)
+
+
+@etapa_perfilada
+def construir_cubo_metricas(df, error_pacientes_distintos=ERROR_PACIENTES_CUBO):
+    """
+    Builds the metrics cube: the metrics of obtener_metricas_egresos at the finest common grain
+    (DIMENSIONES_CUBO), carrying the attributes that depend on it (ATRIBUTOS_CUBO). The additive
+    metrics and the distinct patient sketches can be rolled up to any subset of its dimensions.
+
+    :param df: The hospital discharge data table.
+    :type df: pl.DataFrame or pl.LazyFrame
+
+    :param error_pacientes_distintos: The relative standard error of the distinct patient
+    sketches.
+    :type error_pacientes_distintos: float
+
+    :return: The metrics cube.
+    :rtype: pl.DataFrame or pl.LazyFrame
+    """
+    dimensiones = DIMENSIONES_CUBO + [
+        columna for columna in ATRIBUTOS_CUBO if columna in df.columns
+    ]
+
+    return obtener_metricas_egresos(df, dimensiones, error_pacientes_distintos)
+
+
+def obtener_dimensiones_cubo(cubo):
+    """Obtiene las dimensiones de un cubo de metricas (todas las columnas que no son metricas)"""
+    metricas = METRICAS_ADITIVAS + COLUMNAS_PACIENTES_APROXIMADOS
+    return [columna for columna in cubo.columns if columna not in metricas]
+
+
+def guardar_cubo_metricas(cubo, ruta_cubo):
+    """
+    Writes a metrics cube to a Parquet file.
+
+    :param cubo: The metrics cube (see construir_cubo_metricas).
+    :type cubo: pl.DataFrame or pl.LazyFrame
+
+    :param ruta_cubo: The path of the Parquet file, or a folder where ARCHIVO_CUBO_METRICAS is
+    written.
+    :type ruta_cubo: str or Path
+
+    :return: The path of the written file.
+    :rtype: Path
+    """
+    ruta_cubo = Path(ruta_cubo)
+    if ruta_cubo.suffix != ".parquet":
+        ruta_cubo = ruta_cubo / ARCHIVO_CUBO_METRICAS
+
+    if isinstance(cubo, pl.LazyFrame):
+        cubo = cubo.collect()
+
+    ruta_cubo.parent.mkdir(parents=True, exist_ok=True)
+    cubo.write_parquet(ruta_cubo, compression="zstd")
+
+    return ruta_cubo
+
+
+def leer_cubo_metricas(ruta_cubo):
+    """
+    Reads a metrics cube written with guardar_cubo_metricas.
+
+    :param ruta_cubo: The path of the Parquet file, or the folder where it was written.
+    :type ruta_cubo: str or Path
+
+    :return: The metrics cube.
+    :rtype: pl.LazyFrame
+    """
+    ruta_cubo = Path(ruta_cubo)
+    if ruta_cubo.suffix != ".parquet":
+        ruta_cubo = ruta_cubo / ARCHIVO_CUBO_METRICAS
+
+    return pl.scan_parquet(ruta_cubo)
+
+
+def construir_tabla_cohortes(cohortes, diagnosticos=None):
+    """
+    Builds the lookup table from diagnosis to cohort. Each cohort is defined by a list of ICD-10
+    codes, where the codes ending in "*" are prefixes (ej: "C34*" includes "C340", "C341", ...).
+    A diagnosis can belong to many cohorts, so the table has one row per (cohort, diagnosis).
+
+    :param cohortes: A dictionary of cohort name -> code list (or a single code or prefix).
+    :type cohortes: dict
+
+    :param diagnosticos: The diagnoses to match against the prefixes (ej: the unique "DIAG1" of
+    the data). Only needed when some cohort has prefixes.
+    :type diagnosticos: list or pl.Series, optional
+
+    :return: A table with the columns "COHORTE" and "DIAG1".
+    :rtype: pl.DataFrame
+    """
+    definiciones = pl.DataFrame(
+        [
+            (nombre_cohorte, codigo)
+            for nombre_cohorte, codigos in cohortes.items()
+            for codigo in convertir_a_lista(codigos)
+        ],
+        schema={"COHORTE": pl.Utf8, "codigo": pl.Utf8},
+    )
+    es_prefijo = pl.col("codigo").str.ends_with("*")
+
+    tabla_exactos = definiciones.filter(~es_prefijo).select(
+        "COHORTE", pl.col("codigo").alias("DIAG1")
+    )
+    prefijos = definiciones.filter(es_prefijo).with_columns(
+        pl.col("codigo").str.replace(r"\*$", "")
+    )
+    if prefijos.is_empty():
+        return tabla_exactos.unique()
+
+    # Cada diagnostico se cruza con sus prefijos de los largos usados, en vez de filtrar por
+    # cada cohorte
+    diagnosticos = pl.DataFrame({"DIAG1": diagnosticos}).select(
+        pl.col("DIAG1").cast(pl.Utf8).drop_nulls().unique()
+    )
+    largos_prefijos = prefijos.select(pl.col("codigo").str.lengths().unique()).to_series()
+    prefijos_diagnosticos = pl.concat(
+        [
+            diagnosticos.with_columns(pl.col("DIAG1").str.slice(0, largo).alias("codigo"))
+            for largo in largos_prefijos
+        ]
+    )
+    tabla_prefijos = prefijos_diagnosticos.join(prefijos, on="codigo").select("COHORTE", "DIAG1")
+
+    return pl.concat([tabla_exactos, tabla_prefijos]).unique()
+
+
+@etapa_perfilada
+def obtener_metricas_cohortes(df, cohortes, agrupar_por=None, error_pacientes_distintos=None):
+    """
+    Calculates the metrics of obtener_metricas_egresos (discharges, length of stay, surgical
+    interventions, deaths and distinct patients) for many diagnosis cohorts at once. Cohorts
+    can overlap.
+
+    The data is aggregated once per diagnosis, and the aggregates are joined to the
+    diagnosis -> cohort table (see construir_tabla_cohortes) and summed per cohort, so the cost
+    does not depend on the number of cohorts. The exact distinct patients need the unique
+    (patient, diagnosis) pairs to be joined to the table; with error_pacientes_distintos the
+    per-diagnosis sketches are merged instead.
+
+    If "DIAG1" is categorical, this must be called inside a pl.StringCache() context.
+
+    :param df: The hospital discharge data table to be analyzed.
+    :type df: pl.DataFrame or pl.LazyFrame
+
+    :param cohortes: A dictionary of cohort name -> code list (or a single code or prefix). The
+    codes ending in "*" are prefixes.
+    :type cohortes: dict
+
+    :param agrupar_por: Additional grouping columns (ej: ["ANO_EGRESO"]).
+    :type agrupar_por: list, optional
+
+    :param error_pacientes_distintos: The relative standard error of the approximate distinct
+    patient count. If None, the patients are counted exactly.
+    :type error_pacientes_distintos: float or None
+
+    :return: The metrics per cohort (column "COHORTE") and grouping level.
+    :rtype: pl.DataFrame or pl.LazyFrame
+    """
+    agrupar_por = convertir_a_lista(agrupar_por or [])
+    metricas_diagnosticos = obtener_metricas_egresos(
+        df, agrupar_por + ["DIAG1"], error_pacientes_distintos
+    )
+    if isinstance(metricas_diagnosticos, pl.LazyFrame):
+        metricas_diagnosticos = metricas_diagnosticos.collect()
+
+    tabla_cohortes = construir_tabla_cohortes(cohortes, metricas_diagnosticos["DIAG1"])
+    tabla_cohortes = tabla_cohortes.with_columns(
+        pl.col("DIAG1").cast(metricas_diagnosticos.schema["DIAG1"])
+    )
+    metricas_cohortes = metricas_diagnosticos.join(tabla_cohortes, on="DIAG1", how="inner")
+    agrupar_por_cohorte = ["COHORTE"] + agrupar_por
+
+    if error_pacientes_distintos is not None:
+        metricas = consolidar_metricas_egresos(metricas_cohortes, agrupar_por_cohorte)
+    else:
+        pacientes_diagnosticos = df.select(agrupar_por + ["DIAG1", "ID_PACIENTE"]).unique()
+        if isinstance(pacientes_diagnosticos, pl.LazyFrame):
+            pacientes_diagnosticos = pacientes_diagnosticos.collect()
+
+        pacientes_cohortes = (
+            pacientes_diagnosticos.join(tabla_cohortes, on="DIAG1", how="inner")
+            .groupby(agrupar_por_cohorte)
+            .agg(pl.col("ID_PACIENTE").n_unique().alias("n_pacientes_distintos"))
+        )
+        metricas = (
+            metricas_cohortes.groupby(agrupar_por_cohorte)
+            .agg(pl.col(METRICAS_ADITIVAS).sum())
+            .join(pacientes_cohortes, on=agrupar_por_cohorte, how="left")
+        )
+
+    return metricas.lazy() if isinstance(df, pl.LazyFrame) else metricas
+
+
+@etapa_perfilada
+def obtener_metricas_bandas_edad(
+    df, agrupar_por, columnas_edad=("EDAD_CATEGORIA",), error_pacientes_distintos=None
+):
+    """
+    Calculates the metrics of obtener_metricas_egresos for every band of several age band
+    schemes (ej: the EDAD_PEDIATRICA and EDAD_MENOR_18 columns added by leer_egresos_deis with
+    esquemas_edad). The scheme columns are unpivoted into ("ESQUEMA_EDAD", "BANDA_EDAD") pairs, so
+    overlapping bands of different schemes (ej: "ninos" and "hasta_18") come from the same scan
+    and a single group-by, instead of one filter and aggregation per band.
+
+    :param df: The hospital discharge data table, with the age band columns.
+    :type df: pl.DataFrame or pl.LazyFrame
+
+    :param agrupar_por: The grouping level to work with.
+    :type agrupar_por: str or list
+
+    :param columnas_edad: The age band columns (one per scheme).
+    :type columnas_edad: list or tuple
+
+    :param error_pacientes_distintos: The relative standard error of the approximate distinct
+    patient count. If None, the patients are counted exactly.
+    :type error_pacientes_distintos: float or None
+
+    :return: The metrics per grouping level, "ESQUEMA_EDAD" (the name of the band column) and
+    "BANDA_EDAD" (the band).
+    :rtype: pl.DataFrame or pl.LazyFrame
+    """
+    agrupar_por = convertir_a_lista(agrupar_por)
+    columnas_edad = convertir_a_lista(columnas_edad)
+    columnas_fijas = list(dict.fromkeys(agrupar_por + COLUMNAS_METRICAS))
+
+    bandas = df.select(
+        columnas_fijas + [pl.col(columna).cast(pl.Utf8) for columna in columnas_edad]
+    ).melt(
+        id_vars=columnas_fijas,
+        value_vars=columnas_edad,
+        variable_name="ESQUEMA_EDAD",
+        value_name="BANDA_EDAD",
+    )
+
+    return obtener_metricas_egresos(
+        bandas, agrupar_por + ["ESQUEMA_EDAD", "BANDA_EDAD"], error_pacientes_distintos
+    )
+
+
+@etapa_perfilada
+def marcar_reingresos(df, ventanas=VENTANAS_REINGRESO):
+    """
+    Links every discharge with the next episode of the same patient and flags the readmissions.
+    The admission date is reconstructed as FECHA_EGRESO - DIAS_ESTADA, the table is sorted once
+    by patient (its hash) and admission, and the next episode is obtained with a shift masked
+    where the patient changes. This scales with the sort, instead of the self-join per patient.
+
+    An episode is a readmission of a discharge when it is the next episode of the patient and
+    its admission is between 0 and ventana days after the discharge (an overlapping episode,
+    usually a transfer, is not counted). A discharge is at risk of readmission when the patient
+    is alive (CONDICION_EGRESO == 0, as mapped by make_dataset), the patient and dates are known
+    and there are at least ventana days of follow-up before the last discharge of the table.
+    A stay that is negative or longer than DIAS_ESTADA_MAXIMA days leaves the admission unknown,
+    so that discharge is neither at risk nor counted as a readmission.
+
+    :param df: The hospital discharge data table, with the columns of COLUMNAS_EPISODIOS.
+    :type df: pl.DataFrame or pl.LazyFrame
+
+    :param ventanas: The readmission windows, in days.
+    :type ventanas: list
+
+    :return: The table grouped by patient and sorted by admission, with "FECHA_INGRESO",
+    "DIAS_HASTA_REINGRESO" (days from the discharge to the next admission) and, for every
+    window, the "REINGRESO_<ventana>D" and "EN_RIESGO_<ventana>D" flags.
+    :rtype: pl.DataFrame or pl.LazyFrame
+    """
+    fecha_egreso = obtener_expresion_fecha("FECHA_EGRESO", df.schema["FECHA_EGRESO"])
+    egreso = pl.col("FECHA_EGRESO").cast(pl.Int32)
+    ingreso = pl.col("__ingreso")
+    # Una estada desconocida cuenta como 0 dias; una invalida queda nula (ingreso desconocido)
+    estada = pl.col("DIAS_ESTADA").cast(pl.Int64)
+    dias_estada = pl.when(estada.is_null() | estada.is_between(0, DIAS_ESTADA_MAXIMA)).then(
+        estada.fill_null(0)
+    )
+    # Los episodios sin ingreso se ubican en su fecha de egreso
+    posicion = ingreso.fill_null(egreso)
+
+    episodios = (
+        df.with_row_count("__orden")
+        .with_columns(fecha_egreso.alias("FECHA_EGRESO"))
+        .with_columns(
+            (egreso - dias_estada).alias("__ingreso"),
+            dias_estada.fill_null(0).alias("__estada"),
+            pl.col("ID_PACIENTE").hash(SEMILLA_HASH_PACIENTES).alias("__paciente"),
+        )
+        # Ordenar por dos enteros es mas rapido que por el texto del paciente y tres columnas.
+        # La llave lleva el ingreso, la estada y el numero de fila (desempata episodios iguales)
+        .with_columns(
+            (
+                (posicion - posicion.min()).cast(pl.UInt64) * 2**48
+                + pl.col("__estada").cast(pl.UInt64) * 2**32
+                + pl.col("__orden").cast(pl.UInt64)
+            ).alias("__llave")
+        )
+        .sort(["__paciente", "__llave"])
+    )
+
+    # Se compara el paciente y no su hash: una colision solo podria perder enlaces
+    mismo_paciente = pl.col("ID_PACIENTE") == pl.col("ID_PACIENTE").shift(-1)
+    episodios = episodios.with_columns(
+        ingreso.cast(pl.Date).alias("FECHA_INGRESO"),
+        pl.when(mismo_paciente).then(ingreso.shift(-1) - egreso).alias("DIAS_HASTA_REINGRESO"),
+        (egreso.max() - egreso).alias("__dias_seguimiento"),
+    )
+
+    dias_reingreso = pl.col("DIAS_HASTA_REINGRESO")
+    # El ingreso es nulo si la fecha de egreso es desconocida o la estada es invalida
+    puede_reingresar = (
+        pl.col("ID_PACIENTE").is_not_null()
+        & ingreso.is_not_null()
+        & (pl.col("CONDICION_EGRESO") == 0)
+    )
+    episodios = episodios.with_columns(
+        [
+            (dias_reingreso.is_between(0, ventana)).fill_null(False).alias(f"REINGRESO_{ventana}D")
+            for ventana in ventanas
+        ]
+        + [
+            (puede_reingresar & (pl.col("__dias_seguimiento") >= ventana))
+            .fill_null(False)
+            .alias(f"EN_RIESGO_{ventana}D")
+            for ventana in ventanas
+        ]
+    )
+
+    return episodios.drop(
+        ["__orden", "__ingreso", "__estada", "__paciente", "__llave", "__dias_seguimiento"]
+    )
+
+
+@etapa_perfilada
+def obtener_tasas_reingreso(df, agrupar_por, ventanas=VENTANAS_REINGRESO):
+    """
+    Calculates the readmission rates of every window at any grouping level of
+    obtener_metricas_egresos (ej: ["ANO_EGRESO", "ESTABLECIMIENTO_SALUD", "DIAG1"]). The
+    readmissions are attributed to the index discharge (its hospital, diagnosis, year, etc.),
+    and the episodes are linked over the whole table (see marcar_reingresos), so a readmission
+    in another hospital or year is counted.
+
+    :param df: The hospital discharge data table, with the columns of COLUMNAS_EPISODIOS.
+    :type df: pl.DataFrame or pl.LazyFrame
+
+    :param agrupar_por: The grouping level to work with.
+    :type agrupar_por: str or list
+
+    :param ventanas: The readmission windows, in days.
+    :type ventanas: list
+
+    :return: Per grouping level, "n_egresos" and, for every window, the discharges at risk
+    ("n_en_riesgo_<ventana>d"), the readmissions ("n_reingresos_<ventana>d") and their rate
+    ("tasa_reingreso_<ventana>d", null without discharges at risk).
+    :rtype: pl.DataFrame or pl.LazyFrame
+    """
+    agrupar_por = convertir_a_lista(agrupar_por)
+    columnas = list(dict.fromkeys(agrupar_por + COLUMNAS_EPISODIOS))
+    episodios = marcar_reingresos(df.select(columnas), ventanas)
+
+    tasas = episodios.groupby(agrupar_por).agg(
+        [pl.count().alias("n_egresos")]
+        + [
+            metrica
+            for ventana in ventanas
+            for metrica in (
+                pl.col(f"EN_RIESGO_{ventana}D").sum().alias(f"n_en_riesgo_{ventana}d"),
+                (pl.col(f"REINGRESO_{ventana}D") & pl.col(f"EN_RIESGO_{ventana}D"))
+                .sum()
+                .alias(f"n_reingresos_{ventana}d"),
+            )
+        ]
+    )
+
+    # Sin egresos en riesgo la tasa queda nula
+    return tasas.with_columns(
+        [
+            pl.when(pl.col(f"n_en_riesgo_{ventana}d") > 0)
+            .then(pl.col(f"n_reingresos_{ventana}d") / pl.col(f"n_en_riesgo_{ventana}d"))
+            .alias(f"tasa_reingreso_{ventana}d")
+            for ventana in ventanas
+        ]
+    )
+
+
+@etapa_perfilada
+def obtener_resumen_procedimientos(
+    df, hospitales=None, agrupar_por=("ANO_EGRESO", "DIAG1"), top_n=None
+):
+    """
+    Calculates the frequency of the main surgical intervention (CODIGO_INTERV_Q_PPAL) and of the
+    main procedure (CODIGO_PROCED_PPAL), with their descriptions, per grouping level. Both
+    frequency tables come from a single lazy scan: every discharge is turned into one row per
+    kind of procedure ("INTERV_Q" and "PROCED") before aggregating. Discharges without a code
+    are not counted.
+
+    :param df: The hospital discharge data table to be analyzed.
+    :type df: pl.DataFrame or pl.LazyFrame
+
+    :param hospitales: The establishments to summarize: a code, a list of codes or a stratum of
+    obtener_diccionario_estratos. Defaults to all establishments.
+    :type hospitales: int, list or pl.Series, optional
+
+    :param agrupar_por: The grouping level of the frequencies.
+    :type agrupar_por: list or tuple
+
+    :param top_n: If given, only the top_n most frequent codes of every group and kind of
+    procedure are kept.
+    :type top_n: int, optional
+
+    :return: A LazyFrame with the grouping columns, "TIPO" ("INTERV_Q" or "PROCED"), "CODIGO",
+    "GLOSA" and "n_egresos", sorted by frequency within every group.
+    :rtype: pl.LazyFrame
+    """
+    agrupar_por = convertir_a_lista(agrupar_por)
+    df = df.lazy()
+    if hospitales is not None:
+        df = df.filter(pl.col("ESTABLECIMIENTO_SALUD").is_in(convertir_a_lista(hospitales)))
+
+    procedimientos = df.select(
+        agrupar_por
+        + [
+            pl.concat_list([pl.lit("INTERV_Q"), pl.lit("PROCED")]).alias("TIPO"),
+            pl.concat_list(
+                [
+                    pl.col("CODIGO_INTERV_Q_PPAL").cast(pl.Int64).cast(pl.Utf8),
+                    pl.col("CODIGO_PROCED_PPAL").cast(pl.Utf8),
+                ]
+            ).alias("CODIGO"),
+            pl.concat_list(
+                [
+                    pl.col("GLOSA_INTERV_Q_PPAL").cast(pl.Utf8),
+                    pl.col("GLOSA_PROCED_PPAL").cast(pl.Utf8),
+                ]
+            ).alias("GLOSA"),
         ]
+    ).explode(["TIPO", "CODIGO", "GLOSA"])
+
+    grupo = agrupar_por + ["TIPO"]
+    resumen = (
+        procedimientos.filter(pl.col("CODIGO").is_not_null())
+        .groupby(grupo + ["CODIGO", "GLOSA"])
+        .agg(pl.count().alias("n_egresos"))
+        .sort(grupo + ["n_egresos", "CODIGO"], descending=[False] * len(grupo) + [True, False])
     )
 
-    return metricas_agregadas
+    if top_n is not None:
+        resumen = resumen.filter(
+            pl.col("n_egresos").rank("ordinal", descending=True).over(grupo) <= top_n
+        )
+
+    return resumen
 
 
-def obtener_diccionario_estratos(df_nacional, hospital_interno):
+@etapa_perfilada
+def obtener_desglose_sociodemografico(
+    df,
+    dimensiones=DIMENSIONES_SOCIODEMOGRAFICAS,
+    hospitales=None,
+    variable_a_contar="DIAG1",
+    agregar_glosas=True,
+    cubo=None,
+):
+    """
+    Calculates the metrics of obtener_metricas_egresos per diagnosis for any subset of the
+    sociodemographic dimensions (ej: ["ANO_EGRESO", "SEXO"] or all of
+    DIMENSIONES_SOCIODEMOGRAFICAS), for one hospital, a list or a stratum.
+
+    The labels (comuna names, ICD-10 descriptions, title case) are added after aggregating, so
+    the joins and string operations run over the breakdown instead of over every discharge.
+
+    :param df: The hospital discharge data table to be analyzed.
+    :type df: pl.DataFrame or pl.LazyFrame
+
+    :param dimensiones: The sociodemographic dimensions of the breakdown.
+    :type dimensiones: list
+
+    :param hospitales: The establishments to summarize: a code, a list of codes or a stratum of
+    obtener_diccionario_estratos. Defaults to all establishments.
+    :type hospitales: int, list or pl.Series, optional
+
+    :param variable_a_contar: The variable broken down by the dimensions.
+    :type variable_a_contar: str
+
+    :param agregar_glosas: If True, the labels are joined with agregar_glosas_sociodemograficas.
+    :type agregar_glosas: bool
+
+    :param cubo: A metrics cube to answer from, if it has the dimensions of the breakdown.
+    :type cubo: pl.DataFrame or pl.LazyFrame or None
+
+    :return: The breakdown, sorted by year and number of discharges.
+    :rtype: pl.DataFrame
+    """
+    agrupar_por = convertir_a_lista(dimensiones) + [variable_a_contar]
+    if hospitales is not None:
+        filtro_hospitales = pl.col("ESTABLECIMIENTO_SALUD").is_in(convertir_a_lista(hospitales))
+        df = df.filter(filtro_hospitales)
+        if cubo is not None:
+            cubo = cubo.filter(filtro_hospitales)
+
+    desglose = obtener_metricas_egresos(df, agrupar_por, cubo=cubo)
+    if isinstance(desglose, pl.LazyFrame):
+        desglose = desglose.collect(streaming=True)
+
+    orden = [columna for columna in ["ANO_EGRESO"] if columna in agrupar_por] + ["n_egresos"]
+    desglose = desglose.sort(orden, descending=True)
+
+    if agregar_glosas:
+        desglose = agregar_glosas_sociodemograficas(desglose)
+
+    return desglose
+
+
+@etapa_perfilada
+def agregar_glosas_sociodemograficas(df_desglose):
+    """
+    Joins the labels of a sociodemographic breakdown: the comuna names of the registry scheme
+    (on "COMUNA_RESIDENCIA") and the ICD-10 catalog (on "DIAG1"), both read through their
+    Parquet caches (see src.data.catalogo_cie). The labels in GLOSAS_FORMATO_TITULO are
+    converted to title case. Only the joins whose key is in the breakdown are done.
+
+    :param df_desglose: The aggregated breakdown.
+    :type df_desglose: pl.DataFrame
+
+    :return: The breakdown with its labels.
+    :rtype: pl.DataFrame
+    """
+    if "COMUNA_RESIDENCIA" in df_desglose.columns:
+        tipo_comuna = df_desglose.schema["COMUNA_RESIDENCIA"]
+        comunas = (
+            catalogo_cie.leer_tabla_comunas()
+            .with_columns(
+                pl.col(catalogo_cie.COLUMNA_CODIGO_COMUNA)
+                .cast(tipo_comuna, strict=False)
+                .alias("COMUNA_RESIDENCIA")
+            )
+            .drop([catalogo_cie.COLUMNA_CODIGO_COMUNA, catalogo_cie.COLUMNA_CODIGO_REGION])
+            .unique(subset="COMUNA_RESIDENCIA")
+        )
+        df_desglose = df_desglose.join(comunas, how="left", on="COMUNA_RESIDENCIA")
+
+    if "DIAG1" in df_desglose.columns:
+        df_desglose = leer_y_unir_cie(
+            df_desglose.with_columns(pl.col("DIAG1").cast(pl.Utf8))
+        ).drop("Código")
+
+    glosas = [columna for columna in GLOSAS_FORMATO_TITULO if columna in df_desglose.columns]
+
+    return df_desglose.with_columns(pl.col(glosas).cast(pl.Utf8).str.to_titlecase())
+
+
+@etapa_perfilada
+def obtener_diccionario_estratos(
+    df_nacional,
+    hospital_interno,
+    ruta_config_estratos=None,
+    ruta_cache=None,
+    version_datos=None,
+):
     """
     Function that obtains a dictionary of hospitals belonging to different Chilean strata.
     The strata are: Public Hospitals and Private Hospitals. Additionally, it includes
     national hospital codes, 'grd' hospitals, and the hospital being analyzed in the ranking.
 
+    The membership of every stratum is derived from a single aggregation over the
+    establishments. User-defined strata can be added with a config file (see
+    leer_config_estratos), and the resulting establishment -> strata index can be cached on
+    disk, keyed by the version of the source data.
+
     :param df_nacional: The input DataFrame containing national hospital data.
-    :type df_nacional: pl.DataFrame
+    :type df_nacional: pl.DataFrame or pl.LazyFrame
 
     :param hospital_interno: The ID of the internal hospital to analyze.
     :type hospital_interno: int
 
+    :param ruta_config_estratos: Path of a YAML or JSON file with user-defined strata.
+    :type ruta_config_estratos: str, optional
+
+    :param ruta_cache: Directory where the establishment -> strata index is cached.
+    :type ruta_cache: str, optional
+
+    :param version_datos: Version key of the source data (see calcular_version_datos).
+    Required to use the cache.
+    :type version_datos: str, optional
+
     :return: A dictionary of hospitals belonging to different strata.
     :rtype: dict
     """
-    df_publicos = df_nacional.filter(pl.col("PERTENENCIA_ESTABLECIMIENTO_SALUD") == PERTENECE_SNSS)
-    df_privados = df_nacional.filter(
-        (pl.col("PERTENENCIA_ESTABLECIMIENTO_SALUD") == NO_PERTENECE_SNSS)
-        | (pl.col("ESTABLECIMIENTO_SALUD") == hospital_interno)
-    )
+    config_estratos = leer_config_estratos(ruta_config_estratos) if ruta_config_estratos else {}
 
-    codigos_nacionales = (
-        df_nacional.select(pl.col("ESTABLECIMIENTO_SALUD")).unique().collect(streaming=True)
-    )
-    codigos_publicos = (
-        df_publicos.select(pl.col("ESTABLECIMIENTO_SALUD")).unique().collect(streaming=True)
-    )
-    codigos_privados = (
-        df_privados.select(pl.col("ESTABLECIMIENTO_SALUD")).unique().collect(streaming=True)
-    )
+    ruta_indice = None
+    if ruta_cache is not None and version_datos is not None:
+        clave = json.dumps(
+            [VERSION_INDICE_ESTRATOS, version_datos, hospital_interno, config_estratos],
+            sort_keys=True,
+        )
+        clave = hashlib.sha256(clave.encode()).hexdigest()[:16]
+        ruta_indice = Path(ruta_cache) / f"indice_estratos_{clave}.parquet"
+
+    if ruta_indice is not None and ruta_indice.exists():
+        indice_estratos = pl.read_parquet(ruta_indice)
+    else:
+        indice_estratos = obtener_indice_estratos(df_nacional, hospital_interno, config_estratos)
+        if ruta_indice is not None:
+            ruta_indice.parent.mkdir(parents=True, exist_ok=True)
+            indice_estratos.write_parquet(ruta_indice)
+
+    def codigos_estrato(estrato):
+        return indice_estratos.filter(pl.col("estrato") == estrato).get_column(
+            "ESTABLECIMIENTO_SALUD"
+        )
 
     diccionario_estratos = {
-        "nacionales": codigos_nacionales.to_series(),
-        "publicos": codigos_publicos.to_series(),
-        "privados": codigos_privados.to_series(),
+        "nacionales": codigos_estrato("nacionales"),
+        "publicos": codigos_estrato("publicos"),
+        "privados": codigos_estrato("privados"),
         "grd": HOSPITALES_GRD,
         "interno": [hospital_interno],
+        **{estrato: codigos_estrato(estrato) for estrato in config_estratos},
     }
 
     return diccionario_estratos
 
 
+def obtener_indice_estratos(df_nacional, hospital_interno, config_estratos):
+    """
+    Obtain the establishment -> strata index from a single scan of the national data: the
+    condition of every stratum is evaluated on the distinct combinations of attributes of every
+    establishment, and an establishment belongs to a stratum if any of its combinations meets it
+    (ej: an establishment that left the SNSS is both public and private).
+
+    :param df_nacional: The input DataFrame containing national hospital data.
+    :type df_nacional: pl.DataFrame or pl.LazyFrame
+
+    :param hospital_interno: The ID of the internal hospital to analyze.
+    :type hospital_interno: int
+
+    :param config_estratos: The user-defined strata (see leer_config_estratos).
+    :type config_estratos: dict
+
+    :return: A long DataFrame with the columns ESTABLECIMIENTO_SALUD and estrato.
+    :rtype: pl.DataFrame
+    """
+    es_publico = pl.col("PERTENENCIA_ESTABLECIMIENTO_SALUD").cast(pl.Utf8) == PERTENECE_SNSS
+    es_privado = pl.col("PERTENENCIA_ESTABLECIMIENTO_SALUD").cast(pl.Utf8) == NO_PERTENECE_SNSS
+    condiciones = {
+        "nacionales": pl.lit(True),
+        "publicos": es_publico,
+        "privados": es_privado | (pl.col("ESTABLECIMIENTO_SALUD") == hospital_interno),
+    }
+
+    for estrato, definicion in config_estratos.items():
+        if "codigos" in definicion:
+            condiciones[estrato] = pl.col("ESTABLECIMIENTO_SALUD").is_in(definicion["codigos"])
+        else:
+            condiciones[estrato] = pl.col(definicion["columna"]).is_in(definicion["valores"])
+
+    columnas_config = [
+        definicion["columna"] for definicion in config_estratos.values() if "columna" in definicion
+    ]
+    atributos = [
+        columna
+        for columna in dict.fromkeys(ATRIBUTOS_ESTABLECIMIENTO + columnas_config)
+        if columna in df_nacional.columns
+    ]
+
+    # Las condiciones se evaluan en cada combinacion distinta de atributos de un establecimiento:
+    # uno cuyos atributos cambian entre anios pertenece a todos los estratos en que estuvo
+    establecimientos = (
+        df_nacional.lazy()
+        .select(["ESTABLECIMIENTO_SALUD"] + atributos)
+        .unique()
+        .groupby("ESTABLECIMIENTO_SALUD")
+        .agg(
+            [
+                condicion.fill_null(False).any().alias(estrato)
+                for estrato, condicion in condiciones.items()
+            ]
+        )
+        .sort("ESTABLECIMIENTO_SALUD")
+        .collect(streaming=True)
+    )
+
+    indice_estratos = pl.concat(
+        [
+            establecimientos.filter(pl.col(estrato)).select(
+                pl.col("ESTABLECIMIENTO_SALUD"), pl.lit(estrato).alias("estrato")
+            )
+            for estrato in condiciones
+        ]
+    )
+
+    return indice_estratos
+
+
+def leer_config_estratos(ruta_config_estratos):
+    """
+    Read user-defined strata from a YAML or JSON file. Every stratum is defined either by an
+    explicit list of establishment codes, or by an establishment attribute and the values it
+    must take. For example:
+
+        estratos:
+          servicio_metropolitano_oriente:
+            columna: SERVICIO_DE_SALUD
+            valores: [11]
+          alta_complejidad:
+            codigos: [112103, 109101]
+
+    :param ruta_config_estratos: Path of the YAML (.yaml, .yml) or JSON file.
+    :type ruta_config_estratos: str
+
+    :return: A dictionary of stratum name -> definition.
+    :rtype: dict
+    """
+    with open(ruta_config_estratos, encoding="utf-8") as archivo:
+        if Path(ruta_config_estratos).suffix in (".yaml", ".yml"):
+            config = yaml.safe_load(archivo)
+        else:
+            config = json.load(archivo)
+
+    config_estratos = config.get("estratos", config)
+    for estrato, definicion in config_estratos.items():
+        if "codigos" not in definicion and not {"columna", "valores"} <= set(definicion):
+            raise ValueError(
+                f"El estrato {estrato} debe definir 'codigos' o 'columna' y 'valores'"
+            )
+
+    return config_estratos
+
+
+def calcular_version_datos(ruta_datos):
+    """
+    Compute a version key of the source data, to invalidate caches when it changes. If the path
+    is a Parquet dataset with a manifest, the manifest is hashed. Otherwise, the version is
+    derived from the path, size and modification time of the matching files.
+
+    :param ruta_datos: A file, a directory or a glob pattern of the source data.
+    :type ruta_datos: str
+
+    :return: The version key.
+    :rtype: str
+    """
+    ruta_manifiesto = Path(ruta_datos) / "manifiesto_egresos.json"
+    if ruta_manifiesto.exists():
+        return hashlib.sha256(ruta_manifiesto.read_bytes()).hexdigest()
+
+    if os.path.isdir(ruta_datos):
+        archivos = glob.glob(f"{ruta_datos}/**/*.*", recursive=True)
+    else:
+        archivos = glob.glob(ruta_datos)
+
+    firma = [
+        (archivo, os.path.getsize(archivo), os.path.getmtime(archivo))
+        for archivo in sorted(archivos)
+    ]
+
+    return hashlib.sha256(json.dumps(firma).encode()).hexdigest()
+
+
 def obtener_metricas_para_un_estrato(df, glosa_estrato, variable_analisis, subgrupo_del_ranking):
     """
     Obtain metrics for a specific stratum in the DataFrame based on the analysis variable
@@ -226,6 +1159,7 @@ def obtener_metricas_para_un_estrato(df, glosa_estrato, variable_analisis, subgr
     return resumen
 
 
+@etapa_perfilada
 def obtener_resumen_por_estratos(df, dict_estratos, variables_a_rankear, subgrupo_del_ranking):
     """
     Obtain a summary of metrics for different strata in the DataFrame based on the provided
@@ -277,70 +1211,300 @@ def left_join_consecutivo(left, right):
     return left.join(right, how="left", on=UNIR_EN)
 
 
-def leer_y_unir_cie(df_a_unir):
+@etapa_perfilada
+def leer_y_unir_cie(df_a_unir, ruta_cie=catalogo_cie.ARCHIVO_CIE):
     """This is a function that reads and joins the ICD-10 dictionary to a dataframe.
-    The column to join must be called "DIAG1"
+    The column to join must be called "DIAG1". The dictionary is read through its Parquet cache
+    (see src.data.catalogo_cie), so the workbook is only parsed when it changes.
 
     Args:
-        df_a_unir (DataFrame): The DataFrame to join the ICD-10 dictionary
+        df_a_unir (DataFrame or LazyFrame): The DataFrame to join the ICD-10 dictionary
+        ruta_cie (str or Path): The path of the ICD-10 workbook (by default, the one in
+            data/external)
 
     Returns:
-        DataFrame: The DataFrame with the joined ICD-10 dictionary
+        DataFrame or LazyFrame: The DataFrame with the joined ICD-10 dictionary
     """
-    cie = pl.read_excel("../data/external/CIE-10 - sin_puntos_y_X.xlsx").with_columns(
-        pl.col("Código").alias("DIAG1")
-    )
+    cie = catalogo_cie.leer_catalogo_cie(ruta_cie).with_columns(pl.col("Código").alias("DIAG1"))
+    if isinstance(df_a_unir, pl.LazyFrame):
+        cie = cie.lazy()
+
     df_unida = df_a_unir.join(cie, how="left", on="DIAG1")
 
     return df_unida
 
 
+@etapa_perfilada
+def calcular_ranking_estratos(
+    df_metricas, dict_estratos, variables_a_rankear, subgrupo_del_ranking
+):
+    """
+    Compute the ranking, total and share of every stratum and every ranking variable in a single
+    lazy plan. Instead of filtering the metrics once per stratum and joining the results, every
+    stratum gets a membership flag, and the windows are partitioned by the ranking subgroup plus
+    that flag. Rows outside a stratum get nulls in its columns, as the previous left joins did.
+
+    As before, the "interno" stratum is ranked within the subgroup without "DIAG1" (the
+    subgroup list passed in is not modified).
+
+    :param df_metricas: The metrics per establishment (see obtener_metricas_egresos).
+    :type df_metricas: pl.DataFrame or pl.LazyFrame
+
+    :param dict_estratos: A dictionary containing the strata and their respective hospital codes.
+    :type dict_estratos: dict
+
+    :param variables_a_rankear: The variables to rank (ej: ["n_egresos"]).
+    :type variables_a_rankear: list
+
+    :param subgrupo_del_ranking: The subgroup for ranking (ej: ["ANO_EGRESO", "DIAG1"]).
+    :type subgrupo_del_ranking: list
+
+    :return: The metrics with the columns ranking_{estrato}_{variable},
+    total_{estrato}_{variable} and %_{estrato}_{variable}, in the same type as the input.
+    :rtype: pl.DataFrame or pl.LazyFrame
+    """
+    df = df_metricas.lazy().with_columns(
+        [
+            pl.col("ESTABLECIMIENTO_SALUD").is_in(list(codigos)).alias(f"__en_{glosa_estrato}")
+            for glosa_estrato, codigos in dict_estratos.items()
+        ]
+    )
+
+    columnas_ranking = []
+    for variable_analisis in variables_a_rankear:
+        for glosa_estrato in dict_estratos:
+            en_estrato = pl.col(f"__en_{glosa_estrato}")
+            subgrupo = list(subgrupo_del_ranking)
+            if glosa_estrato == "interno":
+                subgrupo.remove("DIAG1")
+            particion = subgrupo + [f"__en_{glosa_estrato}"]
+
+            sufijo_cols = f"_{glosa_estrato}_{variable_analisis}"
+            columnas_ranking += [
+                pl.when(en_estrato)
+                .then(
+                    pl.col(variable_analisis).rank(method="min", descending=True).over(particion)
+                )
+                .alias(f"ranking{sufijo_cols}"),
+                pl.when(en_estrato)
+                .then(pl.col(variable_analisis).sum().over(particion))
+                .alias(f"total{sufijo_cols}"),
+            ]
+
+    columnas_porcentaje = [
+        (pl.col(variable_analisis) / pl.col(f"total_{glosa_estrato}_{variable_analisis}")).alias(
+            f"%_{glosa_estrato}_{variable_analisis}"
+        )
+        for variable_analisis in variables_a_rankear
+        for glosa_estrato in dict_estratos
+    ]
+
+    resumen = (
+        df.with_columns(columnas_ranking)
+        .with_columns(columnas_porcentaje)
+        .drop([f"__en_{glosa_estrato}" for glosa_estrato in dict_estratos])
+    )
+
+    return resumen.collect() if isinstance(df_metricas, pl.DataFrame) else resumen
+
+
+def obtener_columnas_ranking(dict_estratos, variables_a_rankear):
+    """Obtiene el nombre de las columnas de ranking, total y % de cada variable y estrato"""
+    return [
+        f"{prefijo}_{glosa_estrato}_{variable_analisis}"
+        for variable_analisis in variables_a_rankear
+        for glosa_estrato in dict_estratos
+        for prefijo in ("ranking", "total", "%")
+    ]
+
+
+@etapa_perfilada
 def agregar_ranking_estratos(
     df_metricas,
     estratos_a_analizar,
     vars_a_ocupar_para_rankear,
     vars_para_agrupar_en_ranking,
 ):
-    metricas_por_estrato = obtener_resumen_por_estratos(
+    ranking_nacional = calcular_ranking_estratos(
         df_metricas,
         estratos_a_analizar,
         vars_a_ocupar_para_rankear,
         vars_para_agrupar_en_ranking,
     )
 
-    orden_final_cols = [
-        "ANO_EGRESO",
-        "ESTABLECIMIENTO_SALUD",
-        "GLOSA_ESTABLECIMIENTO_SALUD",
-        "Capítulo",
-        "Sección",
-        "Categoría",
-        "Descripción",
-        "DIAG1",
-        "n_egresos",
-        "dias_estada_totales",
-        "n_int_q",
-        "n_muertos",
-        "n_pacientes_distintos",
-        "ranking_nacionales_n_egresos",
-        "total_nacionales_n_egresos",
-        "%_nacionales_n_egresos",
-        "ranking_publicos_n_egresos",
-        "total_publicos_n_egresos",
-        "%_publicos_n_egresos",
-        "ranking_privados_n_egresos",
-        "total_privados_n_egresos",
-        "%_privados_n_egresos",
-        "ranking_grd_n_egresos",
-        "total_grd_n_egresos",
-        "%_grd_n_egresos",
-        "ranking_interno_n_egresos",
-        "total_interno_n_egresos",
-        "%_interno_n_egresos",
-    ]
+    orden_final_cols = COLUMNAS_BASE_RANKING + obtener_columnas_ranking(
+        estratos_a_analizar, vars_a_ocupar_para_rankear
+    )
 
-    ranking_nacional = reduce(left_join_consecutivo, metricas_por_estrato.values())
     ranking_nacional_con_cie = leer_y_unir_cie(ranking_nacional)
     ranking_nacional_con_cie = ranking_nacional_con_cie.select(orden_final_cols)
 
     return ranking_nacional_con_cie
+
+
+@etapa_perfilada
+def actualizar_cubo_metricas(
+    df, ruta_cubo, anios_modificados, error_pacientes_distintos=ERROR_PACIENTES_CUBO
+):
+    """
+    Refreshes a persisted metrics cube only for the years with new, changed or deleted input
+    files (ej: the "anios_modificados" returned by exportar_egresos_parquet_incremental). The
+    rows of the other years are kept as they are. If there is no cube yet, or it was built with
+    another sketch precision, the whole cube is rebuilt.
+
+    The categorical columns of the stored cube and of df must share a string cache, so this
+    should be called inside pl.StringCache().
+
+    :param df: The hospital discharge data table, with at least the modified years.
+    :type df: pl.DataFrame or pl.LazyFrame
+
+    :param ruta_cubo: The path of the cube (see guardar_cubo_metricas).
+    :type ruta_cubo: str or Path
+
+    :param anios_modificados: The years to recompute.
+    :type anios_modificados: list
+
+    :param error_pacientes_distintos: The relative standard error of the distinct patient
+    sketches.
+    :type error_pacientes_distintos: float
+
+    :return: The refreshed metrics cube.
+    :rtype: pl.DataFrame
+    """
+    ruta_cubo = Path(ruta_cubo)
+    if ruta_cubo.suffix != ".parquet":
+        ruta_cubo = ruta_cubo / ARCHIVO_CUBO_METRICAS
+
+    precision = hyperloglog.calcular_precision_hll(error_pacientes_distintos)
+    cubo_previo = pl.read_parquet(ruta_cubo) if ruta_cubo.exists() else None
+
+    if cubo_previo is None or set(cubo_previo[COLUMNA_PRECISION_SKETCH].unique()) - {precision}:
+        cubo = construir_cubo_metricas(df, error_pacientes_distintos)
+    else:
+        en_anios_modificados = pl.col("ANO_EGRESO").is_in(list(anios_modificados))
+        cubo_anios_modificados = construir_cubo_metricas(
+            df.filter(en_anios_modificados), error_pacientes_distintos
+        )
+        if isinstance(cubo_anios_modificados, pl.LazyFrame):
+            cubo_anios_modificados = cubo_anios_modificados.collect()
+
+        cubo = pl.concat(
+            [
+                cubo_previo.filter(~en_anios_modificados),
+                cubo_anios_modificados.select(cubo_previo.columns),
+            ]
+        )
+
+    if isinstance(cubo, pl.LazyFrame):
+        cubo = cubo.collect()
+
+    guardar_cubo_metricas(cubo, ruta_cubo)
+
+    return cubo
+
+
+@etapa_perfilada
+def actualizar_ranking_estratos(
+    df_metricas,
+    ranking_previo,
+    anios_modificados,
+    estratos_a_analizar,
+    vars_a_ocupar_para_rankear,
+    vars_para_agrupar_en_ranking,
+    calcular_ranking=agregar_ranking_estratos,
+):
+    """
+    Refreshes a stratum ranking only for the modified years. The rankings are partitioned by
+    the ranking subgroup, so when it includes "ANO_EGRESO" a new year never changes the ranks of
+    the previous ones, and the rows of the other years are kept from the previous ranking.
+
+    :param df_metricas: The metrics per establishment, with at least the modified years.
+    :type df_metricas: pl.DataFrame or pl.LazyFrame
+
+    :param ranking_previo: The ranking computed before the new data landed.
+    :type ranking_previo: pl.DataFrame
+
+    :param anios_modificados: The years to recompute.
+    :type anios_modificados: list
+
+    :param estratos_a_analizar: A dictionary containing the strata and their hospital codes.
+    :type estratos_a_analizar: dict
+
+    :param vars_a_ocupar_para_rankear: The variables to rank.
+    :type vars_a_ocupar_para_rankear: list
+
+    :param vars_para_agrupar_en_ranking: The subgroup for ranking. Must include "ANO_EGRESO".
+    :type vars_para_agrupar_en_ranking: list
+
+    :param calcular_ranking: The function that computes the ranking (agregar_ranking_estratos
+    or calcular_ranking_estratos).
+    :type calcular_ranking: function
+
+    :raises ValueError: If the ranking subgroup does not include "ANO_EGRESO".
+
+    :return: The refreshed ranking.
+    :rtype: pl.DataFrame
+    """
+    if "ANO_EGRESO" not in vars_para_agrupar_en_ranking:
+        raise ValueError(
+            "El ranking solo se puede actualizar por anio si el subgrupo incluye ANO_EGRESO: "
+            f"{vars_para_agrupar_en_ranking}"
+        )
+
+    en_anios_modificados = pl.col("ANO_EGRESO").is_in(list(anios_modificados))
+    ranking_anios_modificados = calcular_ranking(
+        df_metricas.filter(en_anios_modificados),
+        estratos_a_analizar,
+        vars_a_ocupar_para_rankear,
+        vars_para_agrupar_en_ranking,
+    )
+    if isinstance(ranking_anios_modificados, pl.LazyFrame):
+        ranking_anios_modificados = ranking_anios_modificados.collect()
+
+    ranking = pl.concat(
+        [
+            ranking_previo.filter(~en_anios_modificados),
+            ranking_anios_modificados.select(ranking_previo.columns),
+        ]
+    )
+
+    return ranking
+
+
+def verificar_consistencia_incremental(resultado_incremental, resultado_completo):
+    """
+    Checks that a result refreshed incrementally (actualizar_cubo_metricas,
+    actualizar_ranking_estratos) matches the same result rebuilt from scratch. Rows are compared
+    regardless of their order, sketches regardless of the order of their registers, and NaN
+    values as nulls.
+
+    :param resultado_incremental: The result refreshed incrementally.
+    :type resultado_incremental: pl.DataFrame or pl.LazyFrame
+
+    :param resultado_completo: The result rebuilt from scratch.
+    :type resultado_completo: pl.DataFrame or pl.LazyFrame
+
+    :raises AssertionError: If both results differ.
+    """
+    resultados = []
+    for resultado in (resultado_incremental, resultado_completo):
+        if isinstance(resultado, pl.LazyFrame):
+            resultado = resultado.collect()
+
+        columnas_lista = [
+            columna for columna, tipo in resultado.schema.items() if tipo.base_type() == pl.List
+        ]
+        # Los NaN (ej: porcentajes 0 / 0) se comparan como nulos, NaN no es igual a NaN
+        resultado = resultado.with_columns(
+            pl.col(columnas_lista).list.sort(), pl.col(pl.FLOAT_DTYPES).fill_nan(None)
+        )
+        columnas_orden = [
+            columna for columna in resultado.columns if columna not in columnas_lista
+        ]
+        resultados.append(resultado.sort(columnas_orden, nulls_last=True))
+
+    incremental, completo = resultados
+    if set(incremental.columns) != set(completo.columns) or not incremental.select(
+        completo.columns
+    ).frame_equal(completo, null_equal=True):
+        raise AssertionError("El resultado incremental difiere de la reconstruccion completa")
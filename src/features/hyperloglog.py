@@ -0,0 +1,228 @@
+"""
+This module implements HyperLogLog sketches with Polars expressions, used to approximate the
+number of distinct patients per group without keeping a hash set of every patient.
+
+A sketch is stored as a sparse list of UInt32 values, one per non-empty register, encoding
+registro * 64 + rho (rho is the position of the first 1 bit of the hash after the register bits).
+Sketches are mergeable: the union of two groups keeps the max rho per register, so coarser
+levels (year, region, stratum) can be obtained from finer ones without re-scanning the patients.
+That is what the sketches are for: on small groups they are slower to build than an exact count.
+
+The hashes come from Expr.hash, which is stable within a Polars version. Sketches persisted with
+one version of Polars should not be merged with sketches built with another one.
+
+Module Constants:
+    - PRECISION_MINIMA: The minimum number of register bits.
+    - PRECISION_MAXIMA: The maximum number of register bits.
+    - SEMILLA_HASH: The seed used to hash the values.
+    - BASE_CODIFICACION: The base used to pack the register and rho in a single integer.
+
+Module Functions:
+    - calcular_precision_hll: Obtains the number of register bits for a relative error.
+    - construir_sketches_hll: Builds one sketch per group from the raw values.
+    - combinar_sketches_hll: Merges the sketches of the rows into coarser groups.
+    - estimar_cardinalidad_hll: Expression that estimates the cardinality of a sketch column.
+"""
+
+import math
+
+import polars as pl
+
+
+PRECISION_MINIMA = 7
+PRECISION_MAXIMA = 16
+SEMILLA_HASH = 0
+BASE_CODIFICACION = 64
+
+
+def calcular_precision_hll(error_relativo):
+    """
+    Obtains the number of register bits (p) needed for a relative standard error. The standard
+    error of HyperLogLog is 1.04 / sqrt(2 ** p).
+
+    :param error_relativo: The relative standard error wanted (ej: 0.01 for 1%).
+    :type error_relativo: float
+
+    :return: The number of register bits, between PRECISION_MINIMA and PRECISION_MAXIMA.
+    :rtype: int
+    """
+    if not 0 < error_relativo < 1:
+        raise ValueError(f"El error relativo debe estar entre 0 y 1: {error_relativo}")
+
+    precision = math.ceil(2 * math.log2(1.04 / error_relativo))
+
+    return min(max(precision, PRECISION_MINIMA), PRECISION_MAXIMA)
+
+
+def obtener_registro_y_rho(columna, precision):
+    """
+    Obtains the expressions of the register and rho of each value of a column.
+
+    :param columna: The column with the values to count.
+    :type columna: str
+
+    :param precision: The number of register bits.
+    :type precision: int
+
+    :return: The expressions of the register (UInt32) and rho (UInt32).
+    :rtype: tuple
+    """
+    bits_restantes = 64 - precision
+    hash_valor = pl.col(columna).cast(pl.Utf8).hash(seed=SEMILLA_HASH)
+
+    registro = (hash_valor // pl.lit(2**bits_restantes, dtype=pl.UInt64)).cast(pl.UInt32)
+
+    # Resto del hash (< 2 ** 57), representable de forma exacta en Float64
+    resto = (hash_valor % pl.lit(2**bits_restantes, dtype=pl.UInt64)).cast(pl.Float64)
+    bit_mas_alto = resto.log(2).floor()
+    # Corrige el redondeo de log2 en valores justo bajo una potencia de 2
+    bit_mas_alto = (
+        pl.when(pl.lit(2.0).pow(bit_mas_alto) > resto)
+        .then(bit_mas_alto - 1)
+        .otherwise(bit_mas_alto)
+    )
+    rho = (
+        pl.when(resto > 0)
+        .then(bits_restantes - bit_mas_alto)
+        .otherwise(bits_restantes + 1)
+        .cast(pl.UInt32)
+    )
+
+    return registro, rho
+
+
+def construir_sketches_hll(df, agrupar_por, columna, precision, nombre_sketch, sumas=None):
+    """
+    Builds one HyperLogLog sketch per group from the raw values of a column.
+
+    Additive metrics of the same groups can be computed in the same pass with sumas: each one is
+    summed per group and register and then per group, which avoids a second groupby of df and
+    the join with its result.
+
+    :param df: The table with the raw values.
+    :type df: pl.DataFrame or pl.LazyFrame
+
+    :param agrupar_por: The grouping level of the sketches.
+    :type agrupar_por: list
+
+    :param columna: The column with the values to count (ej: "ID_PACIENTE").
+    :type columna: str
+
+    :param precision: The number of register bits.
+    :type precision: int
+
+    :param nombre_sketch: The name of the sketch column.
+    :type nombre_sketch: str
+
+    :param sumas: Aliased expressions of additive metrics to compute per group (ej:
+    pl.col("DIAS_ESTADA").sum().alias("dias_estada_totales")). If None, only the sketches are
+    built.
+    :type sumas: list or None
+
+    :return: A table with the grouping columns, the sumas columns and the sketch column
+    (List[UInt32]).
+    :rtype: pl.DataFrame or pl.LazyFrame
+    """
+    sumas = sumas or []
+    nombres_sumas = [suma.meta.output_name() for suma in sumas]
+    registro, rho = obtener_registro_y_rho(columna, precision)
+
+    if not sumas:
+        df = df.filter(pl.col(columna).is_not_null())
+
+    # Los valores nulos no entran al sketch, pero si a las sumas
+    codigo = pl.col("__registro") * BASE_CODIFICACION + pl.col("__rho")
+    codigo = codigo.filter(pl.col("__rho").is_not_null())
+
+    sketches = (
+        df.with_columns(
+            registro.alias("__registro"),
+            pl.when(pl.col(columna).is_not_null()).then(rho).alias("__rho"),
+        )
+        .groupby(agrupar_por + ["__registro"])
+        .agg(sumas + [pl.col("__rho").max()])
+        .groupby(agrupar_por)
+        .agg([pl.col(nombre).sum() for nombre in nombres_sumas] + [codigo.alias(nombre_sketch)])
+    )
+
+    return sketches
+
+
+def combinar_sketches_hll(df, agrupar_por, nombre_sketch):
+    """
+    Merges the sketches of the rows of a table into the groups of a coarser level. The union of
+    the sketches keeps the max rho of each register.
+
+    :param df: The table with a sketch column.
+    :type df: pl.DataFrame or pl.LazyFrame
+
+    :param agrupar_por: The grouping level of the merged sketches.
+    :type agrupar_por: list
+
+    :param nombre_sketch: The name of the sketch column.
+    :type nombre_sketch: str
+
+    :return: A table with the grouping columns and the merged sketch column.
+    :rtype: pl.DataFrame or pl.LazyFrame
+    """
+    codigo = pl.col(nombre_sketch)
+
+    sketches = (
+        df.select(agrupar_por + [nombre_sketch])
+        .explode(nombre_sketch)
+        .filter(codigo.is_not_null())
+        .groupby(agrupar_por + [(codigo // BASE_CODIFICACION).alias("__registro")])
+        .agg((codigo % BASE_CODIFICACION).max().alias("__rho"))
+        .select(
+            agrupar_por
+            + [(pl.col("__registro") * BASE_CODIFICACION + pl.col("__rho")).alias(nombre_sketch)]
+        )
+        .groupby(agrupar_por)
+        .agg(pl.col(nombre_sketch))
+    )
+
+    return sketches
+
+
+def estimar_cardinalidad_hll(nombre_sketch, precision):
+    """
+    Expression that estimates the number of distinct values of each sketch of a column. Uses the
+    HyperLogLog estimator with the linear counting correction for small cardinalities.
+
+    :param nombre_sketch: The name of the sketch column.
+    :type nombre_sketch: str
+
+    :param precision: The number of register bits used to build the sketches, or an expression
+    with them (ej: a column stored alongside the sketches).
+    :type precision: int or pl.Expr
+
+    :return: The expression of the estimated cardinality (UInt64).
+    :rtype: pl.Expr
+    """
+    if isinstance(precision, pl.Expr):
+        m = pl.lit(2.0).pow(precision.cast(pl.Float64))
+    else:
+        m = float(2**precision)
+    alfa = 0.7213 / (1 + 1.079 / m)
+
+    registros_llenos = pl.col(nombre_sketch).list.lengths().fill_null(0)
+    registros_vacios = m - registros_llenos
+    suma_llenos = (
+        pl.col(nombre_sketch)
+        .list.eval(
+            ((pl.element() % BASE_CODIFICACION).cast(pl.Float64) * -math.log(2)).exp().sum()
+        )
+        .list.first()
+        .fill_null(0.0)
+    )
+
+    estimacion_bruta = alfa * m * m / (suma_llenos + registros_vacios)
+    conteo_lineal = m * (m / registros_vacios).log()
+
+    estimacion = (
+        pl.when((estimacion_bruta <= 2.5 * m) & (registros_vacios > 0))
+        .then(conteo_lineal)
+        .otherwise(estimacion_bruta)
+    )
+
+    return estimacion.round(0).cast(pl.UInt64)
@@ -1,15 +1,31 @@
 import glob
+import os
+import re
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 
 import click
 import pandas as pd
-from pdf2image import convert_from_path
+import polars as pl
+from pdf2image import convert_from_path, pdfinfo_from_path
 from pptx import Presentation
 from pptx.dml.color import RGBColor
 from pptx.enum.text import PP_ALIGN
+from pptx.oxml import parse_xml
+from pptx.oxml.ns import nsdecls
 from pptx.util import Inches, Pt
 
-POPPLER_PATH = r"C:\Users\ppizarro\Downloads\Release-23.08.0-0\poppler-23.08.0\Library\bin"
+# Carpeta con los ejecutables de poppler (pdftoppm, pdfinfo). Si no se define, se usan los del
+# PATH (ej: el paquete poppler-utils en Linux)
+POPPLER_PATH = os.environ.get("POPPLER_PATH")
+DPI_FIGURAS = 300
+
+# Tablas de PowerPoint: estilo de tabla, filas por lote de XML y caracteres invalidos en XML
+ESTILO_TABLA = "{FABFCF23-3B69-468F-B69F-88F6DE6A72F2}"
+FILAS_POR_LOTE_XML = 250
+CARACTERES_INVALIDOS_XML = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+TIPOS_TEXTO_POLARS = (pl.Utf8, pl.Categorical)
 
 
 def add_dataframes_to_powerpoint(
@@ -85,19 +101,342 @@ def add_dataframes_to_powerpoint(
     prs.save(pptx_filename)
 
 
+def obtener_textos_columna(df, nombre_columna, max_cell_characters):
+    """
+    Obtains the texts of the cells of a column, truncated to max_cell_characters, and whether
+    the column holds text (left aligned) or numbers (right aligned).
+
+    :param df: The table, in pandas or Polars.
+    :type df: pd.DataFrame or pl.DataFrame
+
+    :param nombre_columna: The name of the column.
+    :type nombre_columna: str
+
+    :param max_cell_characters: The maximum number of characters of a cell.
+    :type max_cell_characters: int
+
+    :return: Whether the column holds text, and the texts of its cells.
+    :rtype: tuple[bool, list]
+    """
+    if isinstance(df, pl.DataFrame):
+        serie = df.get_column(nombre_columna)
+        es_texto = serie.dtype in TIPOS_TEXTO_POLARS
+        try:
+            textos = serie.cast(pl.Utf8).fill_null("").to_list()
+        except pl.ComputeError:
+            textos = [str(valor) for valor in serie.to_list()]
+    else:
+        es_texto = pd.api.types.is_string_dtype(df[nombre_columna])
+        textos = df[nombre_columna].astype(str).tolist()
+
+    textos = [
+        texto if len(texto) < max_cell_characters else f"{texto[:max_cell_characters]}..."
+        for texto in textos
+    ]
+
+    return es_texto, textos
+
+
+def construir_plantillas_columna(es_texto, font_size, font_family, encabezado=False):
+    """
+    Builds the XML before and after the text of the cells of a column, with its alignment and
+    font, as python-pptx writes them when setting them cell by cell.
+    """
+    alineacion = "l" if es_texto else "r"
+    negrita = ' b="1"' if encabezado else ""
+    color = '<a:solidFill><a:srgbClr val="FFFFFF"/></a:solidFill>' if encabezado else ""
+    prefijo = (
+        f'<a:tc><a:txBody><a:bodyPr/><a:lstStyle/><a:p><a:pPr algn="{alineacion}">'
+        f'<a:defRPr{negrita} sz="{int(round(font_size * 100))}">{color}'
+        f'<a:latin typeface="{escapar_xml(font_family)}"/></a:defRPr></a:pPr><a:r><a:t>'
+    )
+    sufijo = "</a:t></a:r></a:p></a:txBody><a:tcPr/></a:tc>"
+
+    return prefijo, sufijo
+
+
+def escapar_xml(texto):
+    """Escapa un texto para escribirlo dentro de un elemento o atributo XML"""
+    texto = CARACTERES_INVALIDOS_XML.sub("", texto)
+    return (
+        texto.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
+    )
+
+
+def agregar_filas_xml(tbl, filas_xml):
+    """Agrega las filas a la tabla, parseando el XML de FILAS_POR_LOTE_XML filas a la vez"""
+    for inicio in range(0, len(filas_xml), FILAS_POR_LOTE_XML):
+        lote = "".join(filas_xml[inicio : inicio + FILAS_POR_LOTE_XML])
+        tbl.extend(list(parse_xml(f"<a:tbl {nsdecls('a')}>{lote}</a:tbl>")))
+
+
+def add_dataframes_to_powerpoint_bulk(
+    dataframes,
+    pptx_filename,
+    font_size=12,
+    font_family="Arial",
+    max_cell_characters=50,
+    cell_width=2,
+    cell_height=1,
+    rows_per_slide=None,
+):
+    """
+    Writes tables to a PowerPoint presentation, as add_dataframes_to_powerpoint, but in bulk:
+    the alignment and font of every column are computed once, and the XML of the rows is built
+    from per-column templates and parsed in batches, instead of setting every cell through
+    python-pptx.
+
+    :param dataframes: The tables to write, one (or more, with rows_per_slide) slide each.
+    Polars tables are read directly, without converting them to pandas.
+    :type dataframes: list of pd.DataFrame or pl.DataFrame
+
+    :param pptx_filename: The path of the presentation.
+    :type pptx_filename: str or Path
+
+    :param font_size: The font size of the cells.
+    :type font_size: int
+
+    :param font_family: The font of the cells.
+    :type font_family: str
+
+    :param max_cell_characters: Longer texts are truncated and end with "...".
+    :type max_cell_characters: int
+
+    :param cell_width: The width of every table, in inches.
+    :type cell_width: float
+
+    :param cell_height: The height of every table, in inches.
+    :type cell_height: float
+
+    :param rows_per_slide: If given, longer tables are split over several slides, repeating the
+    header.
+    :type rows_per_slide: int, optional
+    """
+    prs = Presentation()
+    prs.slide_width = Inches(16)
+    prs.slide_height = Inches(9)
+
+    for df in dataframes:
+        columnas = [str(columna) for columna in df.columns]
+        n_filas = len(df)
+
+        plantillas_encabezado = []
+        plantillas_celdas = []
+        textos_columnas = []
+        for columna in df.columns:
+            es_texto, textos = obtener_textos_columna(df, columna, max_cell_characters)
+            plantillas_encabezado.append(
+                construir_plantillas_columna(es_texto, font_size, font_family, encabezado=True)
+            )
+            plantillas_celdas.append(construir_plantillas_columna(es_texto, font_size, font_family))
+            textos_columnas.append(textos)
+
+        encabezado = "".join(
+            f"{prefijo}{escapar_xml(columna)}{sufijo}"
+            for columna, (prefijo, sufijo) in zip(columnas, plantillas_encabezado)
+        )
+        celdas_filas = [
+            "".join(
+                f"{prefijo}{escapar_xml(texto)}{sufijo}"
+                for texto, (prefijo, sufijo) in zip(textos_fila, plantillas_celdas)
+            )
+            for textos_fila in zip(*textos_columnas)
+        ]
+
+        filas_por_pagina = rows_per_slide or max(n_filas, 1)
+        for inicio in range(0, max(n_filas, 1), filas_por_pagina):
+            celdas_pagina = [encabezado] + celdas_filas[inicio : inicio + filas_por_pagina]
+
+            slide = prs.slides.add_slide(prs.slide_layouts[5])
+            height = Inches(cell_height)
+            table = slide.shapes.add_table(
+                1, len(columnas), Inches(0.5), Inches(1.5), Inches(cell_width), height
+            )
+            tbl = table._element.graphic.graphicData.tbl
+            tbl[0][-1].text = ESTILO_TABLA
+            tbl.remove(tbl.tr_lst[0])
+
+            # Reparte el alto entre las filas como python-pptx (la ultima absorbe el resto)
+            alto_fila = height // len(celdas_pagina)
+            altos = [alto_fila] * (len(celdas_pagina) - 1)
+            altos.append(height - sum(altos))
+            agregar_filas_xml(
+                tbl,
+                [f'<a:tr h="{alto}">{celdas}</a:tr>' for alto, celdas in zip(altos, celdas_pagina)],
+            )
+
+    prs.save(pptx_filename)
+
+
+def obtener_ruta_png(ruta_pdf, numero_pagina, carpeta_salida):
+    """Obtiene la ruta del PNG de una pagina de un PDF (ej: figura_page1.png)"""
+    return Path(carpeta_salida) / f"{Path(ruta_pdf).stem}_page{numero_pagina}.png"
+
+
+def esta_actualizado(ruta_png, ruta_pdf):
+    """Indica si el PNG existe y es mas nuevo que el PDF del que se genero"""
+    ruta_png = Path(ruta_png)
+    return ruta_png.exists() and ruta_png.stat().st_mtime >= Path(ruta_pdf).stat().st_mtime
+
+
+def contar_paginas_pdf(ruta_pdf, poppler_path=POPPLER_PATH):
+    """Cuenta las paginas de un PDF con pdfinfo, sin renderizarlo"""
+    return pdfinfo_from_path(str(ruta_pdf), poppler_path=poppler_path)["Pages"]
+
+
+def renderizar_pagina_pdf(ruta_pdf, numero_pagina, ruta_png, dpi=DPI_FIGURAS, poppler_path=None):
+    """
+    Renders one page of a PDF to a PNG file. pdftoppm writes the file directly, so the page is
+    never loaded as an image in Python.
+
+    :param ruta_pdf: The path of the PDF.
+    :type ruta_pdf: str or Path
+
+    :param numero_pagina: The number of the page, starting at 1.
+    :type numero_pagina: int
+
+    :param ruta_png: The path of the PNG to write.
+    :type ruta_png: str or Path
+
+    :param dpi: The resolution of the PNG.
+    :type dpi: int
+
+    :param poppler_path: The folder with the poppler executables. If None, they are looked up in
+    the PATH.
+    :type poppler_path: str, optional
+
+    :return: The path of the written PNG.
+    :rtype: Path
+    """
+    ruta_png = Path(ruta_png)
+    convert_from_path(
+        str(ruta_pdf),
+        dpi=dpi,
+        first_page=numero_pagina,
+        last_page=numero_pagina,
+        fmt="png",
+        output_folder=str(ruta_png.parent),
+        output_file=ruta_png.stem,
+        single_file=True,
+        paths_only=True,
+        poppler_path=poppler_path,
+    )
+
+    return ruta_png
+
+
+def obtener_paginas_a_renderizar(archivos_pdfs, carpeta_salida, poppler_path=None, forzar=False):
+    """
+    Lists the pages to render: every page of every PDF, except the ones whose PNG is newer than
+    the PDF (unless forzar is True).
+
+    :param archivos_pdfs: The paths of the PDFs.
+    :type archivos_pdfs: list
+
+    :param carpeta_salida: The folder where the PNGs are written.
+    :type carpeta_salida: str or Path
+
+    :param poppler_path: The folder with the poppler executables.
+    :type poppler_path: str, optional
+
+    :param forzar: If True, the pages are rendered even if their PNG is up to date.
+    :type forzar: bool
+
+    :return: A list of (PDF path, page number, PNG path) tuples.
+    :rtype: list
+    """
+    paginas = []
+    for ruta_pdf in archivos_pdfs:
+        for numero_pagina in range(1, contar_paginas_pdf(ruta_pdf, poppler_path) + 1):
+            ruta_png = obtener_ruta_png(ruta_pdf, numero_pagina, carpeta_salida)
+            if forzar or not esta_actualizado(ruta_png, ruta_pdf):
+                paginas.append((ruta_pdf, numero_pagina, ruta_png))
+
+    return paginas
+
+
+def renderizar_pdfs(
+    archivos_pdfs,
+    carpeta_salida,
+    dpi=DPI_FIGURAS,
+    poppler_path=POPPLER_PATH,
+    n_procesos=None,
+    forzar=False,
+):
+    """
+    Renders every page of a list of PDFs to PNG. The pages (not the documents) are distributed
+    over a process pool, so a long PDF does not keep a single process busy, and each process
+    renders one page at a time. Pages whose PNG is newer than the PDF are skipped.
+
+    :param archivos_pdfs: The paths of the PDFs.
+    :type archivos_pdfs: list
+
+    :param carpeta_salida: The folder where the PNGs are written.
+    :type carpeta_salida: str or Path
+
+    :param dpi: The resolution of the PNGs.
+    :type dpi: int
+
+    :param poppler_path: The folder with the poppler executables. If None, they are looked up in
+    the PATH.
+    :type poppler_path: str, optional
+
+    :param n_procesos: The number of processes. Defaults to the number of cores; with 1, the
+    pages are rendered in this process.
+    :type n_procesos: int, optional
+
+    :param forzar: If True, the pages are rendered even if their PNG is up to date.
+    :type forzar: bool
+
+    :return: The paths of the written PNGs.
+    :rtype: list
+    """
+    Path(carpeta_salida).mkdir(parents=True, exist_ok=True)
+    paginas = obtener_paginas_a_renderizar(archivos_pdfs, carpeta_salida, poppler_path, forzar)
+    if not paginas:
+        return []
+
+    rutas_pdfs, numeros_paginas, rutas_pngs = zip(*paginas)
+    argumentos = [
+        rutas_pdfs,
+        numeros_paginas,
+        rutas_pngs,
+        [dpi] * len(paginas),
+        [poppler_path] * len(paginas),
+    ]
+
+    n_procesos = min(n_procesos or os.cpu_count() or 1, len(paginas))
+    if n_procesos == 1:
+        return list(map(renderizar_pagina_pdf, *argumentos))
+
+    with ProcessPoolExecutor(max_workers=n_procesos) as pool:
+        return list(pool.map(renderizar_pagina_pdf, *argumentos))
+
+
 @click.command()
 @click.argument("input_filepath", type=click.Path(exists=True))
 @click.argument("output_filepath", type=click.Path())
-def guardar_pdfs_de_ruta(input_filepath, output_filepath):
+@click.option("--dpi", type=int, default=DPI_FIGURAS, help="Resolucion de los PNG.")
+@click.option(
+    "--procesos",
+    type=int,
+    default=None,
+    help="Procesos para renderizar las paginas. Por defecto, los nucleos disponibles.",
+)
+@click.option(
+    "--poppler-path",
+    envvar="POPPLER_PATH",
+    default=None,
+    help="Carpeta con los ejecutables de poppler. Por defecto, los del PATH.",
+)
+@click.option("--forzar", is_flag=True, help="Renderiza incluso las paginas ya actualizadas.")
+def guardar_pdfs_de_ruta(input_filepath, output_filepath, dpi, procesos, poppler_path, forzar):
     print("Guardando archivos")
-    archivos_pdfs = glob.glob(f"{input_filepath}/*.pdf")
-    for input_filepath in archivos_pdfs:
-        todas_las_paginas = convert_from_path(input_filepath, poppler_path=POPPLER_PATH, dpi=300)
-
-        for i, pagina in enumerate(todas_las_paginas):
-            nombre_pdf = input_filepath.split("\\")[-1].split(".")[0]
-            nombre_archivo = f"{nombre_pdf}_page{i + 1}.png"
-            pagina.save(f"{output_filepath}/{nombre_archivo}", "PNG")
+    archivos_pdfs = sorted(glob.glob(f"{input_filepath}/*.pdf"))
+    rutas_pngs = renderizar_pdfs(
+        archivos_pdfs, output_filepath, dpi, poppler_path, procesos, forzar
+    )
+    print(f"{len(rutas_pngs)} paginas renderizadas de {len(archivos_pdfs)} archivos")
 
 
 if __name__ == "__main__":
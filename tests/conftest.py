@@ -0,0 +1,37 @@
+import polars as pl
+import pytest
+
+from src.benchmarks.generar_egresos_sinteticos import generar_egresos_sinteticos
+from src.data.make_dataset import leer_egresos_deis
+
+# Base sintetica pequena, con campos vacios entre comillas ("") como las del DEIS
+FILAS_EGRESOS_PRUEBA = 4_000
+ANIOS_EGRESOS_PRUEBA = [2018, 2019]
+
+
+@pytest.fixture(scope="session", autouse=True)
+def cache_global_categoricos():
+    """Cache global de textos, para combinar categoricos creados en distintas pruebas"""
+    pl.enable_string_cache(True)
+    yield
+    pl.enable_string_cache(False)
+
+
+@pytest.fixture(scope="session")
+def carpeta_egresos(tmp_path_factory):
+    """Carpeta con un CSV DEIS sintetico por anio"""
+    carpeta = tmp_path_factory.mktemp("egresos")
+    generar_egresos_sinteticos(carpeta, FILAS_EGRESOS_PRUEBA, anios=ANIOS_EGRESOS_PRUEBA)
+
+    return carpeta
+
+
+@pytest.fixture(scope="session")
+def egresos(carpeta_egresos):
+    """Egresos procesados de la base sintetica"""
+    return leer_egresos_deis(carpeta_egresos).collect()
+
+
+def normalizar_categoricos(df):
+    """Convierte los categoricos a texto, para comparar tablas con distintos diccionarios"""
+    return df.with_columns(pl.col(pl.Categorical).cast(pl.Utf8))
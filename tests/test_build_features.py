@@ -0,0 +1,320 @@
+from datetime import date
+from functools import reduce
+
+import polars as pl
+import pytest
+from polars.testing import assert_frame_equal
+
+from src.data.make_dataset import DIAS_POR_ANO, agregar_categorizacion_edad
+from src.features.build_features import (
+    DIAS_ESTADA_MAXIMA,
+    NO_PERTENECE_SNSS,
+    PERTENECE_SNSS,
+    METRICAS_ADITIVAS,
+    UNIR_EN,
+    actualizar_cubo_metricas,
+    actualizar_ranking_estratos,
+    calcular_ranking_estratos,
+    construir_cubo_metricas,
+    left_join_consecutivo,
+    marcar_reingresos,
+    obtener_columnas_ranking,
+    obtener_desglose_sociodemografico,
+    obtener_diccionario_estratos,
+    obtener_dimensiones_cubo,
+    obtener_indice_estratos,
+    obtener_metricas_bandas_edad,
+    obtener_metricas_cohortes,
+    obtener_metricas_egresos,
+    obtener_resumen_por_estratos,
+    obtener_resumen_procedimientos,
+    verificar_consistencia_incremental,
+)
+
+# Metricas por anio, establecimiento y diagnostico, como las que se rankean
+AGRUPACION_METRICAS = [
+    "ANO_EGRESO",
+    "ESTABLECIMIENTO_SALUD",
+    "GLOSA_ESTABLECIMIENTO_SALUD",
+    "DIAG1",
+]
+SUBGRUPO_RANKING = ["ANO_EGRESO", "DIAG1"]
+VARIABLES_RANKING = ["n_egresos", "dias_estada_totales", "n_muertos"]
+# Anio que se reemplaza en las pruebas de actualizacion incremental
+ANIO_MODIFICADO = 2019
+
+
+@pytest.fixture(scope="module")
+def metricas(egresos):
+    """Metricas de los egresos sinteticos, al nivel de UNIR_EN"""
+    return obtener_metricas_egresos(egresos, AGRUPACION_METRICAS).lazy().collect()
+
+
+@pytest.fixture(scope="module")
+def dict_estratos(egresos, metricas):
+    """Estratos, con el establecimiento con mas egresos como hospital interno"""
+    hospital_interno = metricas.sort("n_egresos", descending=True)["ESTABLECIMIENTO_SALUD"][0]
+    return obtener_diccionario_estratos(egresos, hospital_interno)
+
+
+def obtener_estrato(egresos):
+    """Primer estrato de obtener_diccionario_estratos (una pl.Series de codigos)"""
+    dict_estratos = obtener_diccionario_estratos(egresos, egresos["ESTABLECIMIENTO_SALUD"][0])
+    return next(iter(dict_estratos.values()))
+
+
+def test_resumen_procedimientos_acepta_estrato(egresos):
+    estrato = obtener_estrato(egresos)
+    with pl.StringCache():
+        resumen = obtener_resumen_procedimientos(egresos, hospitales=estrato).collect()
+        esperado = obtener_resumen_procedimientos(egresos, hospitales=estrato.to_list()).collect()
+
+    assert isinstance(estrato, pl.Series)
+    assert resumen.height > 0
+    assert resumen.frame_equal(esperado)
+
+
+def test_desglose_sociodemografico_acepta_estrato(egresos):
+    estrato = obtener_estrato(egresos)
+    dimensiones = ["ANO_EGRESO", "SEXO"]
+    with pl.StringCache():
+        desglose = obtener_desglose_sociodemografico(
+            egresos.lazy(), dimensiones, hospitales=estrato, agregar_glosas=False
+        )
+        esperado = obtener_desglose_sociodemografico(
+            egresos.lazy(), dimensiones, hospitales=estrato.to_list(), agregar_glosas=False
+        )
+
+    assert desglose.height > 0
+    assert desglose.frame_equal(esperado)
+
+
+def test_reingresos_ignoran_estadas_invalidas():
+    episodios = pl.DataFrame(
+        {
+            "ID_PACIENTE": ["A", "A", "B", "B", "C", "C", "D"],
+            "FECHA_EGRESO": [
+                date(2020, 1, 10),
+                date(2020, 1, 20),
+                date(2020, 2, 1),
+                date(2020, 2, 11),
+                date(2020, 3, 1),
+                date(2020, 3, 11),
+                date(2021, 1, 1),
+            ],
+            "DIAS_ESTADA": [2, -3, 2, DIAS_ESTADA_MAXIMA + 1, 2, 5, 1],
+            "CONDICION_EGRESO": [0, 0, 0, 0, 0, 0, 0],
+        }
+    )
+
+    marcados = marcar_reingresos(episodios).sort(["ID_PACIENTE", "FECHA_EGRESO"])
+
+    # Solo el segundo episodio de C, con estada valida, es un reingreso del primero
+    assert marcados["REINGRESO_30D"].to_list() == [False, False, False, False, True, False, False]
+    assert marcados["EN_RIESGO_30D"].to_list() == [True, False, True, False, True, True, False]
+    assert marcados["FECHA_INGRESO"].null_count() == 2
+
+
+def obtener_ranking_estratos_legado(
+    df_metricas, dict_estratos, variables_a_rankear, subgrupo_del_ranking
+):
+    """
+    Ranking de estratos con el enfoque anterior a calcular_ranking_estratos: un filtro por estrato
+    y una cadena de left joins en UNIR_EN. Solo entrega el ranking de la ultima variable.
+    """
+    metricas_por_estrato = obtener_resumen_por_estratos(
+        df_metricas,
+        dict_estratos,
+        variables_a_rankear,
+        list(subgrupo_del_ranking),
+    )
+
+    return reduce(left_join_consecutivo, metricas_por_estrato.values())
+
+
+def test_ranking_estratos_igual_al_legado(metricas, dict_estratos):
+    # El enfoque anterior siempre rankeaba por "n_egresos"
+    variables_a_rankear = ["n_egresos"]
+    columnas = UNIR_EN + obtener_columnas_ranking(dict_estratos, variables_a_rankear)
+
+    ranking_legado = obtener_ranking_estratos_legado(
+        metricas, dict_estratos, variables_a_rankear, SUBGRUPO_RANKING
+    )
+    ranking = calcular_ranking_estratos(
+        metricas, dict_estratos, variables_a_rankear, SUBGRUPO_RANKING
+    )
+
+    assert "interno" in dict_estratos
+    assert_frame_equal(
+        ranking_legado.select(columnas).sort(AGRUPACION_METRICAS),
+        ranking.select(columnas).sort(AGRUPACION_METRICAS),
+        check_dtype=False,
+    )
+
+
+def obtener_version_previa(egresos):
+    """Egresos antes de que llegara la version final del anio modificado (la mitad de sus filas)"""
+    es_anio_modificado = pl.col("ANO_EGRESO") == ANIO_MODIFICADO
+    return pl.concat(
+        [
+            egresos.filter(~es_anio_modificado),
+            egresos.filter(es_anio_modificado).head(egresos.height // 4),
+        ]
+    )
+
+
+def test_actualizar_cubo_igual_a_reconstruccion(egresos, tmp_path):
+    ruta_cubo = tmp_path / "cubo.parquet"
+    with pl.StringCache():
+        actualizar_cubo_metricas(obtener_version_previa(egresos), ruta_cubo, [])
+        cubo_incremental = actualizar_cubo_metricas(egresos, ruta_cubo, [ANIO_MODIFICADO])
+        cubo_completo = construir_cubo_metricas(egresos)
+
+        verificar_consistencia_incremental(cubo_incremental, cubo_completo)
+        with pytest.raises(AssertionError):
+            verificar_consistencia_incremental(
+                construir_cubo_metricas(obtener_version_previa(egresos)), cubo_completo
+            )
+
+
+def test_actualizar_ranking_igual_a_reconstruccion(egresos, metricas, dict_estratos):
+    metricas_previas = obtener_metricas_egresos(
+        obtener_version_previa(egresos), AGRUPACION_METRICAS
+    ).lazy().collect()
+    argumentos_ranking = (dict_estratos, VARIABLES_RANKING, SUBGRUPO_RANKING)
+
+    ranking_previo = calcular_ranking_estratos(metricas_previas, *argumentos_ranking)
+    ranking_incremental = actualizar_ranking_estratos(
+        metricas,
+        ranking_previo,
+        [ANIO_MODIFICADO],
+        *argumentos_ranking,
+        calcular_ranking=calcular_ranking_estratos,
+    )
+    ranking_completo = calcular_ranking_estratos(metricas, *argumentos_ranking)
+
+    verificar_consistencia_incremental(ranking_incremental, ranking_completo)
+
+
+def test_estratos_consideran_atributos_de_todos_los_anios():
+    # El establecimiento 1 salio del SNSS y cambio de servicio de salud en 2019
+    egresos = pl.DataFrame(
+        {
+            "ESTABLECIMIENTO_SALUD": [1, 1, 1, 2, 3],
+            "ANO_EGRESO": [2018, 2019, 2019, 2019, 2019],
+            "PERTENENCIA_ESTABLECIMIENTO_SALUD": [
+                PERTENECE_SNSS,
+                NO_PERTENECE_SNSS,
+                None,
+                PERTENECE_SNSS,
+                NO_PERTENECE_SNSS,
+            ],
+            "SERVICIO_DE_SALUD": [11, 12, 12, 11, 13],
+        }
+    )
+    config_estratos = {"oriente": {"columna": "SERVICIO_DE_SALUD", "valores": [12]}}
+
+    indice = obtener_indice_estratos(egresos.lazy(), 2, config_estratos)
+    estratos = {
+        estrato: sorted(codigos)
+        for estrato, codigos in indice.groupby("estrato")
+        .agg(pl.col("ESTABLECIMIENTO_SALUD"))
+        .iter_rows()
+    }
+
+    assert estratos == {
+        "nacionales": [1, 2, 3],
+        "publicos": [1, 2],
+        "privados": [1, 2, 3],
+        "oriente": [1],
+    }
+
+
+def test_metricas_cohortes_igual_a_filtrar_cada_cohorte(egresos):
+    diagnosticos = egresos["DIAG1"].unique().sort().to_list()
+    # Cohortes que se traslapan, con prefijos y codigos exactos
+    cohortes = {
+        "prefijo": "S2*",
+        "prefijo_y_exactos": ["S2*"] + diagnosticos[:3],
+        "exactos": diagnosticos[1:5],
+    }
+
+    metricas = obtener_metricas_cohortes(egresos, cohortes, ["ANO_EGRESO"])
+
+    esperadas = []
+    for nombre_cohorte, codigos in cohortes.items():
+        codigos = [codigos] if isinstance(codigos, str) else codigos
+        en_cohorte = pl.any_horizontal(
+            pl.col("DIAG1").str.starts_with(codigo[:-1])
+            if codigo.endswith("*")
+            else pl.col("DIAG1") == codigo
+            for codigo in codigos
+        )
+        esperadas.append(
+            obtener_metricas_egresos(egresos.filter(en_cohorte), ["ANO_EGRESO"]).select(
+                pl.lit(nombre_cohorte).alias("COHORTE"), pl.all()
+            )
+        )
+    esperadas = pl.concat(esperadas)
+
+    orden = ["COHORTE", "ANO_EGRESO"]
+    assert_frame_equal(metricas.sort(orden), esperadas.select(metricas.columns).sort(orden))
+
+
+def test_metricas_bandas_edad_por_esquema():
+    # Un egreso por edad, en dias: neonato, nino, adolescente, justo 18 anios y adulto
+    edades_dias = [10, 5 * DIAS_POR_ANO, 16 * DIAS_POR_ANO, 18 * DIAS_POR_ANO, 40 * DIAS_POR_ANO]
+    df = pl.DataFrame(
+        {
+            "ANO_EGRESO": [2019] * 5,
+            "DIAG1": ["A00"] * 5,
+            "DIAS_ESTADA": [1, 2, 3, 4, 5],
+            "INTERV_Q": [0, 1, 0, 1, 0],
+            "CONDICION_EGRESO": [0, 0, 0, 0, 1],
+            "ID_PACIENTE": ["a", "b", "c", "d", "e"],
+            "EDAD_CALCULADA_DIAS": edades_dias,
+        }
+    )
+    df = agregar_categorizacion_edad(df, ["EDAD_PEDIATRICA", "EDAD_MENOR_18"])
+
+    metricas = obtener_metricas_bandas_edad(
+        df, ["ANO_EGRESO"], columnas_edad=["EDAD_PEDIATRICA", "EDAD_MENOR_18"]
+    )
+
+    # Egresos y dias de estada de cada banda de cada esquema
+    metricas_por_banda = {
+        (fila["ESQUEMA_EDAD"], fila["BANDA_EDAD"]): (fila["n_egresos"], fila["dias_estada_totales"])
+        for fila in metricas.iter_rows(named=True)
+    }
+    assert metricas_por_banda == {
+        ("EDAD_PEDIATRICA", "neonato"): (1, 1),
+        ("EDAD_PEDIATRICA", "ninos"): (1, 2),
+        ("EDAD_PEDIATRICA", "adolescente"): (1, 3),
+        ("EDAD_PEDIATRICA", "adulto"): (2, 9),
+        # Las bandas de otro esquema se traslapan con las anteriores
+        ("EDAD_MENOR_18", "hasta_18"): (3, 6),
+        ("EDAD_MENOR_18", "18_y_mas"): (2, 9),
+    }
+
+
+@pytest.mark.parametrize(
+    "agrupar_por",
+    [
+        ["ANO_EGRESO"],
+        ["ESTABLECIMIENTO_SALUD", "SEXO", "EDAD_CATEGORIA"],
+        ["ANO_EGRESO", "REGION_RESIDENCIA"],  # Atributo que depende del grano del cubo
+        AGRUPACION_METRICAS,
+    ],
+)
+def test_cubo_igual_a_agrupar_directamente(egresos, agrupar_por):
+    cubo = construir_cubo_metricas(egresos)
+    assert set(agrupar_por) <= set(obtener_dimensiones_cubo(cubo))
+
+    desde_cubo = obtener_metricas_egresos(egresos, agrupar_por, cubo=cubo)
+    directas = obtener_metricas_egresos(egresos, agrupar_por)
+
+    columnas = agrupar_por + METRICAS_ADITIVAS
+    assert_frame_equal(
+        desde_cubo.select(columnas).sort(agrupar_por, nulls_last=True),
+        directas.select(columnas).sort(agrupar_por, nulls_last=True),
+    )
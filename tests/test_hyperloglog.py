@@ -0,0 +1,89 @@
+import math
+
+import polars as pl
+import pytest
+
+from src.features import hyperloglog
+from src.features.build_features import obtener_metricas_egresos
+
+# Error relativo configurado en las pruebas (precision 14, 16384 registros)
+ERROR_RELATIVO_PRUEBA = 0.01
+# Desviaciones estandar toleradas respecto al error estandar de la precision usada
+DESVIACIONES_TOLERADAS = 3
+
+
+def obtener_error_tolerado(precision):
+    """Error relativo maximo aceptado para los sketches de una precision"""
+    return DESVIACIONES_TOLERADAS * 1.04 / math.sqrt(2**precision)
+
+
+def estimar_valores_distintos(valores, precision):
+    """Estimacion de HyperLogLog de los valores distintos de una lista"""
+    df = pl.DataFrame({"grupo": [0] * len(valores), "valor": valores})
+    sketches = hyperloglog.construir_sketches_hll(df, ["grupo"], "valor", precision, "sketch")
+
+    return sketches.select(hyperloglog.estimar_cardinalidad_hll("sketch", precision)).item()
+
+
+@pytest.mark.parametrize(
+    "cardinalidad",
+    [
+        50,  # Conteo lineal (casi todos los registros vacios)
+        5_000,  # Conteo lineal, con colisiones de registros
+        200_000,  # Estimador de HyperLogLog
+    ],
+)
+def test_error_relativo_dentro_de_la_cota(cardinalidad):
+    precision = hyperloglog.calcular_precision_hll(ERROR_RELATIVO_PRUEBA)
+    # Cada valor aparece dos veces, los repetidos no deben cambiar la estimacion
+    valores = [f"paciente_{i}" for i in range(cardinalidad)] * 2
+
+    estimacion = estimar_valores_distintos(valores, precision)
+
+    error_relativo = abs(estimacion - cardinalidad) / cardinalidad
+    assert error_relativo <= obtener_error_tolerado(precision)
+
+
+def test_combinar_sketches_igual_a_construir_la_union():
+    precision = hyperloglog.calcular_precision_hll(ERROR_RELATIVO_PRUEBA)
+    # Dos grupos finos que comparten la mitad de sus valores
+    df = pl.DataFrame(
+        {
+            "grupo": [0] * 30_000 + [1] * 30_000,
+            "valor": [f"paciente_{i}" for i in range(30_000)]
+            + [f"paciente_{i}" for i in range(15_000, 45_000)],
+        }
+    )
+
+    finos = hyperloglog.construir_sketches_hll(df, ["grupo"], "valor", precision, "sketch")
+    combinados = hyperloglog.combinar_sketches_hll(
+        finos.with_columns(pl.lit(0).alias("total")), ["total"], "sketch"
+    )
+    union = hyperloglog.construir_sketches_hll(
+        df.with_columns(pl.lit(0).alias("total")), ["total"], "valor", precision, "sketch"
+    )
+
+    assert sorted(combinados["sketch"][0]) == sorted(union["sketch"][0])
+
+
+def test_metricas_aproximadas_igual_a_exactas():
+    df = pl.DataFrame(
+        {
+            "ANO_EGRESO": [2019] * 6 + [2020] * 4,
+            "DIAG1": ["A00"] * 10,
+            "DIAS_ESTADA": list(range(10)),
+            "INTERV_Q": [1, 0] * 5,
+            "CONDICION_EGRESO": [0, 0, 1, 0, 0, 0, 1, 1, 0, 0],
+            "ID_PACIENTE": ["a", "a", "b", None, "c", "c", "d", None, None, "d"],
+        }
+    )
+
+    exactas = obtener_metricas_egresos(df, ["ANO_EGRESO"]).sort("ANO_EGRESO")
+    aproximadas = obtener_metricas_egresos(df, ["ANO_EGRESO"], ERROR_RELATIVO_PRUEBA).sort(
+        "ANO_EGRESO"
+    )
+
+    # Los egresos sin paciente cuentan en las metricas aditivas, pero no en el sketch
+    columnas_aditivas = exactas.columns[:-1]
+    assert aproximadas.select(columnas_aditivas).frame_equal(exactas.select(columnas_aditivas))
+    assert aproximadas["n_pacientes_distintos"].to_list() == [3, 1]
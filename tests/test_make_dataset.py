@@ -0,0 +1,271 @@
+import logging
+import os
+import shutil
+
+import polars as pl
+import pytest
+
+from src.data.make_dataset import (
+    CODIFICACION_ALTERNATIVA,
+    LIMITE_MEMORIA_MB_DEFECTO,
+    VERSION_ESQUEMA,
+    compactar_esquema,
+    detectar_codificacion,
+    escanear_egresos_deis,
+    escribir_parquet_ordenado,
+    exportar_egresos_parquet_incremental,
+    iterar_lotes_archivo,
+    leer_archivos_egresos_deis,
+    leer_manifiesto,
+    normalizar_fechas_egresos,
+    preparar_archivo_utf8,
+)
+from tests.conftest import normalizar_categoricos
+
+# RSS fijo del proceso y memoria para los lotes sobre el, para que el archivo se lea en varios
+# lotes sin depender de las variaciones del RSS real entre mediciones
+RSS_PRUEBA_MB = 100
+MEMORIA_LOTES_MB_PRUEBA = 0.25
+# Esquemas de edad distintos a los por defecto, para verificar que llegan a ambos lectores
+ESQUEMAS_EDAD_PRUEBA = ["EDAD_CATEGORIA", "EDAD_PEDIATRICA"]
+# Contenido con caracteres fuera de ASCII, como las glosas de los archivos del DEIS
+TEXTO_CODIFICACION = "GLOSA;EDAD\nHospital Dr. Sótero del Río;Año 2019\n"
+
+
+@pytest.fixture(scope="module")
+def archivo_egresos(carpeta_egresos):
+    """Archivo DEIS sintetico de un anio"""
+    return str(carpeta_egresos / "egresos_2019.csv")
+
+
+@pytest.mark.parametrize("esquema_compacto", [False, True])
+def test_lectores_lazy_y_por_lotes_son_iguales(archivo_egresos, esquema_compacto, monkeypatch):
+    monkeypatch.setattr("src.data.make_dataset.medir_rss_mb", lambda: RSS_PRUEBA_MB)
+
+    with pl.StringCache():
+        df_lazy = leer_archivos_egresos_deis(
+            archivo_egresos, esquema_compacto, ESQUEMAS_EDAD_PRUEBA
+        ).collect()
+        limite_memoria_mb = RSS_PRUEBA_MB + MEMORIA_LOTES_MB_PRUEBA
+        lotes = list(
+            iterar_lotes_archivo(
+                archivo_egresos, limite_memoria_mb, {}, esquema_compacto, ESQUEMAS_EDAD_PRUEBA
+            )
+        )
+        df_lotes = pl.concat([df_lote for _, df_lote in lotes])
+
+    assert len(lotes) > 1
+    assert set(ESQUEMAS_EDAD_PRUEBA) <= set(df_lotes.columns)
+    assert df_lazy.schema == df_lotes.schema
+    assert normalizar_categoricos(df_lazy).frame_equal(
+        normalizar_categoricos(df_lotes), null_equal=True
+    )
+
+
+def test_texto_vacio_se_lee_como_nulo(archivo_egresos):
+    with pl.StringCache():
+        df = leer_archivos_egresos_deis(archivo_egresos).collect()
+
+    columnas_texto = normalizar_categoricos(df).select(pl.col(pl.Utf8))
+    vacios = columnas_texto.select((pl.all() == "").sum()).row(0)
+
+    assert df.get_column("DIAG2").null_count() > 0
+    assert not any(vacios)
+
+
+def test_parquet_ordenado_usa_orden_numerico(tmp_path):
+    # Como texto, "112103" quedaria antes que "99" y 2019.0 antes que 999.0
+    df = pl.DataFrame(
+        {
+            "ESTABLECIMIENTO_SALUD": [112103.0, 99.0, 112103.0, 99.0],
+            "ANO_EGRESO": [2019.0, 2019.0, 999.0, 999.0],
+            "DIAG1": ["B00", "A00", "A00", "B00"],
+        }
+    ).with_columns(pl.col("DIAG1").cast(pl.Categorical))
+
+    ruta_archivo = escribir_parquet_ordenado(df, tmp_path / "ordenado.parquet")
+    df_ordenado = pl.read_parquet(ruta_archivo)
+
+    assert df_ordenado.get_column("ESTABLECIMIENTO_SALUD").to_list() == [99, 99, 112103, 112103]
+    assert df_ordenado.get_column("ANO_EGRESO").to_list() == [999, 2019, 999, 2019]
+
+
+@pytest.mark.parametrize("valor_invalido", [2.5, 300.0, -1.0])
+def test_compactar_esquema_valida_lazy_y_eager(valor_invalido):
+    df = pl.DataFrame({"SEXO": [1.0, valor_invalido, None]})
+
+    with pytest.raises(ValueError):
+        compactar_esquema(df)
+    with pytest.raises(pl.ComputeError, match="SEXO"):
+        compactar_esquema(df.lazy()).collect()
+
+
+@pytest.mark.parametrize(
+    "codificacion, esperada",
+    [
+        ("utf-8", "utf-8"),
+        ("utf-8-sig", "utf-8-sig"),
+        (CODIFICACION_ALTERNATIVA, CODIFICACION_ALTERNATIVA),
+    ],
+)
+def test_preparar_archivo_utf8_transcodifica(tmp_path, codificacion, esperada):
+    carpeta_utf8 = tmp_path / "utf8"
+    carpeta_utf8.mkdir()
+    ruta_archivo = tmp_path / "egresos.csv"
+    ruta_archivo.write_text(TEXTO_CODIFICACION, encoding=codificacion)
+
+    ruta_utf8, codificacion_detectada = preparar_archivo_utf8(str(ruta_archivo), carpeta_utf8)
+
+    assert detectar_codificacion(ruta_archivo) == esperada
+    assert codificacion_detectada == esperada
+    assert open(ruta_utf8, encoding="utf-8-sig").read() == TEXTO_CODIFICACION
+
+
+def test_preparar_archivo_utf8_detecta_reemplazo_mas_antiguo(tmp_path):
+    carpeta_utf8 = tmp_path / "utf8"
+    carpeta_utf8.mkdir()
+    ruta_archivo = tmp_path / "egresos.csv"
+    ruta_archivo.write_text(TEXTO_CODIFICACION, encoding=CODIFICACION_ALTERNATIVA)
+
+    ruta_utf8, _ = preparar_archivo_utf8(str(ruta_archivo), carpeta_utf8)
+    assert preparar_archivo_utf8(str(ruta_archivo), carpeta_utf8) == (ruta_utf8, None)
+
+    # El archivo se reemplaza por uno con fecha de modificacion anterior a la de la copia
+    texto_nuevo = TEXTO_CODIFICACION.replace("2019", "2020")
+    ruta_archivo.write_text(texto_nuevo, encoding=CODIFICACION_ALTERNATIVA)
+    mtime_antiguo = os.stat(ruta_utf8).st_mtime_ns - 10**9
+    os.utime(ruta_archivo, ns=(mtime_antiguo, mtime_antiguo))
+
+    _, codificacion = preparar_archivo_utf8(str(ruta_archivo), carpeta_utf8)
+
+    assert codificacion == CODIFICACION_ALTERNATIVA
+    assert open(ruta_utf8, encoding="utf-8").read() == texto_nuevo
+
+
+@pytest.fixture
+def carpetas_incrementales(carpeta_egresos, tmp_path):
+    """Copia de los CSV sinteticos y dataset Parquet exportado una vez a partir de ellos"""
+    carpeta_crudos = tmp_path / "crudos"
+    shutil.copytree(carpeta_egresos, carpeta_crudos)
+    ruta_dataset = tmp_path / "parquet"
+    exportar_egresos_parquet_incremental(str(carpeta_crudos), str(ruta_dataset))
+
+    return carpeta_crudos, ruta_dataset
+
+
+def obtener_fechas_salidas(ruta_dataset):
+    """Fecha de modificacion de cada archivo Parquet del dataset"""
+    return {ruta: ruta.stat().st_mtime_ns for ruta in ruta_dataset.rglob("*.parquet")}
+
+
+def test_manifiesto_omite_archivos_sin_cambios(carpetas_incrementales):
+    carpeta_crudos, ruta_dataset = carpetas_incrementales
+    fechas_salidas = obtener_fechas_salidas(ruta_dataset)
+
+    resultado = exportar_egresos_parquet_incremental(str(carpeta_crudos), str(ruta_dataset))
+
+    assert resultado == {"archivos_procesados": [], "anios_modificados": []}
+    assert obtener_fechas_salidas(ruta_dataset) == fechas_salidas
+
+
+def test_manifiesto_reescribe_archivo_modificado(carpetas_incrementales):
+    carpeta_crudos, ruta_dataset = carpetas_incrementales
+    ruta_archivo = carpeta_crudos / "egresos_2019.csv"
+    lineas = ruta_archivo.read_text(encoding="utf-8").splitlines(keepends=True)
+    # Se conserva el encabezado y la mitad de los egresos
+    lineas = lineas[: len(lineas) // 2]
+    ruta_archivo.write_text("".join(lineas), encoding="utf-8")
+
+    resultado = exportar_egresos_parquet_incremental(str(carpeta_crudos), str(ruta_dataset))
+
+    assert resultado == {"archivos_procesados": ["egresos_2019.csv"], "anios_modificados": [2019]}
+    df_2019 = pl.read_parquet(ruta_dataset / "ANO_EGRESO=2019" / "*.parquet")
+    assert len(df_2019) == len(lineas) - 1
+
+
+def test_manifiesto_elimina_particion_de_archivo_borrado(carpetas_incrementales):
+    carpeta_crudos, ruta_dataset = carpetas_incrementales
+    (carpeta_crudos / "egresos_2018.csv").unlink()
+
+    resultado = exportar_egresos_parquet_incremental(str(carpeta_crudos), str(ruta_dataset))
+
+    assert resultado == {"archivos_procesados": [], "anios_modificados": [2018]}
+    assert not (ruta_dataset / "ANO_EGRESO=2018").exists()
+    assert list(leer_manifiesto(ruta_dataset)["archivos"]) == ["egresos_2019.csv"]
+
+
+def test_manifiesto_reconstruye_con_nueva_version_esquema(carpetas_incrementales, monkeypatch):
+    carpeta_crudos, ruta_dataset = carpetas_incrementales
+    monkeypatch.setattr("src.data.make_dataset.VERSION_ESQUEMA", VERSION_ESQUEMA + 1)
+
+    resultado = exportar_egresos_parquet_incremental(str(carpeta_crudos), str(ruta_dataset))
+
+    assert resultado == {
+        "archivos_procesados": ["egresos_2018.csv", "egresos_2019.csv"],
+        "anios_modificados": [2018, 2019],
+    }
+    entradas = leer_manifiesto(ruta_dataset)["archivos"].values()
+    assert {entrada["version_esquema"] for entrada in entradas} == {VERSION_ESQUEMA + 1}
+
+
+def convertir_a_formato_nuevo(ruta_origen, ruta_destino):
+    """Escribe un CSV DEIS antiguo con el formato nuevo: indice sin nombre y EDAD_ANOS"""
+    lineas = ruta_origen.read_text(encoding="utf-8").splitlines(keepends=True)
+    encabezado = lineas[0].replace("EDAD_A_OS", "EDAD_ANOS")
+    filas = [f"{indice};{linea}" for indice, linea in enumerate(lineas[1:])]
+    ruta_destino.write_text("".join([f";{encabezado}"] + filas), encoding="utf-8")
+
+
+def test_formatos_nuevo_y_antiguo_se_leen_juntos(carpeta_egresos, tmp_path):
+    shutil.copy(carpeta_egresos / "egresos_2018.csv", tmp_path / "egresos_2018.csv")
+    convertir_a_formato_nuevo(carpeta_egresos / "egresos_2019.csv", tmp_path / "egresos_2019.csv")
+
+    with pl.StringCache():
+        df_antiguo = escanear_egresos_deis(str(carpeta_egresos / "*.csv")).collect()
+        df_mixto = escanear_egresos_deis(str(tmp_path / "*.csv")).collect()
+
+    assert df_mixto.columns == df_antiguo.columns
+    assert df_mixto.schema == df_antiguo.schema
+    assert normalizar_categoricos(df_mixto).frame_equal(
+        normalizar_categoricos(df_antiguo), null_equal=True
+    )
+
+
+def test_normalizar_fechas_anios_cumplidos_y_fechas_invalidas():
+    # Fecha de nacimiento, fecha de egreso, anio de egreso, anios cumplidos y fecha invalida
+    casos = [
+        ("2000-02-29", "2019-02-28", 2019, 18, False),  # Nacido un 29 de febrero, antes del 1/3
+        ("2000-02-29", "2019-03-01", 2019, 19, False),
+        ("2000-02-29", "2020-02-29", 2020, 20, False),
+        ("1899-06-01", "2019-06-01", 2019, 120, False),  # Justo la edad maxima valida
+        ("1890-01-01", "2019-06-01", 2019, 129, True),
+        ("2019-06-02", "2019-06-01", 2019, -1, True),  # Nacimiento posterior al egreso
+        ("2000-01-01", "2019-02-30", 2019, None, True),  # Fecha que no existe
+        ("2000-01-01", "2018-12-31", 2019, 18, True),  # Egreso fuera de ANO_EGRESO
+    ]
+    df = pl.DataFrame(
+        [caso[:3] for caso in casos],
+        schema=["FECHA_NACIMIENTO", "FECHA_EGRESO", "ANO_EGRESO"],
+        orient="row",
+    )
+
+    df = normalizar_fechas_egresos(df)
+
+    assert df["EDAD_ANOS_CUMPLIDOS"].to_list() == [caso[3] for caso in casos]
+    assert df["FECHA_INVALIDA"].to_list() == [caso[4] for caso in casos]
+
+
+@pytest.mark.parametrize("por_lotes", [False, True])
+def test_esquema_compacto_registra_ahorro_memoria(archivo_egresos, por_lotes, caplog):
+    caplog.set_level(logging.INFO, logger="src.data.make_dataset")
+
+    with pl.StringCache():
+        if por_lotes:
+            lotes = iterar_lotes_archivo(
+                archivo_egresos, LIMITE_MEMORIA_MB_DEFECTO, {}, esquema_compacto=True
+            )
+            list(lotes)
+        else:
+            leer_archivos_egresos_deis(archivo_egresos, esquema_compacto=True).collect()
+
+    assert any("MB ahorrados" in mensaje for mensaje in caplog.messages)